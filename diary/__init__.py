@@ -3,6 +3,22 @@ from .db import init_db
 from os import makedirs
 import os
 from .routes import init_routes
+from .fulltext import init_search_index
+from .closure import init_closure
+from .counters import init_counters
+from .versions import init_versions
+from .export import init_export
+from .excerpts import init_excerpts
+from .importer import init_import
+from .instrument import init_instrumentation
+from .metrics import init_metrics
+from .bench import init_bench
+from .migrations import init_migrations
+from .fragments import init_fragments
+from .tagindex import init_tag_index
+from .suggest import init_suggest
+from .fuzzy import init_fuzzy
+from .sessions import init_sessions
 
 
 def create_app():
@@ -33,6 +49,10 @@ def create_app():
         app.config['DB_PASSWORD'] = os.environ['DB_PASSWORD']
     if os.environ.get('DB_NAME'):
         app.config['DB_NAME'] = os.environ['DB_NAME']
+    if os.environ.get('DB_BACKEND'):
+        app.config['DB_BACKEND'] = os.environ['DB_BACKEND']
+    if os.environ.get('SQLITE_PATH'):
+        app.config['SQLITE_PATH'] = os.environ['SQLITE_PATH']
 
     # Allow SECRET_KEY to be provided via instance config or overridden by environment
     # Order: instance/config.py -> environment -> default (None)
@@ -54,6 +74,22 @@ def create_app():
 
     # Initialize database integrations (register teardown handlers, CLI helpers)
     init_db(app)
+    init_migrations(app)
+    init_instrumentation(app)
+    init_metrics(app)
+    init_versions(app)
+    init_sessions(app)
+    init_search_index(app)
+    init_closure(app)
+    init_counters(app)
+    init_excerpts(app)
+    init_fragments(app)
+    init_tag_index(app)
+    init_suggest(app)
+    init_fuzzy(app)
+    init_export(app)
+    init_import(app)
+    init_bench(app)
 
     init_routes(app)
 
@@ -0,0 +1,361 @@
+"""Synthetic data (`flask seed`) and route benchmarks (`flask bench`).
+
+`flask seed` fills the configured database with reproducible synthetic
+data (fixed `--seed`): a tag forest of `--roots` trees with the given
+`--depth` and `--fanout`, `--entries` entries with log-normally
+distributed body lengths and a skewed number of tags each, and a search
+history with Zipf-like counts. Entries are written through the bulk
+import path (`diary/importer.py`), so postings, the closure table and
+the counters are maintained exactly as in production.
+
+`flask bench` drives the main routes through the app's test client
+(in-process, no network) and reports per scenario the p50/p95/p99
+latency, throughput and SQL statements per request (read from the
+`Server-Timing` header, see `diary/instrument.py`). Results are written
+as JSON; `--compare` prints the change against an earlier run. Point
+both commands at a scratch database, e.g. `DB_BACKEND=sqlite
+SQLITE_PATH=/tmp/bench.sqlite3`.
+
+The `diary_edit` scenario rewrites real entries, so it only runs on a
+database that `flask seed` wrote (it leaves a `bench_seed` table) or
+with `--allow-writes`; otherwise it is skipped.
+"""
+
+import contextvars
+import json
+import math
+import os
+import random
+import re
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .db import get_db, table_exists
+from .importer import TagResolver, write_batch
+from .versions import bump_version
+
+
+WORDS = (
+    'morning evening coffee walk train office meeting project deadline review code bug fix release '
+    'garden rain sun weekend family friend dinner lunch book read write idea plan travel city '
+    'mountain river beach museum music concert film movie run running swim bike yoga sleep dream '
+    'work home kitchen recipe bread soup market shopping budget money invoice client call email '
+    'design draft note journal memory photo camera winter summer spring autumn holiday birthday '
+    'doctor health tired happy quiet busy slow fast learn lesson course language python database '
+    'server deploy query index search cache latency page tag tree branch root leaf child parent'
+).split()
+
+_QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+# Scenarios that write to the database
+_WRITES = ('diary_edit',)
+_SEED_MARKER_DDL = (
+    'CREATE TABLE IF NOT EXISTS bench_seed ('
+    'seeded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, seed INT NOT NULL, entries INT NOT NULL)'
+)
+_NEXT_RE = re.compile(r'cursor=([\w-]+)">Next')
+
+
+def _paragraphs(rng, length):
+    out = []
+    size = 0
+    while size < length:
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 16))).capitalize() + '.'
+        out.append(sentence)
+        size += len(sentence) + 1
+        if rng.random() < 0.15:
+            out.append('\n\n')
+    return ' '.join(out)[:length]
+
+
+def _tag_forest(rng, roots, depth, fanout):
+    """Return tag paths (`a/b/c`) for a forest, parents before children."""
+    paths = []
+    counter = [0]
+
+    def name():
+        counter[0] += 1
+        return f'{rng.choice(WORDS)}-{counter[0]}'
+
+    frontier = [name() for _ in range(roots)]
+    paths.extend(frontier)
+    for _ in range(depth - 1):
+        nxt = []
+        for parent in frontier:
+            for _ in range(fanout):
+                nxt.append(f'{parent}/{name()}')
+        paths.extend(nxt)
+        frontier = nxt
+    return paths
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def _summarize(durations, queries, wall):
+    ordered = sorted(durations)
+    return {
+        'requests': len(durations),
+        'p50_ms': round(_percentile(ordered, 50) * 1000, 2),
+        'p95_ms': round(_percentile(ordered, 95) * 1000, 2),
+        'p99_ms': round(_percentile(ordered, 99) * 1000, 2),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2) if ordered else 0.0,
+        'rps': round(len(durations) / wall, 1) if wall else 0.0,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+class _Runner:
+    """Issues requests as a logged-in user and records timings."""
+
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = user_id
+
+    def request(self, method, url, data=None):
+        start = time.perf_counter()
+        resp = self.client.open(url, method=method, data=data)
+        elapsed = time.perf_counter() - start
+        if resp.status_code >= 500:
+            raise click.ClickException(f'{method} {url} returned {resp.status_code}')
+        m = _QUERIES_RE.search(resp.headers.get('Server-Timing', ''))
+        return resp, elapsed, int(m.group(1)) if m else None
+
+
+def _scenarios(rng, runner, cur, deep_pages):
+    """Build `{name: callable(i) -> (method, url, data)}` from the seeded data."""
+    cur.execute('SELECT id, name FROM tags ORDER BY id')
+    tags = cur.fetchall()
+    cur.execute('SELECT id, title, content FROM diary ORDER BY id DESC LIMIT 200')
+    recent = cur.fetchall()
+    if not recent:
+        raise click.ClickException('The database has no entries; run `flask seed` first.')
+    placeholders = ', '.join(['%s'] * len(recent))
+    cur.execute(f'SELECT diary_id, tag_id FROM diary_tags WHERE diary_id IN ({placeholders})',
+                tuple(e['id'] for e in recent))
+    entry_tags = {}
+    for r in cur.fetchall():
+        entry_tags.setdefault(r['diary_id'], []).append(str(r['tag_id']))
+
+    # Walk the keyset cursors once to find a deep page
+    url = '/preview'
+    for _ in range(deep_pages - 1):
+        resp, _, _ = runner.request('GET', url)
+        m = _NEXT_RE.search(resp.get_data(as_text=True))
+        if not m:
+            break
+        url = f'/preview?cursor={m.group(1)}'
+    deep_url = url
+
+    def pick_tag():
+        return rng.choice(tags) if tags else {'id': 0, 'name': ''}
+
+    def search(n):
+        return lambda i: ('GET', '/search/?q=' + '+'.join(rng.sample(WORDS, n)), None)
+
+    def typo(i):
+        # One keyword with two adjacent letters swapped (see `diary/fuzzy.py`)
+        word = rng.choice(WORDS)
+        j = rng.randrange(len(word) - 1)
+        return ('GET', '/search/?q=' + word[:j] + word[j + 1] + word[j] + word[j + 2:], None)
+
+    def edit(i):
+        # Alternate between two bodies so every edit is a real update;
+        # tags are resubmitted unchanged.
+        e = recent[i % len(recent)]
+        content = e['content'] + (' (edited)' if (i // len(recent)) % 2 == 0 else '')
+        return ('POST', f"/diary/{e['id']}/edit",
+                {'title': e['title'], 'content': content, 'tags': entry_tags.get(e['id'], [])})
+
+    scenarios = {
+        'preview_first': lambda i: ('GET', '/preview', None),
+        'preview_deep_cursor': lambda i: ('GET', deep_url, None),
+        'preview_deep_offset': lambda i: ('GET', f'/preview?page={deep_pages}', None),
+        'preview_tag': lambda i: ('GET', f"/preview?tag={pick_tag()['name']}", None),
+        'preview_tag_combo': lambda i: (
+            'GET', f"/preview?any={pick_tag()['name']}&any={pick_tag()['name']}&exclude={pick_tag()['name']}&deep=1", None),
+        'title_first': lambda i: ('GET', '/title', None),
+        'title_tag': lambda i: ('GET', f"/title?tag={pick_tag()['id']}", None),
+        'tags_index': lambda i: ('GET', '/tags/', None),
+        'tags_trees': lambda i: ('GET', '/tags/trees', None),
+        'diary_edit': edit,
+    }
+    for n in range(1, 6):
+        scenarios[f'search_{n}kw'] = search(n)
+    scenarios['search_typo'] = typo
+    return scenarios
+
+
+def init_bench(app):
+    """Register the `flask seed` and `flask bench` CLI commands."""
+
+    @click.command('seed')
+    @click.option('--entries', default=1000, show_default=True)
+    @click.option('--roots', default=5, show_default=True, help='Root tags.')
+    @click.option('--depth', default=3, show_default=True, help='Levels per tag tree.')
+    @click.option('--fanout', default=3, show_default=True, help='Children per tag.')
+    @click.option('--tags-per-entry', default=2.0, show_default=True, help='Mean tags per entry.')
+    @click.option('--history', default=200, show_default=True, help='Search-history terms.')
+    @click.option('--seed', 'seed_value', default=42, show_default=True, help='Random seed.')
+    @with_appcontext
+    def seed_command(entries, roots, depth, fanout, tags_per_entry, history, seed_value):
+        """Generate reproducible synthetic entries, tags and search history."""
+        rng = random.Random(seed_value)
+        paths = _tag_forest(rng, roots, depth, fanout)
+        # Skewed popularity: a few tags are used far more than the rest
+        weights = [1.0 / (rank + 1) for rank in range(len(paths))]
+        rng.shuffle(weights)
+        start = datetime.now().replace(microsecond=0) - timedelta(days=3 * 365)
+        step = (3 * 365 * 86400) / max(entries, 1)
+
+        conn = get_db()
+        started = time.monotonic()
+        done = 0
+        try:
+            with conn.cursor() as cur:
+                resolver = TagResolver(cur)
+                for p in paths:
+                    resolver.resolve(p)
+                batch = []
+                for i in range(entries):
+                    length = int(min(20000, max(40, rng.lognormvariate(math.log(800), 0.9))))
+                    k = min(len(paths), int(rng.expovariate(1 / tags_per_entry) + 0.5)) if tags_per_entry > 0 else 0
+                    chosen = set(rng.choices(paths, weights=weights, k=k)) if k else set()
+                    batch.append({
+                        'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 7))).capitalize(),
+                        'content': _paragraphs(rng, length),
+                        'created_at': start + timedelta(seconds=int(i * step)),
+                        'tags': sorted(chosen),
+                    })
+                    if len(batch) >= 500:
+                        done += write_batch(conn, cur, resolver, batch)
+                        batch = []
+                        click.echo(f'Seeded {done} entries...')
+                if batch:
+                    done += write_batch(conn, cur, resolver, batch)
+
+                terms = sorted({' '.join(rng.sample(WORDS, rng.randint(1, 3))) for _ in range(history)})
+                rows = [(t, max(1, int(1000 / (rank + 1))), start + timedelta(seconds=rng.randint(0, 3 * 365 * 86400)))
+                        for rank, t in enumerate(terms)]
+                for s in range(0, len(rows), 500):
+                    chunk = rows[s:s + 500]
+                    cur.execute(
+                        f"INSERT INTO search_history (term, count, last_searched) VALUES {', '.join(['(%s, %s, %s)'] * len(chunk))} "
+                        "ON DUPLICATE KEY UPDATE count = count + VALUES(count)",
+                        tuple(v for row in chunk for v in row),
+                    )
+
+                # Marks the database as synthetic for `flask bench` (see `_WRITES`)
+                cur.execute(_SEED_MARKER_DDL)
+                cur.execute('INSERT INTO bench_seed (seed, entries) VALUES (%s, %s)', (seed_value, done))
+        finally:
+            bump_version('tags', 'entries')
+        elapsed = time.monotonic() - started
+        click.echo(f'Seeded {done} entries, {len(paths)} tags and {len(terms)} search terms in {elapsed:.1f}s.')
+
+    @click.command('bench')
+    @click.option('--requests', 'count', default=100, show_default=True, help='Requests per scenario.')
+    @click.option('--warmup', default=10, show_default=True, help='Unmeasured requests per scenario.')
+    @click.option('--deep-pages', default=20, show_default=True, help='Page depth for the deep preview scenarios.')
+    @click.option('--only', multiple=True, help='Run only these scenarios (repeatable).')
+    @click.option('--user-id', default=1, show_default=True, help='Session user id for requests.')
+    @click.option('--seed', 'seed_value', default=42, show_default=True, help='Random seed.')
+    @click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+                  help='JSON results file (default: instance/bench/bench-<time>.json).')
+    @click.option('--compare', type=click.Path(exists=True, dir_okay=False), default=None,
+                  help='Earlier results file to compare against.')
+    @click.option('--allow-writes', is_flag=True,
+                  help='Run the diary_edit scenario on a database not written by `flask seed`.')
+    @with_appcontext
+    def bench_command(count, warmup, deep_pages, only, user_id, seed_value, output, compare, allow_writes):
+        """Benchmark the listing, search, tag and edit routes in-process."""
+        app = current_app._get_current_object()
+        app.config['SQL_INSTRUMENTATION'] = True
+        app.config['SERVER_TIMING'] = True
+        rng = random.Random(seed_value)
+
+        skip = set()
+        if not allow_writes:
+            with get_db().cursor() as cur:
+                seeded = table_exists(cur, 'bench_seed')
+            if not seeded:
+                requested = [name for name in _WRITES if name in only]
+                if requested:
+                    raise click.ClickException(
+                        f"{', '.join(requested)} edits entries, and this database was not written by "
+                        '`flask seed`; pass --allow-writes to run it anyway.'
+                    )
+                skip.update(_WRITES)
+                if not only:
+                    click.echo(f"Skipping {', '.join(_WRITES)}: not a `flask seed` database (see --allow-writes).")
+
+        def run():
+            # Runs in an empty context so every request gets its own app
+            # context (and pooled connection), as under gunicorn.
+            runner = _Runner(app, user_id)
+            with app.app_context():
+                with get_db().cursor() as cur:
+                    scenarios = _scenarios(rng, runner, cur, deep_pages)
+            results = {}
+            for name, make in scenarios.items():
+                if (only and name not in only) or name in skip:
+                    continue
+                for i in range(warmup):
+                    runner.request(*make(i))
+                durations, queries = [], []
+                wall = time.perf_counter()
+                for i in range(count):
+                    _, elapsed, n = runner.request(*make(i))
+                    durations.append(elapsed)
+                    if n is not None:
+                        queries.append(n)
+                results[name] = _summarize(durations, queries, time.perf_counter() - wall)
+                r = results[name]
+                click.echo(
+                    f"{name:22} p50 {r['p50_ms']:8.2f}ms  p95 {r['p95_ms']:8.2f}ms  p99 {r['p99_ms']:8.2f}ms  "
+                    f"{r['rps']:8.1f} req/s  {r['queries_per_request']} q/req"
+                )
+            return results
+
+        results = contextvars.Context().run(run)
+
+        report = {
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'backend': app.config.get('DB_BACKEND'),
+            'requests': count,
+            'warmup': warmup,
+            'seed': seed_value,
+            'scenarios': results,
+        }
+        if output is None:
+            directory = os.path.join(app.instance_path, 'bench')
+            os.makedirs(directory, exist_ok=True)
+            output = os.path.join(directory, f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+        with open(output, 'w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=2)
+        click.echo(f'Wrote {output}')
+
+        if compare:
+            with open(compare, 'r', encoding='utf-8') as fh:
+                before = json.load(fh).get('scenarios', {})
+            click.echo(f'Compared with {compare} (p50 / p95, negative is faster):')
+            for name, r in results.items():
+                old = before.get(name)
+                if not old:
+                    continue
+                deltas = []
+                for key in ('p50_ms', 'p95_ms'):
+                    deltas.append(f"{(r[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else 'n/a')
+                click.echo(f'{name:22} {deltas[0]:>8} {deltas[1]:>8}')
+
+    app.cli.add_command(seed_command)
+    app.cli.add_command(bench_command)
@@ -0,0 +1,98 @@
+"""Log of entry writes for the per-worker in-memory indexes.
+
+The tag bitmap index (`diary/tagindex.py`) and the fuzzy-search title
+vocabulary (`diary/fuzzy.py`) live in each gunicorn worker. The shared
+`entries` data version tells a worker that *something* changed; this
+log tells it *what*, so it can catch up by re-reading a few rows
+instead of rebuilding from a scan of every entry on the request path.
+
+Every write to entries records, in the same transaction, one row in
+`entry_changes`:
+
+- `diary_id` set: the entry was created, edited or deleted (readers
+  re-read its current state);
+- `tag_id` set: the tag was deleted and removed from every entry;
+- both NULL: a bulk write (`flask import`, `flask seed`); readers rebuild.
+
+A reader keeps a `Feed` position and calls `Feed.poll()` when the
+version moved. Sequence numbers are assigned at insert but become
+visible at commit, so each poll re-reads the last `_OVERLAP` rows and
+skips the ones it already applied; a writer that commits out of order
+is still seen. Readers that fall more than `_MAX_BATCH` rows behind
+rebuild instead. Writers prune rows older than the newest `_KEEP`.
+"""
+
+
+_OVERLAP = 64
+_MAX_BATCH = 2000
+_KEEP = 20000
+_PRUNE_EVERY = 1000
+
+
+def _insert(cur, rows):
+    placeholders = ', '.join(['(%s, %s)'] * len(rows))
+    cur.execute(
+        f'INSERT INTO entry_changes (diary_id, tag_id) VALUES {placeholders}',
+        tuple(v for row in rows for v in row),
+    )
+    first = cur.lastrowid or 0
+    # Prune now and then, keeping enough rows for any reader that may
+    # still catch up instead of rebuilding
+    if first and (first % _PRUNE_EVERY) < len(rows):
+        cur.execute('DELETE FROM entry_changes WHERE seq <= %s', (first - _KEEP,))
+
+
+def record(cur, entry_ids=(), tag_id=None):
+    """Log changed `entry_ids` and/or a deleted `tag_id` (inside the write's transaction)."""
+    rows = [(entry_id, None) for entry_id in entry_ids]
+    if tag_id is not None:
+        rows.append((None, tag_id))
+    if rows:
+        _insert(cur, rows)
+
+
+def record_reset(cur):
+    """Log a bulk write after which readers rebuild."""
+    _insert(cur, [(None, None)])
+
+
+class Feed:
+    """A reader's position in `entry_changes`."""
+
+    def __init__(self):
+        self.seq = 0
+        self.seen = set()
+
+    def start(self, cur):
+        """Take the current position (call before reading the tables)."""
+        cur.execute('SELECT seq FROM entry_changes ORDER BY seq DESC LIMIT %s', (_OVERLAP,))
+        self.seen = {int(r['seq']) for r in cur.fetchall()}
+        self.seq = max(self.seen, default=0)
+
+    def poll(self, cur):
+        """Return `(entry_ids, tag_ids)` changed since the last poll, or None to rebuild."""
+        low = max(0, self.seq - _OVERLAP)
+        cur.execute(
+            'SELECT seq, diary_id, tag_id FROM entry_changes WHERE seq > %s ORDER BY seq LIMIT %s',
+            (low, _MAX_BATCH + _OVERLAP + 1),
+        )
+        rows = cur.fetchall()
+        if len(rows) > _MAX_BATCH + _OVERLAP:
+            return None
+        entry_ids = set()
+        tag_ids = set()
+        for r in rows:
+            seq = int(r['seq'])
+            if seq in self.seen:
+                continue
+            if r['diary_id'] is not None:
+                entry_ids.add(int(r['diary_id']))
+            elif r['tag_id'] is not None:
+                tag_ids.add(int(r['tag_id']))
+            else:
+                return None
+            self.seen.add(seq)
+        if rows:
+            self.seq = max(self.seq, int(rows[-1]['seq']))
+        self.seen = {s for s in self.seen if s > self.seq - _OVERLAP}
+        return entry_ids, tag_ids
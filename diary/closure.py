@@ -0,0 +1,115 @@
+"""Maintenance of `diary_tags_closure`.
+
+The closure table holds one `(diary_id, tag_id)` row for every tag an
+entry carries directly *and* for every ancestor of those tags, so
+"entries under tag X" is a single indexed lookup instead of a recursive
+walk of `tags.parent_id` per query.
+
+Rows are (re)derived from `diary_tags` and `tags` with one recursive
+`INSERT ... SELECT` per batch of entries:
+- `diary.new` / `diary.edit` refresh the entry they wrote;
+- `tags.edit` (re-parenting) and `tags.delete` refresh every entry that
+  was under the tag before the change;
+- `flask rebuild-closure` backfills the whole table in id-range batches
+  and then bumps the `tags` and `entries` data versions, so workers drop
+  search results and pages cached from the old rows.
+"""
+
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from .db import get_db
+from .versions import bump_version
+
+
+REFRESH_BATCH = 500
+
+# `UNION` (not `UNION ALL`) de-duplicates rows, which also stops the
+# recursion should the tag hierarchy ever contain a cycle.
+_INSERT_SQL = """
+INSERT INTO diary_tags_closure (diary_id, tag_id)
+WITH RECURSIVE anc (diary_id, tag_id) AS (
+    SELECT dt.diary_id, dt.tag_id FROM diary_tags dt WHERE dt.{where}
+    UNION
+    SELECT a.diary_id, t.parent_id
+    FROM anc a JOIN tags t ON t.id = a.tag_id
+    WHERE t.parent_id IS NOT NULL
+)
+SELECT diary_id, tag_id FROM anc
+"""
+
+
+def _refresh_where(cur, where, params):
+    """Re-derive closure rows for entries selected by `where` (on `diary_id`)."""
+    cur.execute(f'DELETE FROM diary_tags_closure WHERE {where}', params)
+    cur.execute(_INSERT_SQL.format(where=where), params)
+
+
+def refresh_entries(cur, diary_ids):
+    """Recompute the closure rows of the given entries."""
+    ids = sorted({int(i) for i in diary_ids})
+    for start in range(0, len(ids), REFRESH_BATCH):
+        batch = ids[start:start + REFRESH_BATCH]
+        placeholders = ', '.join(['%s'] * len(batch))
+        _refresh_where(cur, f'diary_id IN ({placeholders})', tuple(batch))
+
+
+def remove_entry(cur, diary_id):
+    """Drop the closure rows of a deleted entry."""
+    cur.execute('DELETE FROM diary_tags_closure WHERE diary_id = %s', (diary_id,))
+
+
+def entries_under_tag(cur, tag_id):
+    """Return ids of entries carrying `tag_id` or any of its descendants.
+
+    Call this *before* re-parenting or deleting a tag, then pass the
+    result to `refresh_entries()` afterwards.
+    """
+    cur.execute('SELECT diary_id FROM diary_tags_closure WHERE tag_id = %s', (tag_id,))
+    return [r['diary_id'] for r in cur.fetchall()]
+
+
+def init_closure(app):
+    """Register the `flask rebuild-closure` CLI command."""
+
+    @click.command('rebuild-closure')
+    @click.option('--batch-size', default=5000, show_default=True, help='Diary ids per batch.')
+    @with_appcontext
+    def rebuild_closure_command(batch_size):
+        """Rebuild `diary_tags_closure` from `diary_tags` and the tag tree."""
+        conn = get_db()
+        started = time.monotonic()
+        with conn.cursor() as cur:
+            cur.execute('SELECT MIN(id) AS lo, MAX(id) AS hi FROM diary')
+            bounds = cur.fetchone()
+            if bounds['lo'] is None:
+                cur.execute('DELETE FROM diary_tags_closure')
+                bump_version('tags', 'entries')
+                click.echo('No diary entries; closure table cleared.')
+                return
+
+            lo, hi = int(bounds['lo']), int(bounds['hi'])
+            try:
+                for start in range(lo, hi + 1, batch_size):
+                    end = start + batch_size - 1
+                    conn.begin()
+                    try:
+                        _refresh_where(cur, 'diary_id BETWEEN %s AND %s', (start, end))
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    click.echo(f'Processed ids {start}..{min(end, hi)}')
+            finally:
+                # Cached search results and deep-filter pages read the closure
+                bump_version('tags', 'entries')
+
+            cur.execute('SELECT COUNT(*) AS cnt FROM diary_tags_closure')
+            rows = cur.fetchone()['cnt']
+
+        elapsed = time.monotonic() - started
+        click.echo(f'Rebuilt diary_tags_closure ({rows} rows) in {elapsed:.1f}s.')
+
+    app.cli.add_command(rebuild_closure_command)
@@ -0,0 +1,95 @@
+"""Conditional GET helpers (ETag / Last-Modified / 304).
+
+Views compute a validator *before* running their real queries:
+
+- listing pages (`home.preview`, `home.title`, `tags.trees`) derive an
+  ETag from the query arguments and the shared data versions
+  (`diary/versions.py`), which costs a memory read and no database
+  round trip;
+- `diary.detail` reads `diary.updated_at` with a primary-key lookup.
+
+When the request's `If-None-Match` (or, failing that,
+`If-Modified-Since`) matches, `not_modified()` returns an empty 304 and
+the view skips its queries and template. Otherwise the view renders as
+before and `with_validators()` attaches the validators.
+
+Responses are `Cache-Control: private, no-cache` (browsers keep them but
+revalidate every time) and the ETag includes the logged-in user id,
+since pages differ per session. Pending flash messages do not prevent a
+304: none of these pages render them (only the login, register and edit
+forms do), so they would stay pending and turn off 304s for the rest of
+the session.
+"""
+
+import hashlib
+from datetime import datetime, timezone
+
+from flask import current_app, make_response, request, session
+
+
+def make_etag(*parts):
+    """Return an opaque ETag value for `parts` (plus the session user)."""
+    raw = repr((session.get('user_id'),) + parts).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()[:24]
+
+
+def _query_key():
+    """The request's query arguments in a canonical order.
+
+    The same filters or page given in another order (or an empty
+    `?tag=&cursor=`) select the same page, so they share one ETag.
+    """
+    return tuple(sorted((k, v) for k, v in request.args.items(multi=True) if v))
+
+
+def version_etag(*names):
+    """ETag from the shared data versions `names` and the query, or None when unavailable.
+
+    Process-local counters (no shared versions file) cannot vouch for
+    writes made by other workers, so no validator is produced then.
+    """
+    counters = current_app.extensions['diary_versions']
+    if not counters.shared:
+        return None
+    return make_etag(request.endpoint, _query_key(), counters.get('epoch'), *(counters.get(n) for n in names))
+
+
+def from_timestamp(ts):
+    """Convert a `UNIX_TIMESTAMP()` value to an aware UTC datetime (or None)."""
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(float(ts), timezone.utc)
+
+
+def _apply(response, etag, last_modified):
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 response if the client's copy is current, else None."""
+    if request.method not in ('GET', 'HEAD') or (etag is None and last_modified is None):
+        return None
+
+    if request.if_none_match:
+        fresh = etag is not None and request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since is not None:
+        fresh = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    return _apply(current_app.response_class(status=304), etag, last_modified)
+
+
+def with_validators(rv, etag, last_modified=None):
+    """Turn a view return value into a response carrying the validators."""
+    response = make_response(rv)
+    if response.status_code != 200:
+        return response
+    return _apply(response, etag, last_modified)
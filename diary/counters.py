@@ -0,0 +1,201 @@
+"""Maintained entry counters (`entry_counters` table).
+
+Listing pages need "Page N of M", which used to cost a `COUNT(*)` (or a
+`COUNT(DISTINCT ...)` join for tag filters) on every view. Instead the
+write paths keep one row per tag with
+
+- `direct_count`: entries carrying the tag itself (`diary_tags`)
+- `rollup_count`: entries carrying the tag or a descendant
+  (`diary_tags_closure`)
+
+plus a row with `tag_id = 0` holding the total number of entries.
+Readers do a primary-key lookup. `flask reconcile-counters` recomputes
+everything from the source tables and repairs any drift (for example
+after upgrading an existing database, or a crash between statements).
+"""
+
+import click
+from flask.cli import with_appcontext
+
+from .db import get_db
+from .versions import bump_version
+
+
+GLOBAL = 0
+
+
+def tag_sets(cur, diary_id):
+    """Return `(direct, rollup)` tag-id sets currently recorded for an entry."""
+    cur.execute('SELECT tag_id FROM diary_tags WHERE diary_id = %s', (diary_id,))
+    direct = {r['tag_id'] for r in cur.fetchall()}
+    cur.execute('SELECT tag_id FROM diary_tags_closure WHERE diary_id = %s', (diary_id,))
+    rollup = {r['tag_id'] for r in cur.fetchall()}
+    return direct, rollup
+
+
+def adjust(cur, deltas):
+    """Apply `{tag_id: (direct_delta, rollup_delta)}` in one upsert."""
+    rows = [(tid, d, r) for tid, (d, r) in deltas.items() if d or r]
+    if not rows:
+        return
+    placeholders = ', '.join(['(%s, %s, %s)'] * len(rows))
+    cur.execute(
+        f"INSERT INTO entry_counters (tag_id, direct_count, rollup_count) VALUES {placeholders} "
+        "ON DUPLICATE KEY UPDATE direct_count = direct_count + VALUES(direct_count), "
+        "rollup_count = rollup_count + VALUES(rollup_count)",
+        tuple(v for row in rows for v in row),
+    )
+
+
+def entry_changed(cur, before, after, total_delta=0):
+    """Adjust counters for one entry whose tag sets went from `before` to `after`.
+
+    `before`/`after` are `(direct, rollup)` pairs as returned by
+    `tag_sets()`; use empty sets for a created or deleted entry together
+    with `total_delta` of +1 / -1.
+    """
+    deltas = {}
+
+    def add(tid, d, r):
+        old = deltas.get(tid, (0, 0))
+        deltas[tid] = (old[0] + d, old[1] + r)
+
+    if total_delta:
+        add(GLOBAL, total_delta, total_delta)
+    for tid in after[0] - before[0]:
+        add(tid, 1, 0)
+    for tid in before[0] - after[0]:
+        add(tid, -1, 0)
+    for tid in after[1] - before[1]:
+        add(tid, 0, 1)
+    for tid in before[1] - after[1]:
+        add(tid, 0, -1)
+    adjust(cur, deltas)
+
+
+def recount_rollups(cur, tag_ids):
+    """Recompute `rollup_count` exactly for the given tags.
+
+    Used after the tag hierarchy changes (re-parenting, deletion), which
+    shifts rollups along whole ancestor chains.
+    """
+    ids = sorted({int(t) for t in tag_ids if t})
+    if not ids:
+        return
+    placeholders = ', '.join(['%s'] * len(ids))
+    cur.execute(
+        f"""
+        INSERT INTO entry_counters (tag_id, direct_count, rollup_count)
+        SELECT t.id, 0, (SELECT COUNT(*) FROM diary_tags_closure c WHERE c.tag_id = t.id)
+        FROM tags t WHERE t.id IN ({placeholders})
+        ON DUPLICATE KEY UPDATE rollup_count = VALUES(rollup_count)
+        """,
+        tuple(ids),
+    )
+
+
+def remove_tag(cur, tag_id):
+    """Drop the counter row of a deleted tag."""
+    cur.execute('DELETE FROM entry_counters WHERE tag_id = %s', (tag_id,))
+
+
+def entry_count(cur, tag_id=None, rollup=False):
+    """Return the number of entries (optionally carrying `tag_id`).
+
+    Falls back to counting when no counter row exists yet.
+    """
+    key = GLOBAL if tag_id is None else tag_id
+    column = 'rollup_count' if rollup else 'direct_count'
+    cur.execute(f'SELECT {column} AS cnt FROM entry_counters WHERE tag_id = %s', (key,))
+    row = cur.fetchone()
+    if row is not None:
+        return max(0, int(row['cnt']))
+
+    if tag_id is None:
+        cur.execute('SELECT COUNT(*) AS cnt FROM diary')
+    elif rollup:
+        cur.execute('SELECT COUNT(*) AS cnt FROM diary_tags_closure WHERE tag_id = %s', (tag_id,))
+    else:
+        cur.execute('SELECT COUNT(*) AS cnt FROM diary_tags WHERE tag_id = %s', (tag_id,))
+    return int(cur.fetchone()['cnt'])
+
+
+def _expected_counts(cur):
+    expected = {}
+    cur.execute('SELECT COUNT(*) AS cnt FROM diary')
+    n = int(cur.fetchone()['cnt'])
+    expected[GLOBAL] = (n, n)
+    cur.execute('SELECT id FROM tags')
+    for r in cur.fetchall():
+        expected[r['id']] = (0, 0)
+    cur.execute('SELECT tag_id, COUNT(*) AS cnt FROM diary_tags GROUP BY tag_id')
+    for r in cur.fetchall():
+        expected[r['tag_id']] = (int(r['cnt']), expected.get(r['tag_id'], (0, 0))[1])
+    cur.execute('SELECT tag_id, COUNT(*) AS cnt FROM diary_tags_closure GROUP BY tag_id')
+    for r in cur.fetchall():
+        expected[r['tag_id']] = (expected.get(r['tag_id'], (0, 0))[0], int(r['cnt']))
+    return expected
+
+
+def drift(cur):
+    """Return `(stored, fixes, stale)`: counter rows that differ from a recount.
+
+    `fixes` maps tag ids to the expected `(direct, rollup)` counts and
+    `stale` lists counter rows of tags that no longer exist.
+    """
+    expected = _expected_counts(cur)
+    cur.execute('SELECT tag_id, direct_count, rollup_count FROM entry_counters')
+    stored = {r['tag_id']: (int(r['direct_count']), int(r['rollup_count'])) for r in cur.fetchall()}
+    fixes = {tid: want for tid, want in expected.items() if stored.get(tid) != want}
+    stale = [tid for tid in stored if tid not in expected]
+    return stored, fixes, stale
+
+
+def repair(cur, fixes, stale):
+    """Write the rows returned by `drift()` (inside the caller's transaction)."""
+    rows = sorted(fixes.items())
+    for start in range(0, len(rows), 500):
+        batch = rows[start:start + 500]
+        placeholders = ', '.join(['(%s, %s, %s)'] * len(batch))
+        cur.execute(
+            f"INSERT INTO entry_counters (tag_id, direct_count, rollup_count) VALUES {placeholders} "
+            "ON DUPLICATE KEY UPDATE direct_count = VALUES(direct_count), rollup_count = VALUES(rollup_count)",
+            tuple(v for tid, (d, r) in batch for v in (tid, d, r)),
+        )
+    if stale:
+        placeholders = ', '.join(['%s'] * len(stale))
+        cur.execute(f'DELETE FROM entry_counters WHERE tag_id IN ({placeholders})', tuple(stale))
+
+
+def init_counters(app):
+    """Register the `flask reconcile-counters` CLI command."""
+
+    @click.command('reconcile-counters')
+    @click.option('--dry-run', is_flag=True, help='Report drift without fixing it.')
+    @with_appcontext
+    def reconcile_counters_command(dry_run):
+        """Recompute `entry_counters` from diary, diary_tags and the closure."""
+        conn = get_db()
+        with conn.cursor() as cur:
+            stored, fixes, stale = drift(cur)
+            for tid, want in sorted(fixes.items()):
+                click.echo(f'tag_id={tid}: stored={stored.get(tid)} expected={want}')
+            for tid in stale:
+                click.echo(f'tag_id={tid}: counter row for a missing tag')
+
+            if dry_run or not (fixes or stale):
+                click.echo(f'{len(fixes) + len(stale)} counter rows drifted.')
+                return
+
+            conn.begin()
+            try:
+                repair(cur, fixes, stale)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        # Tag usage, page totals and listing ETags are cached by version
+        bump_version('tags', 'entries')
+        click.echo(f'Repaired {len(fixes) + len(stale)} counter rows.')
+
+    app.cli.add_command(reconcile_counters_command)
@@ -1,14 +1,20 @@
 """Database helpers for the `diary` Flask application.
 
-This module configures a persistent MySQL connection stored on `g.db`.
-It registers a teardown handler with the Flask app so connections are
-closed at the end of requests. The implementation will attempt to
-connect to a database named `diary` and create it if it does not exist.
+This module hands out pooled database connections stored on `g.db`.
+`DB_BACKEND` selects MySQL (`'mysql'`, the default) or a local SQLite
+file in WAL mode (`'sqlite'`, see `diary/sqlite_db.py`); SQL in the app
+is written for MySQL and translated for SQLite.
+Connections come from a per-process `ConnectionPool` (see `diary/pool.py`)
+and a teardown handler returns them to the pool at the end of requests.
+When the pool opens a connection it will attempt to connect to a
+database named `diary` and create it if it does not exist.
 
 Credentials must be provided by the application configuration or
 environment (see `create_app()` in `diary/__init__.py`). Do not put
 secrets in source files.
 
+Cursors are timed per request by `diary/instrument.py`.
+
 Note: This requires a running MySQL server and the `PyMySQL` package.
 """
 
@@ -20,19 +26,34 @@ import click
 from flask.cli import with_appcontext
 import os
 from os import path
+import sqlite3
+import threading
+from .pool import ConnectionPool
+from .instrument import DictCursor
+from . import sqlite_db
 
+# Raised on unique/foreign-key violations by either backend
+IntegrityError = (pymysql.err.IntegrityError, sqlite3.IntegrityError)
 
-def get_db():
-    """Return a MySQL connection, creating it and the database if needed.
 
-    The connection is stored on `g.db` for the request lifecycle.
+_pool_lock = threading.Lock()
+
+
+def _connect(app):
+    """Open a new connection for the configured backend."""
+    if app.config.get('DB_BACKEND') == 'sqlite':
+        return sqlite_db.connect(app)
+    return _connect_mysql(app)
+
+
+def _connect_mysql(app):
+    """Open a new MySQL connection, creating the database if needed.
+
+    Only the pool calls this, so the `CREATE DATABASE` fallback runs when
+    a connection is first opened rather than on every request.
     Raises a RuntimeError when DB credentials are missing so callers
     get a clear message instead of accidental anonymous connections.
     """
-    if 'db' in g:
-        return g.db
-
-    app = current_app._get_current_object()
     host = app.config.get('DB_HOST', 'localhost')
     port = int(app.config.get('DB_PORT', 3306))
     user = app.config.get('DB_USER')
@@ -46,7 +67,7 @@ def get_db():
 
     # Try connecting directly to the requested database
     try:
-        conn = pymysql.connect(host=host, port=port, user=user, password=password, db=db_name, cursorclass=pymysql.cursors.DictCursor, autocommit=True)
+        return pymysql.connect(host=host, port=port, user=user, password=password, db=db_name, cursorclass=DictCursor, autocommit=True)
     except OperationalError as exc:
         # If the database does not exist, create it and reconnect.
         # Other errors are re-raised.
@@ -55,7 +76,7 @@ def get_db():
             # Connect without database to create it
             admin_conn: Optional[pymysql.connections.Connection] = None
             try:
-                admin_conn = pymysql.connect(host=host, port=port, user=user, password=password, cursorclass=pymysql.cursors.DictCursor, autocommit=True)
+                admin_conn = pymysql.connect(host=host, port=port, user=user, password=password, cursorclass=DictCursor, autocommit=True)
                 with admin_conn.cursor() as cur:
                     cur.execute(f"CREATE DATABASE IF NOT EXISTS `{db_name}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;")
             finally:
@@ -63,29 +84,81 @@ def get_db():
                     admin_conn.close()
 
             # Reconnect to the newly created database
-            conn = pymysql.connect(host=host, port=port, user=user, password=password, db=db_name, cursorclass=pymysql.cursors.DictCursor, autocommit=True)
-        else:
-            raise
+            return pymysql.connect(host=host, port=port, user=user, password=password, db=db_name, cursorclass=DictCursor, autocommit=True)
+        raise
+
+
+def get_pool(app=None):
+    """Return the per-process connection pool for `app`, creating it lazily.
+
+    The pool lives in `app.extensions['diary_pool']`. It is created on
+    first use (not in `create_app()`) so gunicorn's master never opens
+    connections that forked workers would inherit.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+
+    pool = app.extensions.get('diary_pool')
+    if pool is not None:
+        return pool
+
+    with _pool_lock:
+        pool = app.extensions.get('diary_pool')
+        if pool is None:
+            cfg = app.config
+            pool = ConnectionPool(
+                lambda: _connect(app),
+                min_size=int(cfg.get('DB_POOL_MIN_SIZE', 0)),
+                max_size=int(cfg.get('DB_POOL_MAX_SIZE', 10)),
+                recycle=cfg.get('DB_POOL_RECYCLE', 300),
+                max_lifetime=cfg.get('DB_POOL_MAX_LIFETIME', 3600),
+                timeout=float(cfg.get('DB_POOL_TIMEOUT', 10)),
+                reset_on_return=bool(cfg.get('DB_POOL_RESET_ON_RETURN', True)),
+            )
+            app.extensions['diary_pool'] = pool
+    return pool
+
+
+def get_db():
+    """Return a pooled MySQL connection for the current app context.
+
+    The connection is checked out of the pool once and stored on `g.db`
+    for the request lifecycle; `close_db()` returns it at teardown.
+    """
+    if 'db' in g:
+        return g.db
 
-    g.db = conn
-    return conn
+    g.db = get_pool().acquire()
+    return g.db
 
 
 def close_db(e=None):
-    """Close the MySQL connection stored on `g` if present."""
+    """Return the connection stored on `g` (if any) to the pool."""
     db = g.pop('db', None)
 
     if db is not None:
         try:
-            db.close()
+            get_pool().release(db)
         except Exception:
             pass
 
 
+def table_exists(cur, name):
+    """Return True if table `name` exists in the current database."""
+    if current_app.config.get('DB_BACKEND') == 'sqlite':
+        cur.execute("SELECT COUNT(*) AS cnt FROM sqlite_master WHERE type = 'table' AND name = %s", (name,))
+    else:
+        cur.execute(
+            "SELECT COUNT(*) AS cnt FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+            (name,),
+        )
+    return cur.fetchone()['cnt'] > 0
+
+
 def init_db(app=None):
     """Initialize DB helpers for the given Flask app.
 
-    This registers a teardown handler that closes DB connections and
+    This registers a teardown handler that returns DB connections to the pool and
     provides a convenient place to expose CLI commands later. Secret
     values (DB_USER/DB_PASSWORD) should be set via environment or
     `instance/config.py` and are deliberately not defaulted here.
@@ -97,22 +170,36 @@ def init_db(app=None):
         app = current_app
 
     # Default configuration values for non-secret options
+    app.config.setdefault('DB_BACKEND', 'mysql')
+    app.config.setdefault('SQLITE_PATH', path.join(app.instance_path, 'diary.sqlite3'))
     app.config.setdefault('DB_HOST', 'localhost')
     app.config.setdefault('DB_PORT', 3306)
     app.config.setdefault('DB_NAME', 'diary')
 
+    # Connection pool sizing and health checks (see `diary/pool.py`)
+    app.config.setdefault('DB_POOL_MIN_SIZE', 0)
+    app.config.setdefault('DB_POOL_MAX_SIZE', 10)
+    app.config.setdefault('DB_POOL_RECYCLE', 300)
+    app.config.setdefault('DB_POOL_MAX_LIFETIME', 3600)
+    app.config.setdefault('DB_POOL_TIMEOUT', 10)
+    app.config.setdefault('DB_POOL_RESET_ON_RETURN', True)
+
     app.teardown_appcontext(close_db)
 
     # Register a Flask CLI command to initialize schema from instance/schema.sql
     @click.command('init-db')
     @with_appcontext
     def init_db_command():
-        """Initialize the database schema from `instance/schema.sql`.
+        """Initialize the database schema.
 
-        The SQL file is expected to contain one or more statements separated
-        by semicolons. This command will execute each non-empty statement.
+        MySQL reads `instance/schema.sql`, SQLite `instance/schema-sqlite.sql`.
+        The MySQL file is expected to contain one or more statements separated
+        by semicolons; the SQLite file is run as one script. Pending
+        migrations (`diary/migrations.py`) are applied afterwards.
         """
-        schema_path = path.join(current_app.instance_path, 'schema.sql')
+        sqlite = current_app.config.get('DB_BACKEND') == 'sqlite'
+        schema_name = 'schema-sqlite.sql' if sqlite else 'schema.sql'
+        schema_path = path.join(current_app.instance_path, schema_name)
         if not path.exists(schema_path):
             click.echo(f'No schema file found at {schema_path}')
             return
@@ -122,12 +209,20 @@ def init_db(app=None):
             sql = fh.read()
 
         conn = get_db()
-        with conn.cursor() as cur:
-            # Naive split by semicolon; sufficient for simple schema files.
-            for stmt in (s.strip() for s in sql.split(';')):
-                if not stmt:
-                    continue
-                cur.execute(stmt)
+        if sqlite:
+            # Trigger bodies contain semicolons; let SQLite split the script
+            conn.executescript(sql)
+        else:
+            with conn.cursor() as cur:
+                # Naive split by semicolon; sufficient for simple schema files.
+                for stmt in (s.strip() for s in sql.split(';')):
+                    if not stmt:
+                        continue
+                    cur.execute(stmt)
+
+        # Bring tables that already existed up to date (no-ops on a new database)
+        from .migrations import migrate
+        migrate(conn)
 
         click.echo('Initialized the database schema.')
 
@@ -0,0 +1,66 @@
+"""Diff-based writes of an entry's `diary_tags` rows.
+
+`diary.edit` used to delete every association of the entry and insert
+the selected tags again one statement at a time (and `diary.new` also
+inserted row by row), each statement committing on its own under
+autocommit. `set_entry_tags()` instead compares the submitted ids with
+the stored ones and applies only the difference: one multi-row `INSERT`
+for the additions and one `DELETE ... IN` for the removals. Callers run
+it inside the same transaction as the rest of the entry write.
+"""
+
+
+WRITE_BATCH = 500
+
+
+def parse_tag_ids(values, known=None):
+    """Return the set of valid integer tag ids among form `values`.
+
+    Values that are not integers are ignored, as are ids missing from
+    `known` (e.g. the catalogue's id -> name map) when it is given.
+    """
+    ids = set()
+    for value in values:
+        try:
+            tag_id = int(value)
+        except (TypeError, ValueError):
+            continue
+        if known is not None and tag_id not in known:
+            continue
+        ids.add(tag_id)
+    return ids
+
+
+def current_tag_ids(cur, diary_id):
+    """Return the set of tag ids stored for an entry."""
+    cur.execute('SELECT tag_id FROM diary_tags WHERE diary_id = %s', (diary_id,))
+    return {r['tag_id'] for r in cur.fetchall()}
+
+
+def set_entry_tags(cur, diary_id, tag_ids, existing=None):
+    """Make the entry carry exactly `tag_ids`; return `(added, removed)`.
+
+    `existing` may be passed when the caller already knows the stored
+    ids (an empty set for a freshly inserted entry) to save a query.
+    """
+    wanted = set(tag_ids)
+    if existing is None:
+        existing = current_tag_ids(cur, diary_id)
+    added = sorted(wanted - existing)
+    removed = sorted(existing - wanted)
+
+    for start in range(0, len(removed), WRITE_BATCH):
+        batch = removed[start:start + WRITE_BATCH]
+        placeholders = ', '.join(['%s'] * len(batch))
+        cur.execute(
+            f'DELETE FROM diary_tags WHERE diary_id = %s AND tag_id IN ({placeholders})',
+            (diary_id, *batch),
+        )
+    for start in range(0, len(added), WRITE_BATCH):
+        batch = added[start:start + WRITE_BATCH]
+        placeholders = ', '.join(['(%s, %s)'] * len(batch))
+        cur.execute(
+            f'INSERT INTO diary_tags (diary_id, tag_id) VALUES {placeholders}',
+            tuple(v for tag_id in batch for v in (diary_id, tag_id)),
+        )
+    return added, removed
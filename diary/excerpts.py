@@ -0,0 +1,102 @@
+"""Precomputed entry excerpts for listing pages.
+
+`home.preview` used to select and render the full `content` TEXT of
+every listed entry. `diary.new` / `diary.edit` (and `flask import`) now
+also store `diary.excerpt`: the first `EXCERPT_LENGTH` characters of
+the body, cut at a word boundary where possible, and
+`diary.excerpt_truncated` saying whether anything was cut. Listings read
+only those columns; the full body is loaded by `diary.detail` or on
+demand through the `diary.content_fragment` endpoint ("Show more").
+
+After changing `EXCERPT_LENGTH` (or upgrading an existing database),
+run `flask rebuild-excerpts`. It keeps `updated_at` (an excerpt is not
+an edit) and bumps the `entries` and `fragments` data versions, so
+running workers re-render their cached listing fragments and pages.
+"""
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .db import get_db
+from .versions import bump_version
+
+
+DEFAULT_LENGTH = 300
+# Size of the `diary.excerpt` column
+MAX_LENGTH = 2000
+
+
+def excerpt_length(app=None):
+    """Configured excerpt length, clamped to the column size."""
+    app = app or current_app
+    return max(1, min(int(app.config.get('EXCERPT_LENGTH', DEFAULT_LENGTH)), MAX_LENGTH))
+
+
+def make_excerpt(content, length=None):
+    """Return `(excerpt, truncated)` for an entry body."""
+    content = content or ''
+    if length is None:
+        length = excerpt_length()
+    if len(content) <= length:
+        return content, False
+    cut = content[:length]
+    # Prefer ending on whitespace unless that would drop most of the text
+    space = max(cut.rfind(' '), cut.rfind('\n'))
+    if space >= length * 2 // 3:
+        cut = cut[:space]
+    return cut.rstrip(), True
+
+
+def init_excerpts(app):
+    """Register the `flask rebuild-excerpts` CLI command."""
+    app.config.setdefault('EXCERPT_LENGTH', DEFAULT_LENGTH)
+
+    @click.command('rebuild-excerpts')
+    @click.option('--batch-size', default=500, show_default=True, help='Entries per batch.')
+    @with_appcontext
+    def rebuild_excerpts_command(batch_size):
+        """Recompute `diary.excerpt` for every entry."""
+        conn = get_db()
+        length = excerpt_length()
+        started = time.monotonic()
+        done = 0
+        last_id = 0
+        try:
+            with conn.cursor() as cur:
+                while True:
+                    cur.execute(
+                        'SELECT id, content FROM diary WHERE id > %s ORDER BY id LIMIT %s',
+                        (last_id, batch_size),
+                    )
+                    rows = cur.fetchall()
+                    if not rows:
+                        break
+                    conn.begin()
+                    try:
+                        for r in rows:
+                            excerpt, truncated = make_excerpt(r['content'], length)
+                            # `updated_at = updated_at` keeps MySQL's ON UPDATE from
+                            # treating the backfill as an edit
+                            cur.execute(
+                                'UPDATE diary SET excerpt = %s, excerpt_truncated = %s, updated_at = updated_at '
+                                'WHERE id = %s',
+                                (excerpt, truncated, r['id']),
+                            )
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    done += len(rows)
+                    last_id = rows[-1]['id']
+                    click.echo(f'Updated {done} excerpts...')
+        finally:
+            # Listing pages and cached fragments show the excerpts
+            bump_version('entries', 'fragments')
+
+        elapsed = time.monotonic() - started
+        click.echo(f'Rebuilt {done} excerpts in {elapsed:.1f}s.')
+
+    app.cli.add_command(rebuild_excerpts_command)
@@ -0,0 +1,154 @@
+"""Cache of rendered per-entry HTML fragments.
+
+The listing templates render each entry through a small partial:
+`home/_entry_card.html` (preview), `home/_entry_title.html` (titles)
+and `home/_entry_tags.html` (the tag links; search results highlight
+the title per query, so only the tags are shared there). Templates call
+`fragment(name, e)` instead of including the partial, and the rendered
+HTML is kept in a per-worker LRU keyed by `(name, entry id)`.
+
+Each cached fragment remembers the entry's stamp, `(updated_at, tags,
+fragments version)`: `diary.edit` always moves `updated_at`, a tag
+rename changes the `tags` string and bulk rewrites that keep
+`updated_at` (`flask rebuild-excerpts`) bump the shared `fragments`
+data version, so a fragment rendered before any of them (in any worker)
+is never served, and is replaced the next time that entry is listed. This
+worker also drops an entry's fragments on `diary.edit`/`diary.delete`
+and clears the cache on tag renames and deletes, so stale HTML does not
+linger until evicted. Rows without `updated_at` are rendered uncached.
+
+Memory is capped by fragment count and by the total size of the cached
+HTML; `FRAGMENT_CACHE_MAX_ENTRIES = 0` disables the cache.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+from .versions import data_version
+
+
+_cache_lock = threading.Lock()
+
+
+class FragmentCache:
+    """LRU of rendered HTML per `(template, entry id)`, validated by stamp."""
+
+    def __init__(self, max_entries=5000, max_bytes=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key):
+        _, html = self._items.pop(key)
+        self._bytes -= len(html)
+
+    def get(self, key, stamp):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[0] == stamp:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, stamp, html):
+        if len(html) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = (stamp, html)
+            self._bytes += len(html)
+            while self._items and (len(self._items) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._items)))
+                self.evictions += 1
+
+    def invalidate_entry(self, entry_id):
+        """Drop every cached fragment of `entry_id`."""
+        with self._lock:
+            for key in [k for k in self._items if k[1] == entry_id]:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+def get_fragment_cache(app=None):
+    """Return this worker's `FragmentCache`, or None when disabled."""
+    if app is None:
+        app = current_app._get_current_object()
+    cache = app.extensions.get('diary_fragment_cache')
+    if cache is None:
+        max_entries = int(app.config.get('FRAGMENT_CACHE_MAX_ENTRIES', 5000))
+        if max_entries <= 0:
+            return None
+        with _cache_lock:
+            cache = app.extensions.get('diary_fragment_cache')
+            if cache is None:
+                cache = FragmentCache(
+                    max_entries=max_entries,
+                    max_bytes=int(app.config.get('FRAGMENT_CACHE_MAX_BYTES', 4 * 1024 * 1024)),
+                )
+                app.extensions['diary_fragment_cache'] = cache
+    return cache
+
+
+def invalidate_entry(entry_id):
+    cache = current_app.extensions.get('diary_fragment_cache')
+    if cache is not None:
+        cache.invalidate_entry(entry_id)
+
+
+def clear_fragments():
+    cache = current_app.extensions.get('diary_fragment_cache')
+    if cache is not None:
+        cache.clear()
+
+
+def render_fragment(name, entry):
+    """Render partial `name` for `entry` (as `e`), from the cache when current."""
+    template = current_app.jinja_env.get_template(name)
+    cache = get_fragment_cache()
+    updated_at = entry.get('updated_at')
+    if cache is None or updated_at is None:
+        return Markup(template.render(e=entry))
+
+    key = (name, entry['id'])
+    stamp = (updated_at, entry.get('tags'), data_version('fragments'))
+    html = cache.get(key, stamp)
+    if html is None:
+        html = Markup(template.render(e=entry))
+        cache.put(key, stamp, html)
+    return html
+
+
+def init_fragments(app):
+    """Expose `fragment()` to templates."""
+    app.config.setdefault('FRAGMENT_CACHE_MAX_ENTRIES', 5000)
+    app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', 4 * 1024 * 1024)
+    app.jinja_env.globals['fragment'] = render_fragment
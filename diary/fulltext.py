@@ -0,0 +1,226 @@
+"""Inverted index used by `search.index`.
+
+Each diary entry is tokenized into the `diary_postings` table
+(`token`, `diary_id`, `weight`) whenever `diary.new` / `diary.edit`
+write it, so a search is a handful of primary-key range scans instead of
+`LIKE '%kw%'` over every `content` row.
+
+Tokenization:
+- Latin/other scripts: runs of letters/digits, case-folded.
+- CJK scripts (no spaces between words): overlapping character bigrams,
+  plus the last character of each run as a unigram, similar to MySQL's
+  ngram parser.
+
+A query keyword matches an entry when every token of the keyword is
+present (word tokens match by prefix, so `run` finds `running`). This
+approximates the old substring semantics without a table scan. The
+`weight` of a posting is its term frequency with title hits counted
+`TITLE_WEIGHT` times; results are ranked by the summed weight.
+
+Tag names are not indexed here: the tags table is small, so matching
+tag ids are resolved directly and joined through `diary_tags_closure`.
+"""
+
+import re
+import time
+from collections import Counter
+
+import click
+from flask.cli import with_appcontext
+
+from .db import get_db
+from .versions import bump_version
+
+
+TITLE_WEIGHT = 3
+TAG_WEIGHT = 2
+MAX_TOKEN_LENGTH = 64
+INSERT_BATCH = 500
+
+_WORD_RE = re.compile(r'[^\W_]+')
+_CJK_RE = re.compile('([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)')
+
+
+def _segments(text):
+    """Yield `(segment, is_cjk)` pairs for the word runs in `text`."""
+    for word in _WORD_RE.findall(text or ''):
+        for i, part in enumerate(_CJK_RE.split(word.casefold())):
+            if part:
+                # re.split puts captured (CJK) groups at odd indexes
+                yield part, bool(i % 2)
+
+
+def tokenize(text):
+    """Return the list of index tokens for `text` (with repeats)."""
+    tokens = []
+    for seg, is_cjk in _segments(text):
+        if is_cjk:
+            tokens.extend(seg[i:i + 2] for i in range(len(seg) - 1))
+            tokens.append(seg[-1])
+        else:
+            tokens.append(seg[:MAX_TOKEN_LENGTH])
+    return tokens
+
+
+def query_tokens(keyword):
+    """Return `(token, is_prefix)` pairs that must all match for `keyword`."""
+    out = []
+    for seg, is_cjk in _segments(keyword):
+        if is_cjk and len(seg) > 1:
+            out.extend((seg[i:i + 2], False) for i in range(len(seg) - 1))
+        else:
+            # single CJK characters and words match any token they start
+            out.append((seg[:MAX_TOKEN_LENGTH], True))
+    # de-duplicate while keeping order
+    return list(dict.fromkeys(out))
+
+
+def _weights(title, content):
+    weights = Counter()
+    for tok in tokenize(title):
+        weights[tok] += TITLE_WEIGHT
+    for tok in tokenize(content):
+        weights[tok] += 1
+    return weights
+
+
+def _insert_postings(cur, rows):
+    for start in range(0, len(rows), INSERT_BATCH):
+        batch = rows[start:start + INSERT_BATCH]
+        placeholders = ', '.join(['(%s, %s, %s)'] * len(batch))
+        cur.execute(
+            f'INSERT INTO diary_postings (token, diary_id, weight) VALUES {placeholders}',
+            tuple(v for row in batch for v in row),
+        )
+
+
+def index_entry(cur, diary_id, title, content):
+    """(Re)build the postings of one entry using `cur`."""
+    cur.execute('DELETE FROM diary_postings WHERE diary_id = %s', (diary_id,))
+    _insert_postings(cur, [(tok, diary_id, w) for tok, w in _weights(title, content).items()])
+
+
+def index_new_entries(cur, entries):
+    """Write postings for freshly inserted `(diary_id, title, content)` rows.
+
+    Unlike `index_entry()` there is nothing to delete first, and the
+    postings of all entries share the same batched inserts.
+    """
+    rows = []
+    for diary_id, title, content in entries:
+        rows.extend((tok, diary_id, w) for tok, w in _weights(title, content).items())
+    _insert_postings(cur, rows)
+
+
+def remove_entry(cur, diary_id):
+    """Drop the postings of a deleted entry."""
+    cur.execute('DELETE FROM diary_postings WHERE diary_id = %s', (diary_id,))
+
+
+def match_sql(keywords, tag_ids, via_closure=True):
+    """Build SQL yielding `(diary_id, score)` for entries matching every keyword.
+
+    `tag_ids` maps each keyword to the ids of tags whose name contains it;
+    entries carrying such a tag (directly or via a descendant) also match
+    that keyword. With `via_closure` the lookup goes through
+    `diary_tags_closure`; otherwise `tag_ids` must already include the
+    descendant tags and `diary_tags` is used.
+
+    Returns `(sql, params)`, or `(None, None)` when no keyword can match.
+    """
+    parts = []
+    params = []
+    for kw in keywords:
+        branches = []
+        toks = query_tokens(kw)
+        if toks:
+            conds = []
+            hits = []
+            cond_params = []
+            for tok, is_prefix in toks:
+                if is_prefix:
+                    conds.append('p.token LIKE %s')
+                    # tokens are letters/digits only, so no LIKE escaping is needed
+                    cond_params.append(tok + '%')
+                else:
+                    conds.append('p.token = %s')
+                    cond_params.append(tok)
+                hits.append(f'MAX({conds[-1]})')
+            branches.append(
+                'SELECT p.diary_id, SUM(p.weight) AS score FROM diary_postings p '
+                f"WHERE {' OR '.join(conds)} GROUP BY p.diary_id "
+                f"HAVING {' + '.join(hits)} = {len(toks)}"
+            )
+            params.extend(cond_params)
+            params.extend(cond_params)
+
+        ids = tag_ids.get(kw) or []
+        if ids:
+            placeholders = ', '.join(['%s'] * len(ids))
+            table = 'diary_tags_closure' if via_closure else 'diary_tags'
+            branches.append(
+                f'SELECT c.diary_id, {TAG_WEIGHT} AS score FROM {table} c '
+                f'WHERE c.tag_id IN ({placeholders})'
+            )
+            params.extend(ids)
+
+        if not branches:
+            # This keyword can match nothing, so the AND of all keywords is empty
+            return None, None
+        parts.append(
+            'SELECT m.diary_id, SUM(m.score) AS score FROM ('
+            + ' UNION ALL '.join(branches)
+            + ') m GROUP BY m.diary_id'
+        )
+
+    if not parts:
+        return None, None
+    sql = (
+        'SELECT k.diary_id, SUM(k.score) AS score FROM ('
+        + ' UNION ALL '.join(parts)
+        + f') k GROUP BY k.diary_id HAVING COUNT(*) = {len(parts)}'
+    )
+    return sql, params
+
+
+def init_search_index(app):
+    """Register the `flask reindex-search` CLI command."""
+
+    @click.command('reindex-search')
+    @click.option('--batch-size', default=500, show_default=True, help='Entries per batch.')
+    @with_appcontext
+    def reindex_search_command(batch_size):
+        """Rebuild `diary_postings` for every diary entry."""
+        conn = get_db()
+        started = time.monotonic()
+        done = 0
+        last_id = 0
+        try:
+            with conn.cursor() as cur:
+                while True:
+                    cur.execute(
+                        'SELECT id, title, content FROM diary WHERE id > %s ORDER BY id LIMIT %s',
+                        (last_id, batch_size),
+                    )
+                    rows = cur.fetchall()
+                    if not rows:
+                        break
+                    conn.begin()
+                    try:
+                        for r in rows:
+                            index_entry(cur, r['id'], r['title'], r['content'])
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    done += len(rows)
+                    last_id = rows[-1]['id']
+                    click.echo(f'Indexed {done} entries...')
+        finally:
+            # Search results are cached by the `entries` version
+            bump_version('entries')
+
+        elapsed = time.monotonic() - started
+        click.echo(f'Reindexed {done} entries in {elapsed:.1f}s.')
+
+    app.cli.add_command(reindex_search_command)
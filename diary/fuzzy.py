@@ -0,0 +1,321 @@
+"""Typo-tolerant search: trigram candidates re-ranked by edit distance.
+
+When every keyword of a search matches, nothing here runs. When the
+exact search finds nothing, `search.index` asks `correct()` to replace
+each keyword that has no postings with the closest word from entry
+titles or tag names, and runs the search once more with the corrected
+keywords. `did_you_mean()` proposes the closest, most searched term from
+`search_history`. A user who misspells a word therefore gets results
+from one request instead of retrying variants, each another scan.
+
+Candidates come from per-worker `TrigramIndex` vocabularies: each word
+is split into padded trigrams (`'  py', ' py', 'pyt', ..., 'on '`), and
+the words sharing the most trigrams with the query (Jaccard similarity
+of at least `SEARCH_FUZZY_THRESHOLD`) are re-ranked by Damerau edit
+distance, allowing 1 edit for 3-4 letter words, 2 up to 8 letters and 3
+beyond. Keywords shorter than 3 letters are never corrected.
+
+- Title words follow the shared `entries` data version: this worker's
+  `diary.new`/`diary.edit`/`diary.delete` update them in place
+  (`title_changed()`); writes of other processes are caught up from the
+  `entry_changes` log (see `diary/changelog.py`) by re-reading only the
+  changed titles. Only bulk writes rebuild them.
+- Tag words are rebuilt from the cached tag catalogue when it changes.
+- Search terms are the `SUGGEST_HISTORY_TERMS` most searched, shared with
+  the typeahead (see `diary/suggest.py`).
+
+Set `SEARCH_FUZZY = False` to disable the fallback.
+"""
+
+import threading
+from collections import Counter
+
+from flask import current_app
+
+from . import changelog
+from .db import get_db
+from .fulltext import query_tokens, tokenize
+from .instrument import SSDictCursor
+from .suggest import get_search_trie
+from .tagcache import get_catalogue
+from .versions import data_version
+
+
+_build_lock = threading.Lock()
+MIN_WORD_LENGTH = 3
+# Candidates by trigram similarity that are checked for edit distance
+_CANDIDATES = 32
+# Titles re-read per statement when catching up
+_CATCH_UP_CHUNK = 500
+
+
+def trigrams(word):
+    """Padded trigrams of `word` (already casefolded)."""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_distance(word):
+    """Edits tolerated when correcting `word`."""
+    n = len(word)
+    if n < MIN_WORD_LENGTH:
+        return 0
+    if n <= 4:
+        return 1
+    if n <= 8:
+        return 2
+    return 3
+
+
+def edit_distance(a, b, limit):
+    """Damerau (optimal string alignment) distance, or `limit + 1` if larger."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class TrigramIndex:
+    """Vocabulary of words with a count each, searchable by trigram overlap.
+
+    Words whose count drops to zero stay in the postings but are skipped.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.words = []
+        self.ids = {}
+        self.counts = []
+        self.sizes = []
+        self.grams = {}
+
+    def add(self, word, n=1):
+        with self.lock:
+            word_id = self.ids.get(word)
+            if word_id is None:
+                word_id = len(self.words)
+                grams = trigrams(word)
+                self.words.append(word)
+                self.ids[word] = word_id
+                self.counts.append(0)
+                self.sizes.append(len(grams))
+                for g in grams:
+                    self.grams.setdefault(g, []).append(word_id)
+            self.counts[word_id] += n
+
+    def discard(self, word, n=1):
+        with self.lock:
+            word_id = self.ids.get(word)
+            if word_id is not None:
+                self.counts[word_id] = max(0, self.counts[word_id] - n)
+
+    def count(self, word):
+        word_id = self.ids.get(word)
+        return self.counts[word_id] if word_id is not None else 0
+
+    def similar(self, word, threshold=0.2):
+        """Return `[(distance, -count, word)]` within `max_distance(word)`, best first."""
+        limit = max_distance(word)
+        if not limit:
+            return []
+        grams = trigrams(word)
+        with self.lock:
+            shared = Counter()
+            for g in grams:
+                shared.update(self.grams.get(g, ()))
+            scored = []
+            for word_id, n in shared.items():
+                if self.counts[word_id] <= 0:
+                    continue
+                similarity = n / (len(grams) + self.sizes[word_id] - n)
+                if similarity >= threshold:
+                    scored.append((similarity, word_id))
+            scored.sort(reverse=True)
+            candidates = [(self.words[i], self.counts[i]) for _, i in scored[:_CANDIDATES]]
+        out = []
+        for cand, count in candidates:
+            d = edit_distance(word, cand, limit)
+            if d <= limit:
+                out.append((d, -count, cand))
+        out.sort()
+        return out
+
+
+def _title_words(title):
+    return {t for t in tokenize(title) if len(t) >= MIN_WORD_LENGTH}
+
+
+class TitleIndex(TrigramIndex):
+    """Words of all entry titles, with the words of each entry to update them."""
+
+    def __init__(self):
+        super().__init__()
+        self.entry_words = {}
+        self.feed = changelog.Feed()
+
+    @classmethod
+    def build(cls, cur, version):
+        index = cls()
+        index.version = version
+        # Position in the change log first (see `tagindex.TagIndex.build`)
+        index.feed.start(cur)
+        counts = Counter()
+        cur.execute('SELECT id, title FROM diary')
+        for r in cur:
+            words = frozenset(_title_words(r['title']))
+            index.entry_words[r['id']] = words
+            counts.update(words)
+        for word, n in counts.items():
+            index.add(word, n)
+        return index
+
+    def set_title(self, entry_id, title):
+        """Replace the words of one entry (`title=None`: deleted)."""
+        old = self.entry_words.pop(entry_id, frozenset())
+        new = frozenset(_title_words(title)) if title is not None else frozenset()
+        if new:
+            self.entry_words[entry_id] = new
+        for word in old - new:
+            self.discard(word)
+        for word in new - old:
+            self.add(word)
+
+    def catch_up(self, cur, entry_ids):
+        entry_ids = sorted(entry_ids)
+        for i in range(0, len(entry_ids), _CATCH_UP_CHUNK):
+            chunk = entry_ids[i:i + _CATCH_UP_CHUNK]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cur.execute(f'SELECT id, title FROM diary WHERE id IN ({placeholders})', tuple(chunk))
+            titles = {r['id']: r['title'] for r in cur.fetchall()}
+            for entry_id in chunk:
+                self.set_title(entry_id, titles.get(entry_id))
+
+
+def get_title_index():
+    """Return this worker's title vocabulary, caught up or rebuilt if the entries version moved."""
+    app = current_app._get_current_object()
+    version = data_version('entries')
+    index = app.extensions.get('diary_fuzzy_titles')
+    if index is not None and index.version == version:
+        return index
+
+    with _build_lock:
+        index = app.extensions.get('diary_fuzzy_titles')
+        if index is not None and index.version == version:
+            return index
+        if index is not None:
+            with get_db().cursor() as cur:
+                changes = index.feed.poll(cur)
+                if changes is not None:
+                    # Tag deletes leave titles alone
+                    index.catch_up(cur, changes[0])
+                    index.version = max(index.version, version)
+                    return index
+        with get_db().cursor(SSDictCursor) as cur:
+            index = TitleIndex.build(cur, version)
+        app.extensions['diary_fuzzy_titles'] = index
+        return index
+
+
+def title_changed(entry_id, title):
+    """Update the title vocabulary for this worker's write.
+
+    Call after `bump_version('entries')`, with `title=None` for a deleted
+    entry. Applied only if the vocabulary saw every earlier write (see
+    `tagindex._apply`); otherwise it catches up on next use.
+    """
+    index = current_app.extensions.get('diary_fuzzy_titles')
+    if index is None:
+        return
+    version = data_version('entries')
+    with _build_lock:
+        if index.version != version - 1:
+            return
+        index.set_title(entry_id, title)
+        index.version = version
+
+
+def get_tag_index():
+    """Words of all tag names, rebuilt when the tag catalogue changes."""
+    app = current_app._get_current_object()
+    catalogue = get_catalogue()
+    index = app.extensions.get('diary_fuzzy_tags')
+    if index is not None and index.version == catalogue.version:
+        return index
+    index = TrigramIndex()
+    for t in catalogue.names:
+        for word in _title_words(t['name']):
+            index.add(word, max(1, catalogue.usage.get(t['id'], 0)))
+    index.version = catalogue.version
+    app.extensions['diary_fuzzy_tags'] = index
+    return index
+
+
+def get_term_index():
+    """Most searched terms, rebuilt whenever the typeahead re-reads them."""
+    app = current_app._get_current_object()
+    trie = get_search_trie()
+    index = app.extensions.get('diary_fuzzy_terms')
+    if index is not None and index.source is trie:
+        return index
+    index = TrigramIndex()
+    for term, (count, _) in list(trie.scores.items()):
+        index.add(' '.join(term.casefold().split()), count)
+    index.source = trie
+    app.extensions['diary_fuzzy_terms'] = index
+    return index
+
+
+def _has_hits(cur, keyword):
+    """True when `keyword` matches some posting or tag name on its own."""
+    if any(keyword in t['name'].casefold() for t in get_catalogue().names):
+        return True
+    for tok, is_prefix in query_tokens(keyword):
+        if is_prefix:
+            cur.execute('SELECT 1 FROM diary_postings WHERE token LIKE %s LIMIT 1', (tok + '%',))
+        else:
+            cur.execute('SELECT 1 FROM diary_postings WHERE token = %s LIMIT 1', (tok,))
+        if cur.fetchone() is None:
+            return False
+    return True
+
+
+def correct(cur, keywords):
+    """Return `keywords` with unmatched ones corrected, or None if none could be."""
+    threshold = float(current_app.config.get('SEARCH_FUZZY_THRESHOLD', 0.2))
+    out = []
+    changed = False
+    for kw in keywords:
+        if max_distance(kw) and not _has_hits(cur, kw):
+            candidates = get_title_index().similar(kw, threshold) + get_tag_index().similar(kw, threshold)
+            if candidates:
+                kw = min(candidates)[2]
+                changed = True
+        out.append(kw)
+    return sorted(set(out)) if changed else None
+
+
+def did_you_mean(q):
+    """The closest past search to `q` that differs from it, or None."""
+    query = ' '.join(q.casefold().split())
+    threshold = float(current_app.config.get('SEARCH_FUZZY_THRESHOLD', 0.2))
+    for distance, _, term in get_term_index().similar(query, threshold):
+        if distance:
+            return term
+    return None
+
+
+def init_fuzzy(app):
+    app.config.setdefault('SEARCH_FUZZY', True)
+    app.config.setdefault('SEARCH_FUZZY_THRESHOLD', 0.2)
@@ -0,0 +1,172 @@
+"""Write-behind buffering of `search_history` increments.
+
+`search.index` used to run an `INSERT ... ON DUPLICATE KEY UPDATE
+count = count + 1` (a hot-row write plus a commit) for every search.
+Searches now call `record_search(term)`, which only bumps an in-process
+counter. A daemon thread merges the pending increments per term and
+writes them with a single multi-row upsert every
+`SEARCH_HISTORY_FLUSH_INTERVAL` seconds, or sooner once
+`SEARCH_HISTORY_FLUSH_TERMS` distinct terms are pending. The buffer is
+also flushed at interpreter exit (gunicorn workers exit cleanly on
+graceful shutdown/restart).
+
+Setting `SEARCH_HISTORY_FLUSH_INTERVAL = 0` writes through synchronously.
+
+`search.history` merges `pending()` into the rows it reads, so counts
+shown by a worker include its own not-yet-flushed searches.
+"""
+
+import atexit
+import os
+import threading
+import weakref
+from datetime import datetime
+
+from flask import current_app
+
+from .db import get_db
+
+
+class HistoryBuffer:
+    """Per-process buffer of `term -> (count, last_searched)` increments."""
+
+    def __init__(self, app, interval=5.0, max_terms=100):
+        self.app = app
+        self.interval = interval
+        self.max_terms = max_terms
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _reset_after_fork(self):
+        # Threads and held locks do not survive fork; the parent keeps
+        # responsibility for the increments it buffered.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='search-history-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Flushing search history failed; will retry.')
+
+    def record(self, term):
+        """Count one search for `term`."""
+        now = datetime.now().replace(microsecond=0)
+        if not self.interval:
+            self._write({term: (1, now)})
+            return
+        self._ensure_thread()
+        with self._lock:
+            count, _ = self._pending.get(term, (0, now))
+            self._pending[term] = (count + 1, now)
+            full = len(self._pending) >= self.max_terms
+        if full:
+            self._wake.set()
+
+    def pending(self):
+        """Snapshot of unflushed increments: `{term: (count, last_searched)}`."""
+        with self._lock:
+            return dict(self._pending)
+
+    def discard(self, term):
+        """Forget unflushed increments for `term` (e.g. when it is deleted)."""
+        with self._lock:
+            self._pending.pop(term, None)
+
+    def flush(self):
+        """Write all pending increments in one upsert; re-queue them on failure."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                self._write(batch)
+            except Exception:
+                with self._lock:
+                    for term, (count, last) in batch.items():
+                        old_count, old_last = self._pending.get(term, (0, last))
+                        self._pending[term] = (old_count + count, max(old_last, last))
+                raise
+
+    def _write(self, batch):
+        rows = sorted(batch.items())
+        with self.app.app_context():
+            conn = get_db()
+            with conn.cursor() as cur:
+                for start in range(0, len(rows), 500):
+                    chunk = rows[start:start + 500]
+                    placeholders = ', '.join(['(%s, %s, %s)'] * len(chunk))
+                    cur.execute(
+                        f"INSERT INTO search_history (term, count, last_searched) VALUES {placeholders} "
+                        "ON DUPLICATE KEY UPDATE count = count + VALUES(count), "
+                        "last_searched = GREATEST(last_searched, VALUES(last_searched))",
+                        tuple(v for term, (count, last) in chunk for v in (term, count, last)),
+                    )
+
+
+_buffer_lock = threading.Lock()
+_buffers = weakref.WeakSet()
+
+
+def _reset_buffers_after_fork():
+    for buf in list(_buffers):
+        buf._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_buffers_after_fork)
+
+
+def get_history_buffer(app=None):
+    """Return the app's `HistoryBuffer`, creating it on first use."""
+    if app is None:
+        app = current_app._get_current_object()
+    buf = app.extensions.get('diary_history_buffer')
+    if buf is None:
+        with _buffer_lock:
+            buf = app.extensions.get('diary_history_buffer')
+            if buf is None:
+                buf = HistoryBuffer(
+                    app,
+                    interval=float(app.config.get('SEARCH_HISTORY_FLUSH_INTERVAL', 5)),
+                    max_terms=int(app.config.get('SEARCH_HISTORY_FLUSH_TERMS', 100)),
+                )
+                app.extensions['diary_history_buffer'] = buf
+                _buffers.add(buf)
+                atexit.register(_flush_at_exit, buf)
+    return buf
+
+
+def _flush_at_exit(buf):
+    if buf._pid != os.getpid():
+        return
+    try:
+        buf.flush()
+    except Exception:
+        pass
+
+
+def record_search(term):
+    """Buffer one search of `term` for the current app."""
+    get_history_buffer().record(term)
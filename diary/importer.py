@@ -0,0 +1,287 @@
+"""Bulk import of diary entries (`flask import`).
+
+Sources:
+- an NDJSON file (one object per line with `title`, `content`, optional
+  `created_at` and `tags`), e.g. the output of `flask export`;
+- a directory of Markdown files, each with optional front matter::
+
+      ---
+      title: Trip notes
+      date: 2024-05-01 09:30
+      tags: [travel, work/projects]
+      ---
+      Body text...
+
+  Without a `title` the first `# heading` (or the file name) is used.
+
+Tags are given as slash-separated paths (`work/projects`). Each segment
+is resolved through an in-memory name -> id map loaded once from the
+tags table; missing segments are created under the previous one.
+
+Entries are written in batches: per batch one multi-row `INSERT` into
+`diary`, shared batched inserts for postings and `diary_tags`, one
+closure refresh and one counter upsert, all inside a single transaction.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from . import changelog, closure, counters, fulltext, tagpaths
+from .db import get_db
+from .excerpts import excerpt_length, make_excerpt
+from .versions import bump_version
+
+
+WRITE_BATCH = 500
+
+
+def _parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+
+
+def _split_tags(value):
+    """Normalize a tags value (list or comma-separated string) to paths."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    paths = []
+    for item in value:
+        path = '/'.join(seg.strip() for seg in str(item).split('/') if seg.strip())
+        if path:
+            paths.append(path)
+    return paths
+
+
+def read_ndjson(path):
+    """Yield entry dicts from an NDJSON file; blank lines are skipped."""
+    with open(path, 'r', encoding='utf-8') as fh:
+        for lineno, line in enumerate(fh, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError as exc:
+                raise click.ClickException(f'{path}:{lineno}: invalid JSON ({exc})')
+            yield {
+                'title': str(obj.get('title') or '').strip(),
+                'content': str(obj.get('content') or ''),
+                'created_at': _parse_datetime(obj.get('created_at')),
+                'tags': _split_tags(obj.get('tags')),
+            }
+
+
+def _unquote(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def parse_front_matter(text):
+    """Split Markdown `text` into `(meta, body)`.
+
+    Supports the simple `key: value` front matter most tools write,
+    including `tags: [a, b]`, `tags: a, b` and block lists (`- a`).
+    """
+    lines = text.splitlines()
+    if not lines or lines[0].strip() != '---':
+        return {}, text
+    meta = {}
+    key = None
+    for i, line in enumerate(lines[1:], 1):
+        if line.strip() in ('---', '...'):
+            return meta, '\n'.join(lines[i + 1:]).lstrip('\n')
+        stripped = line.strip()
+        if stripped.startswith('- ') and key is not None:
+            meta.setdefault(key, [])
+            if isinstance(meta[key], list):
+                meta[key].append(_unquote(stripped[2:]))
+            continue
+        if ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        key = key.strip().lower()
+        value = value.strip()
+        if value.startswith('[') and value.endswith(']'):
+            meta[key] = [_unquote(v) for v in value[1:-1].split(',') if v.strip()]
+        elif value:
+            meta[key] = _unquote(value)
+        else:
+            meta[key] = []
+    # No closing delimiter: not front matter after all
+    return {}, text
+
+
+def read_markdown_dir(directory):
+    """Yield entry dicts for every `*.md` file under `directory` (sorted)."""
+    paths = []
+    for root, _dirs, files in os.walk(directory):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(('.md', '.markdown')))
+    for path in sorted(paths):
+        with open(path, 'r', encoding='utf-8') as fh:
+            meta, body = parse_front_matter(fh.read())
+        title = meta.get('title') if isinstance(meta.get('title'), str) else ''
+        if not title:
+            first, _, rest = body.partition('\n')
+            if first.startswith('# '):
+                title, body = first[2:].strip(), rest.lstrip('\n')
+            else:
+                title = os.path.splitext(os.path.basename(path))[0]
+        yield {
+            'title': title.strip(),
+            'content': body.strip(),
+            'created_at': _parse_datetime(meta.get('created_at') or meta.get('date')),
+            'tags': _split_tags(meta.get('tags')),
+        }
+
+
+class TagResolver:
+    """Resolve tag paths to ids, creating missing tags on the way.
+
+    Tag names are unique (case-insensitively, per the table collation),
+    so an existing segment is reused wherever it already lives in the
+    tree; only new segments take the previous segment as parent.
+    """
+
+    def __init__(self, cur):
+        self.cur = cur
+        cur.execute('SELECT id, name FROM tags')
+        self.ids = {r['name'].casefold(): r['id'] for r in cur.fetchall()}
+        self.created = 0
+
+    def resolve(self, path):
+        parent_id = None
+        for name in path.split('/'):
+            tag_id = self.ids.get(name.casefold())
+            if tag_id is None:
+                self.cur.execute('INSERT INTO tags (name, parent_id) VALUES (%s, %s)', (name[:100], parent_id))
+                tag_id = self.cur.lastrowid
+                tagpaths.assign(self.cur, tag_id, parent_id)
+                self.ids[name.casefold()] = tag_id
+                self.created += 1
+            parent_id = tag_id
+        return parent_id
+
+
+def write_batch(conn, cur, resolver, batch):
+    """Insert one batch of entries with their tags in a single transaction.
+
+    Returns the number of entries written. Tags are resolved (and, if
+    needed, created) before the transaction so a failed batch never
+    leaves the resolver pointing at rolled-back tag ids.
+    """
+    tag_sets = [{resolver.resolve(p) for p in e['tags']} for e in batch]
+    now = datetime.now().replace(microsecond=0)
+    length = excerpt_length()
+
+    conn.begin()
+    try:
+        # Lock the top of the id range so the batch can use explicit,
+        # consecutive ids (a multi-row insert does not report them all)
+        cur.execute('SELECT COALESCE(MAX(id), 0) AS max_id FROM diary FOR UPDATE')
+        first_id = int(cur.fetchone()['max_id']) + 1
+        ids = list(range(first_id, first_id + len(batch)))
+
+        rows = []
+        for i, e in zip(ids, batch):
+            excerpt, truncated = make_excerpt(e['content'], length)
+            rows.append((i, e['title'][:255], e['content'], excerpt, truncated, e['created_at'] or now))
+        placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(rows))
+        cur.execute(
+            f'INSERT INTO diary (id, title, content, excerpt, excerpt_truncated, created_at) VALUES {placeholders}',
+            tuple(v for row in rows for v in row),
+        )
+        fulltext.index_new_entries(cur, ((i, e['title'], e['content']) for i, e in zip(ids, batch)))
+
+        pairs = [(i, t) for i, tags in zip(ids, tag_sets) for t in sorted(tags)]
+        for start in range(0, len(pairs), WRITE_BATCH):
+            chunk = pairs[start:start + WRITE_BATCH]
+            cur.execute(
+                f"INSERT INTO diary_tags (diary_id, tag_id) VALUES {', '.join(['(%s, %s)'] * len(chunk))}",
+                tuple(v for pair in chunk for v in pair),
+            )
+
+        deltas = {counters.GLOBAL: (len(batch), len(batch))}
+        if pairs:
+            closure.refresh_entries(cur, ids)
+            for _, tag_id in pairs:
+                d, r = deltas.get(tag_id, (0, 0))
+                deltas[tag_id] = (d + 1, r)
+            placeholders = ', '.join(['%s'] * len(ids))
+            cur.execute(
+                f'SELECT tag_id, COUNT(*) AS cnt FROM diary_tags_closure '
+                f'WHERE diary_id IN ({placeholders}) GROUP BY tag_id',
+                tuple(ids),
+            )
+            for r in cur.fetchall():
+                d, _ = deltas.get(r['tag_id'], (0, 0))
+                deltas[r['tag_id']] = (d, int(r['cnt']))
+        counters.adjust(cur, deltas)
+        # Too many entries to log one by one: in-memory indexes rebuild
+        changelog.record_reset(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(batch)
+
+
+def init_import(app):
+    """Register the `flask import` CLI command."""
+
+    @click.command('import')
+    @click.argument('source', type=click.Path(exists=True))
+    @click.option('--format', 'fmt', type=click.Choice(('auto', 'ndjson', 'markdown')), default='auto',
+                  show_default=True, help='`auto` picks markdown for directories, ndjson for files.')
+    @click.option('--batch-size', default=WRITE_BATCH, show_default=True, help='Entries per transaction.')
+    @with_appcontext
+    def import_command(source, fmt, batch_size):
+        """Import entries from an NDJSON file or a directory of Markdown files."""
+        if fmt == 'auto':
+            fmt = 'markdown' if os.path.isdir(source) else 'ndjson'
+        entries = read_markdown_dir(source) if fmt == 'markdown' else read_ndjson(source)
+
+        conn = get_db()
+        started = time.monotonic()
+        done = skipped = 0
+        try:
+            with conn.cursor() as cur:
+                resolver = TagResolver(cur)
+                batch = []
+                for entry in entries:
+                    if not entry['title']:
+                        skipped += 1
+                        continue
+                    batch.append(entry)
+                    if len(batch) >= batch_size:
+                        done += write_batch(conn, cur, resolver, batch)
+                        batch = []
+                        elapsed = time.monotonic() - started
+                        click.echo(f'Imported {done} entries ({done / max(elapsed, 1e-6):.0f}/s)...')
+                if batch:
+                    done += write_batch(conn, cur, resolver, batch)
+        finally:
+            # Committed batches (and created tags) must become visible even
+            # if a later batch failed
+            bump_version('tags', 'entries')
+        elapsed = time.monotonic() - started
+        click.echo(
+            f'Imported {done} entries in {elapsed:.1f}s ({done / max(elapsed, 1e-6):.0f}/s); '
+            f'created {resolver.created} tags, skipped {skipped} without a title.'
+        )
+
+    app.cli.add_command(import_command)
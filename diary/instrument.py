@@ -0,0 +1,134 @@
+"""Per-request SQL instrumentation.
+
+Connections are opened with `DictCursor` from this module (and
+`flask export` streams through `SSDictCursor` from here), which time
+every `execute()` and add it to the current request's `RequestStats`.
+At the end of each request:
+
+- a `Server-Timing` header reports the database time and query count
+  (`db`) next to the total time spent in the app (`app`), visible in the
+  browser's network panel;
+- requests slower than `SLOW_REQUEST_MS` are logged as one JSON object
+  with the query count, database time and the slowest statement;
+- statements executed `SQL_REPEAT_THRESHOLD` or more times with the
+  same text in one request are logged as a possible N+1 pattern.
+
+Queries outside a request (CLI commands, background flushes) are not
+recorded. Set `SQL_INSTRUMENTATION = False` to disable the hooks.
+"""
+
+import json
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from pymysql import cursors
+
+
+DEFAULT_SLOW_REQUEST_MS = 500
+DEFAULT_REPEAT_THRESHOLD = 5
+# Statement text kept in logs
+_SQL_PREVIEW = 300
+
+
+class RequestStats:
+    """Query count, database time and per-statement counts for one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.total = 0.0
+        self.slowest = (0.0, None)
+        self.statements = Counter()
+
+    def record(self, sql, duration):
+        self.count += 1
+        self.total += duration
+        self.statements[sql] += 1
+        if duration > self.slowest[0]:
+            self.slowest = (duration, sql)
+
+    def repeated(self, threshold):
+        """Statements executed at least `threshold` times, most frequent first."""
+        return [(sql, n) for sql, n in self.statements.most_common() if n >= threshold]
+
+
+def _preview(sql):
+    sql = ' '.join(str(sql).split())
+    return sql if len(sql) <= _SQL_PREVIEW else sql[:_SQL_PREVIEW] + '...'
+
+
+class TimedCursorMixin:
+    """Cursor mixin timing `execute()` into the current request's stats."""
+
+    def execute(self, query, args=None):
+        stats = g.get('sql_stats') if has_request_context() else None
+        if stats is None:
+            return super().execute(query, args)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            stats.record(query, time.perf_counter() - start)
+
+
+class DictCursor(TimedCursorMixin, cursors.DictCursor):
+    """`pymysql.cursors.DictCursor` that reports to the request stats."""
+
+
+class SSDictCursor(TimedCursorMixin, cursors.SSDictCursor):
+    """Unbuffered dict cursor that reports to the request stats.
+
+    Only the time until the first row is available is measured.
+    """
+
+
+def init_instrumentation(app):
+    """Register the request hooks that collect and report SQL timings."""
+    app.config.setdefault('SQL_INSTRUMENTATION', True)
+    app.config.setdefault('SERVER_TIMING', True)
+    app.config.setdefault('SLOW_REQUEST_MS', DEFAULT_SLOW_REQUEST_MS)
+    app.config.setdefault('SQL_REPEAT_THRESHOLD', DEFAULT_REPEAT_THRESHOLD)
+
+    @app.before_request
+    def start_sql_stats():
+        if app.config['SQL_INSTRUMENTATION']:
+            g.sql_stats = RequestStats()
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+        elapsed_ms = (time.perf_counter() - stats.started) * 1000
+        db_ms = stats.total * 1000
+
+        if app.config['SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={db_ms:.1f};desc="{stats.count} queries", app;dur={elapsed_ms:.1f}',
+            )
+
+        repeated = stats.repeated(int(app.config['SQL_REPEAT_THRESHOLD']))
+        if repeated:
+            app.logger.warning('possible N+1 %s', json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'repeated': [{'sql': _preview(sql), 'count': n} for sql, n in repeated],
+            }))
+
+        if elapsed_ms >= float(app.config['SLOW_REQUEST_MS']):
+            slowest_s, slowest_sql = stats.slowest
+            app.logger.warning('slow request %s', json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'duration_ms': round(elapsed_ms, 1),
+                'db_ms': round(db_ms, 1),
+                'queries': stats.count,
+                'slowest_ms': round(slowest_s * 1000, 1),
+                'slowest_sql': _preview(slowest_sql) if slowest_sql else None,
+            }))
+        return response
@@ -0,0 +1,372 @@
+"""Prometheus metrics aggregated across gunicorn workers.
+
+Each worker process records into its own append-only memory-mapped
+file under `METRICS_DIR` (default `instance/metrics/<pid>.db`), so the
+hot path is a dict lookup and an 8-byte write with no locking between
+processes. `/metrics` reads every file and sums them, so a scrape that
+lands on any one worker reports totals for all of them:
+
+- `diary_requests_total{endpoint,method,status}`
+- `diary_request_duration_seconds{endpoint}` (histogram)
+- `diary_request_errors_total{endpoint}` (5xx responses)
+- `diary_db_queries_total{endpoint}`, `diary_db_seconds_total{endpoint}`
+  (from the per-request SQL stats, see `diary/instrument.py`)
+- connection pool, search-result cache and search-history buffer
+  gauges, summed over live workers only.
+
+When a worker starts it folds the counters of exited workers into
+`archive.db` and removes their files, so totals survive worker restarts
+and the directory does not grow without bound.
+
+`/metrics` answers only direct requests from `METRICS_ALLOW_IPS`
+(loopback by default); requests relayed by the reverse proxy (they
+carry `X-Forwarded-For`) are refused. `deploy/nginx.conf` also denies
+the path.
+"""
+
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import abort, current_app, g, request
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'diary_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'diary_request_duration_seconds': ('histogram', 'Request latency in seconds, by endpoint.'),
+    'diary_request_errors_total': ('counter', 'Requests answered with a 5xx status, by endpoint.'),
+    'diary_db_queries_total': ('counter', 'SQL statements executed, by endpoint.'),
+    'diary_db_seconds_total': ('counter', 'Time spent in SQL statements, by endpoint.'),
+    'diary_db_pool_connections': ('gauge', 'Pooled connections by state (live workers).'),
+    'diary_db_pool_max_size': ('gauge', 'Configured pool cap summed over live workers.'),
+    'diary_db_pool_checkouts': ('gauge', 'Pool checkouts since worker start (live workers).'),
+    'diary_db_pool_timeouts': ('gauge', 'Pool acquire timeouts since worker start (live workers).'),
+    'diary_search_cache_entries': ('gauge', 'Cached search result pages (live workers).'),
+    'diary_search_cache_bytes': ('gauge', 'Approximate size of cached search results (live workers).'),
+    'diary_search_cache_hits': ('gauge', 'Search cache hits since worker start (live workers).'),
+    'diary_search_cache_misses': ('gauge', 'Search cache misses since worker start (live workers).'),
+    'diary_fragment_cache_entries': ('gauge', 'Cached entry fragments (live workers).'),
+    'diary_fragment_cache_bytes': ('gauge', 'Size of cached entry fragments (live workers).'),
+    'diary_fragment_cache_hits': ('gauge', 'Fragment cache hits since worker start (live workers).'),
+    'diary_fragment_cache_misses': ('gauge', 'Fragment cache misses since worker start (live workers).'),
+    'diary_search_history_pending': ('gauge', 'Buffered search-history terms not yet written.'),
+}
+
+_INITIAL_SIZE = 64 * 1024
+_HEADER = struct.Struct('<Q')
+_KEYLEN = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+# Gauges are refreshed at most this often per worker (seconds)
+_GAUGE_INTERVAL = 1.0
+
+
+def _parse(data):
+    """Yield `(key, value, value_offset)` from the bytes of a values file."""
+    used = _HEADER.unpack_from(data, 0)[0] if len(data) >= _HEADER.size else 0
+    pos = _HEADER.size
+    while pos < used:
+        (keylen,) = _KEYLEN.unpack_from(data, pos)
+        key = bytes(data[pos + _KEYLEN.size:pos + _KEYLEN.size + keylen]).decode('utf-8')
+        pos += (_KEYLEN.size + keylen + 7) // 8 * 8
+        yield key, _VALUE.unpack_from(data, pos)[0], pos
+        pos += _VALUE.size
+
+
+class ValueFile:
+    """Append-only `key -> float` map in a memory-mapped file.
+
+    Only the owning process writes; any process may read. An entry is
+    fully written before the `used` header is advanced past it, so
+    readers never see half an entry.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = os.fstat(self._fd).st_size
+        if size < _INITIAL_SIZE:
+            os.ftruncate(self._fd, _INITIAL_SIZE)
+            size = _INITIAL_SIZE
+        self._map = mmap.mmap(self._fd, size)
+        self._positions = {key: pos for key, _, pos in _parse(self._map)}
+        self._used = max(_HEADER.unpack_from(self._map, 0)[0], _HEADER.size)
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        entry = (_KEYLEN.size + len(encoded) + 7) // 8 * 8 + _VALUE.size
+        if self._used + entry > len(self._map):
+            size = len(self._map)
+            while self._used + entry > size:
+                size *= 2
+            os.ftruncate(self._fd, size)
+            self._map.close()
+            self._map = mmap.mmap(self._fd, size)
+        pos = self._used
+        _KEYLEN.pack_into(self._map, pos, len(encoded))
+        self._map[pos + _KEYLEN.size:pos + _KEYLEN.size + len(encoded)] = encoded
+        value_pos = pos + entry - _VALUE.size
+        _VALUE.pack_into(self._map, value_pos, 0.0)
+        self._used = pos + entry
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = value_pos
+        return value_pos
+
+    def add(self, key, amount):
+        pos = self._positions.get(key)
+        if pos is None:
+            pos = self._append(key)
+        _VALUE.pack_into(self._map, pos, _VALUE.unpack_from(self._map, pos)[0] + amount)
+
+    def set(self, key, value):
+        pos = self._positions.get(key)
+        if pos is None:
+            pos = self._append(key)
+        _VALUE.pack_into(self._map, pos, value)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def _key(kind, name, labels):
+    return json.dumps([kind, name, sorted(labels.items())], separators=(',', ':'))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return []
+    return [(key, value) for key, value, _ in _parse(data)]
+
+
+class MetricsStore:
+    """Per-process writer plus the cross-process reader for one directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self._gauges_at = 0.0
+
+    def _own(self):
+        # Opened lazily and per pid, so a store created before fork (e.g.
+        # gunicorn --preload) never has two processes writing one file.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._fold_dead()
+            self._file = ValueFile(os.path.join(self.directory, f'{self._pid}.db'))
+        return self._file
+
+    @contextlib.contextmanager
+    def _dir_lock(self, exclusive):
+        """Hold a `flock` on the directory's `.lock` file.
+
+        Folding dead files takes it exclusively; `collect()` shares it, so a
+        scrape never reads a file that is being folded into the archive
+        (which would count it twice, or not at all).
+        """
+        lock_fd = os.open(os.path.join(self.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(lock_fd)
+
+    def _fold_dead(self):
+        with self._dir_lock(exclusive=True):
+            archive = None
+            for name in os.listdir(self.directory):
+                stem, ext = os.path.splitext(name)
+                if ext != '.db' or not stem.isdigit() or int(stem) == self._pid or _pid_alive(int(stem)):
+                    continue
+                path = os.path.join(self.directory, name)
+                if archive is None:
+                    archive = ValueFile(os.path.join(self.directory, 'archive.db'))
+                for key, value in _read(path):
+                    if not key.startswith('["g"'):
+                        archive.add(key, value)
+                os.unlink(path)
+            if archive is not None:
+                archive.close()
+
+    def inc(self, name, labels, amount=1.0):
+        with self._lock:
+            self._own().add(_key('c', name, labels), amount)
+
+    def set_gauge(self, name, labels, value):
+        with self._lock:
+            self._own().set(_key('g', name, labels), value)
+
+    def observe(self, name, labels, seconds):
+        """Record one histogram observation (buckets stored non-cumulative)."""
+        le = BUCKETS[bisect.bisect_left(BUCKETS, seconds)] if seconds <= BUCKETS[-1] else '+Inf'
+        with self._lock:
+            f = self._own()
+            f.add(_key('c', name + '_bucket', dict(labels, le=str(le))), 1.0)
+            f.add(_key('c', name + '_sum', labels), seconds)
+            f.add(_key('c', name + '_count', labels), 1.0)
+
+    def collect(self):
+        """Return `{(name, labels_tuple): value}` summed over all files."""
+        totals = {}
+        with self._dir_lock(exclusive=False):
+            for fname in sorted(os.listdir(self.directory)):
+                stem, ext = os.path.splitext(fname)
+                if ext != '.db':
+                    continue
+                live = stem.isdigit() and _pid_alive(int(stem))
+                for key, value in _read(os.path.join(self.directory, fname)):
+                    kind, name, labels = json.loads(key)
+                    if kind == 'g' and not live:
+                        continue
+                    k = (name, tuple(tuple(pair) for pair in labels))
+                    totals[k] = totals.get(k, 0.0) + value
+        return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _bucket_order(le):
+    return float('inf') if le == '+Inf' else float(le)
+
+
+def render(totals):
+    """Render collected totals in the Prometheus text exposition format."""
+    lines = []
+    for name, (kind, help_text) in HELP.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind != 'histogram':
+            for (n, labels), value in sorted(totals.items()):
+                if n == name:
+                    lines.append(f'{name}{_labels(labels)} {value:g}')
+            continue
+        series = {}
+        for (n, labels), value in totals.items():
+            if n == name + '_bucket':
+                base = tuple(p for p in labels if p[0] != 'le')
+                le = dict(labels)['le']
+                series.setdefault(base, {})[le] = value
+        for base in sorted(series):
+            running = 0.0
+            buckets = series[base]
+            for le in [str(b) for b in BUCKETS] + ['+Inf']:
+                running += buckets.get(le, 0.0)
+                lines.append(f'{name}_bucket{_labels(base + (("le", le),))} {running:g}')
+            lines.append(f'{name}_sum{_labels(base)} {totals.get((name + "_sum", base), 0.0):g}')
+            lines.append(f'{name}_count{_labels(base)} {totals.get((name + "_count", base), 0.0):g}')
+    return '\n'.join(lines) + '\n'
+
+
+def _update_gauges(app, store):
+    pool = app.extensions.get('diary_pool')
+    if pool is not None:
+        stats = pool.stats()
+        store.set_gauge('diary_db_pool_connections', {'state': 'idle'}, stats['idle'])
+        store.set_gauge('diary_db_pool_connections', {'state': 'in_use'}, stats['in_use'])
+        store.set_gauge('diary_db_pool_max_size', {}, stats['max_size'])
+        store.set_gauge('diary_db_pool_checkouts', {}, stats['checkouts'])
+        store.set_gauge('diary_db_pool_timeouts', {}, stats['timeouts'])
+    cache = app.extensions.get('diary_search_cache')
+    if cache is not None:
+        stats = cache.stats()
+        store.set_gauge('diary_search_cache_entries', {}, stats['entries'])
+        store.set_gauge('diary_search_cache_bytes', {}, stats['bytes'])
+        store.set_gauge('diary_search_cache_hits', {}, stats['hits'])
+        store.set_gauge('diary_search_cache_misses', {}, stats['misses'])
+    fragments = app.extensions.get('diary_fragment_cache')
+    if fragments is not None:
+        stats = fragments.stats()
+        store.set_gauge('diary_fragment_cache_entries', {}, stats['entries'])
+        store.set_gauge('diary_fragment_cache_bytes', {}, stats['bytes'])
+        store.set_gauge('diary_fragment_cache_hits', {}, stats['hits'])
+        store.set_gauge('diary_fragment_cache_misses', {}, stats['misses'])
+    buf = app.extensions.get('diary_history_buffer')
+    if buf is not None:
+        store.set_gauge('diary_search_history_pending', {}, len(buf.pending()))
+
+
+def metrics_view():
+    """Serve the aggregated metrics to allowlisted, non-proxied clients."""
+    app = current_app._get_current_object()
+    allowed = set(app.config.get('METRICS_ALLOW_IPS', ()))
+    if request.remote_addr not in allowed or 'X-Forwarded-For' in request.headers:
+        abort(403)
+    store = app.extensions['diary_metrics']
+    _update_gauges(app, store)
+    return app.response_class(render(store.collect()), mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """Register request hooks and the `/metrics` endpoint."""
+    app.config.setdefault('METRICS_ENABLED', True)
+    app.config.setdefault('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+    app.config.setdefault('METRICS_ALLOW_IPS', ['127.0.0.1', '::1'])
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    store = MetricsStore(app.config['METRICS_DIR'])
+    app.extensions['diary_metrics'] = store
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get('metrics_started')
+        if started is None or request.endpoint == 'metrics':
+            return response
+        elapsed = time.perf_counter() - started
+        labels = {'endpoint': request.endpoint or 'none'}
+        store.inc('diary_requests_total', dict(labels, method=request.method, status=str(response.status_code)))
+        store.observe('diary_request_duration_seconds', labels, elapsed)
+        if response.status_code >= 500:
+            store.inc('diary_request_errors_total', labels)
+        stats = g.get('sql_stats')
+        if stats is not None and stats.count:
+            store.inc('diary_db_queries_total', labels, stats.count)
+            store.inc('diary_db_seconds_total', labels, stats.total)
+
+        now = time.monotonic()
+        if now - store._gauges_at >= _GAUGE_INTERVAL:
+            store._gauges_at = now
+            _update_gauges(app, store)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
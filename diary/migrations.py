@@ -0,0 +1,334 @@
+"""Versioned schema migrations (`flask migrate`).
+
+`instance/schema.sql` (and `schema-sqlite.sql`) describe the current
+schema for new databases, but `flask init-db` only runs `CREATE ... IF
+NOT EXISTS`, so databases created earlier never pick up new columns or
+indexes. Each change is therefore also listed in `MIGRATIONS` with a
+version number; applied versions are recorded in `schema_version`.
+
+Migrations check the catalogue before changing anything (a column or
+index that already exists is skipped), so they are safe to run on a
+database created from the current schema files, on one that was
+upgraded by hand, and again after an interrupted run. `flask init-db`
+applies them after creating the tables.
+
+On MySQL, DDL runs as online DDL (`ALGORITHM=INPLACE, LOCK=NONE`) so
+reads and writes continue while an index is built; if the server
+refuses that for a statement it is retried with the default algorithm.
+MySQL commits DDL implicitly, so each migration's version is recorded
+after its last step. On SQLite each migration runs in one transaction.
+
+Tables that are maintained on write (search postings, the tag closure,
+entry counters) start empty on an upgraded database; their migrations
+backfill them, only touching entries that have no rows yet, so an
+interrupted backfill resumes where it stopped.
+"""
+
+import click
+import pymysql
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .db import get_db, table_exists
+from .versions import bump_version
+from . import closure, counters, fulltext, tagpaths
+
+
+# MySQL error codes for "ALGORITHM/LOCK not supported for this operation"
+_ONLINE_DDL_UNSUPPORTED = (1845, 1846)
+_LOCK_NAME = 'diary_migrate'
+# Entries per statement when backfilling derived tables
+_BACKFILL_BATCH = 500
+
+_SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS `schema_version` (
+    `version` INT NOT NULL PRIMARY KEY,
+    `description` VARCHAR(255) NOT NULL,
+    `applied_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+
+def _sqlite():
+    return current_app.config.get('DB_BACKEND') == 'sqlite'
+
+
+def _column_exists(cur, table, column):
+    if _sqlite():
+        cur.execute(f'PRAGMA table_info(`{table}`)')
+        return any(r['name'] == column for r in cur.fetchall())
+    cur.execute(
+        'SELECT COUNT(*) AS cnt FROM information_schema.columns '
+        'WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s',
+        (table, column),
+    )
+    return cur.fetchone()['cnt'] > 0
+
+
+def _index_exists(cur, table, name):
+    if _sqlite():
+        cur.execute("SELECT COUNT(*) AS cnt FROM sqlite_master WHERE type = 'index' AND name = %s", (name,))
+    else:
+        cur.execute(
+            'SELECT COUNT(*) AS cnt FROM information_schema.statistics '
+            'WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s',
+            (table, name),
+        )
+    return cur.fetchone()['cnt'] > 0
+
+
+def _alter(cur, table, clauses):
+    """Run `ALTER TABLE table clauses` online where MySQL allows it."""
+    sql = f'ALTER TABLE `{table}` {clauses}'
+    try:
+        cur.execute(sql + ', ALGORITHM=INPLACE, LOCK=NONE')
+    except pymysql.err.MySQLError as exc:
+        if not exc.args or exc.args[0] not in _ONLINE_DDL_UNSUPPORTED:
+            raise
+        click.echo(f'  online DDL not available ({exc.args[1]}); retrying with a table lock')
+        cur.execute(sql)
+
+
+def _add_index(cur, table, name, columns):
+    if _index_exists(cur, table, name):
+        return
+    cols = ', '.join(f'`{c}`' for c in columns)
+    if _sqlite():
+        cur.execute(f'CREATE INDEX IF NOT EXISTS `{name}` ON `{table}` ({cols})')
+    else:
+        _alter(cur, table, f'ADD INDEX `{name}` ({cols})')
+
+
+def _excerpt_columns(cur):
+    # SQLite databases have always had these (see schema-sqlite.sql)
+    if _sqlite() or _column_exists(cur, 'diary', 'excerpt'):
+        return
+    _alter(cur, 'diary',
+           "ADD COLUMN `excerpt` VARCHAR(2000) NOT NULL DEFAULT '' AFTER `content`, "
+           "ADD COLUMN `excerpt_truncated` TINYINT(1) NOT NULL DEFAULT 0 AFTER `excerpt`")
+    click.echo('  excerpt columns added; run `flask rebuild-excerpts` to backfill them')
+
+
+def _updated_at_column(cur):
+    if not _sqlite() and not _column_exists(cur, 'diary', 'updated_at'):
+        _alter(cur, 'diary',
+               'ADD COLUMN `updated_at` TIMESTAMP(6) NOT NULL '
+               'DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)')
+    _add_index(cur, 'diary', 'idx_diary_updated_at', ['updated_at'])
+
+
+def _listing_indexes(cur):
+    # `ORDER BY created_at DESC, id DESC` and the keyset range on it
+    _add_index(cur, 'diary', 'idx_diary_created_at', ['created_at', 'id'])
+    # Tag filters and counts look up `diary_tags` by tag
+    _add_index(cur, 'diary_tags', 'idx_diary_tags_tag', ['tag_id', 'diary_id'])
+
+
+def _search_history_indexes(cur):
+    # `/search/history` sorts by count or by recency
+    _add_index(cur, 'search_history', 'idx_search_history_count', ['count', 'last_searched'])
+    _add_index(cur, 'search_history', 'idx_search_history_last', ['last_searched', 'count'])
+
+
+def _tag_paths(cur):
+    if not _column_exists(cur, 'tags', 'path'):
+        if _sqlite():
+            cur.execute("ALTER TABLE `tags` ADD COLUMN `path` VARCHAR(700) NOT NULL DEFAULT '' COLLATE NOCASE")
+            cur.execute('ALTER TABLE `tags` ADD COLUMN `depth` INT NOT NULL DEFAULT 0')
+        else:
+            _alter(cur, 'tags',
+                   "ADD COLUMN `path` VARCHAR(700) CHARACTER SET ascii COLLATE ascii_bin NOT NULL DEFAULT '', "
+                   'ADD COLUMN `depth` INT NOT NULL DEFAULT 0')
+    _add_index(cur, 'tags', 'idx_tags_path', ['path'])
+    detached = tagpaths.rebuild(cur)
+    if detached:
+        click.echo(f'  {detached} tag(s) in a parent cycle became roots; run `flask rebuild-closure`')
+
+
+def _entry_changes(cur):
+    if table_exists(cur, 'entry_changes'):
+        return
+    if _sqlite():
+        cur.execute(
+            'CREATE TABLE `entry_changes` (`seq` INTEGER PRIMARY KEY AUTOINCREMENT, '
+            '`diary_id` BIGINT NULL, `tag_id` BIGINT NULL)'
+        )
+    else:
+        cur.execute(
+            'CREATE TABLE `entry_changes` (`seq` BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+            '`diary_id` BIGINT NULL, `tag_id` BIGINT NULL) '
+            'ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci'
+        )
+
+
+def _postings_table(cur):
+    if table_exists(cur, 'diary_postings'):
+        return
+    if _sqlite():
+        cur.execute(
+            'CREATE TABLE `diary_postings` (`token` VARCHAR(64) NOT NULL COLLATE NOCASE, '
+            '`diary_id` BIGINT NOT NULL REFERENCES `diary` (`id`) ON DELETE CASCADE, '
+            '`weight` INT NOT NULL, PRIMARY KEY (`token`, `diary_id`)) WITHOUT ROWID'
+        )
+        cur.execute('CREATE INDEX IF NOT EXISTS `idx_diary_postings_diary` ON `diary_postings` (`diary_id`)')
+    else:
+        cur.execute(
+            'CREATE TABLE `diary_postings` ('
+            '`token` VARCHAR(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL, '
+            '`diary_id` BIGINT NOT NULL, `weight` INT NOT NULL, '
+            'PRIMARY KEY (`token`, `diary_id`), KEY `idx_diary_postings_diary` (`diary_id`), '
+            'CONSTRAINT `fk_diary_postings_diary` FOREIGN KEY (`diary_id`) REFERENCES `diary` (`id`) ON DELETE CASCADE'
+            ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci'
+        )
+
+
+def _counters_table(cur):
+    if table_exists(cur, 'entry_counters'):
+        return
+    ddl = (
+        'CREATE TABLE `entry_counters` (`tag_id` BIGINT NOT NULL PRIMARY KEY, '
+        '`direct_count` BIGINT NOT NULL DEFAULT 0, `rollup_count` BIGINT NOT NULL DEFAULT 0)'
+    )
+    if not _sqlite():
+        ddl += ' ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci'
+    cur.execute(ddl)
+
+
+def _backfill_postings(cur):
+    # Databases from before full-text search have no postings table
+    _postings_table(cur)
+    done = 0
+    last_id = 0
+    while True:
+        cur.execute(
+            'SELECT id, title, content FROM diary d WHERE id > %s AND NOT EXISTS '
+            '(SELECT 1 FROM diary_postings p WHERE p.diary_id = d.id) ORDER BY id LIMIT %s',
+            (last_id, _BACKFILL_BATCH),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            break
+        fulltext.index_new_entries(cur, [(r['id'], r['title'], r['content']) for r in rows])
+        done += len(rows)
+        last_id = rows[-1]['id']
+    if done:
+        click.echo(f'  indexed {done} entries for search')
+
+
+def _backfill_counters(cur):
+    _counters_table(cur)
+    # Rollup counts are read from the closure, so fill that first
+    cur.execute(
+        'SELECT DISTINCT dt.diary_id FROM diary_tags dt WHERE NOT EXISTS '
+        '(SELECT 1 FROM diary_tags_closure c WHERE c.diary_id = dt.diary_id)'
+    )
+    missing = [r['diary_id'] for r in cur.fetchall()]
+    closure.refresh_entries(cur, missing)
+    if missing:
+        click.echo(f'  derived tag closure rows for {len(missing)} entries')
+    _, fixes, stale = counters.drift(cur)
+    counters.repair(cur, fixes, stale)
+    if fixes or stale:
+        click.echo(f'  wrote {len(fixes) + len(stale)} entry counter rows')
+
+
+def _updated_at_trigger(cur):
+    # SQLite's stand-in for ON UPDATE fired on every UPDATE, including the
+    # excerpt backfill; limit it to edits of the entry itself
+    if not _sqlite():
+        return
+    cur.execute('DROP TRIGGER IF EXISTS `trg_diary_updated_at`')
+    cur.execute(
+        'CREATE TRIGGER `trg_diary_updated_at` AFTER UPDATE OF `title`, `content` ON `diary` '
+        'FOR EACH ROW WHEN NEW.updated_at = OLD.updated_at '
+        'BEGIN '
+        "UPDATE `diary` SET `updated_at` = strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') WHERE `id` = NEW.id; "
+        'END'
+    )
+
+
+# (version, description, function(cur)); append only, never renumber
+MIGRATIONS = [
+    (1, 'Add diary.excerpt and diary.excerpt_truncated', _excerpt_columns),
+    (2, 'Add diary.updated_at and its index', _updated_at_column),
+    (3, 'Index diary(created_at, id) and diary_tags(tag_id, diary_id)', _listing_indexes),
+    (4, 'Index search_history by count and last_searched', _search_history_indexes),
+    (5, 'Add tags.path and tags.depth (materialized paths)', _tag_paths),
+    (6, 'Add entry_changes (change log for in-memory indexes)', _entry_changes),
+    (7, 'Add and backfill diary_postings (search index)', _backfill_postings),
+    (8, 'Backfill diary_tags_closure, add and backfill entry_counters', _backfill_counters),
+    (9, 'Keep diary.updated_at on SQLite when only excerpts change', _updated_at_trigger),
+]
+
+
+def applied_versions(cur):
+    """Return the set of recorded migration versions (creating the table)."""
+    cur.execute(_SCHEMA_VERSION_DDL)
+    cur.execute('SELECT version FROM schema_version')
+    return {int(r['version']) for r in cur.fetchall()}
+
+
+def pending(cur):
+    """Return the migrations not yet recorded, in order."""
+    done = applied_versions(cur)
+    return [m for m in MIGRATIONS if m[0] not in done]
+
+
+def migrate(conn):
+    """Apply pending migrations in order; return the versions applied."""
+    sqlite = _sqlite()
+    applied = []
+    with conn.cursor() as cur:
+        if not sqlite:
+            # Serialize concurrent deploys (two workers starting at once)
+            cur.execute('SELECT GET_LOCK(%s, 30) AS got', (_LOCK_NAME,))
+            if not cur.fetchone()['got']:
+                raise click.ClickException('Another `flask migrate` is running.')
+        try:
+            for version, description, func in pending(cur):
+                click.echo(f'Applying {version}: {description}')
+                if sqlite:
+                    conn.begin()
+                try:
+                    func(cur)
+                    cur.execute(
+                        'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                        (version, description),
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied.append(version)
+        finally:
+            if not sqlite:
+                cur.execute('SELECT RELEASE_LOCK(%s)', (_LOCK_NAME,))
+            if applied:
+                # Backfills rewrite counters, closure rows and postings that
+                # workers cache by data version
+                bump_version('tags', 'entries')
+    return applied
+
+
+def init_migrations(app):
+    """Register the `flask migrate` CLI command."""
+
+    @click.command('migrate')
+    @click.option('--list', 'list_only', is_flag=True, help='Show pending migrations without applying them.')
+    @with_appcontext
+    def migrate_command(list_only):
+        """Apply pending schema migrations."""
+        conn = get_db()
+        with conn.cursor() as cur:
+            if not table_exists(cur, 'diary'):
+                raise click.ClickException('No schema found; run `flask init-db` first.')
+            todo = pending(cur)
+        if list_only:
+            for version, description, _ in todo:
+                click.echo(f'{version}: {description}')
+            click.echo(f'{len(todo)} pending migration(s).')
+            return
+        applied = migrate(conn)
+        click.echo(f'Applied {len(applied)} migration(s).' if applied else 'Schema is up to date.')
+
+    app.cli.add_command(migrate_command)
@@ -0,0 +1,61 @@
+"""Keyset (cursor) pagination helpers for the listing routes.
+
+Listings are ordered by `(created_at DESC, id DESC)`. Instead of
+`LIMIT .. OFFSET ..` (which scans and discards every row before the
+offset) the routes pass an opaque cursor naming the boundary row, so
+each page is a range scan of `per_page + 1` rows regardless of depth.
+
+Cursors are URL-safe base64 of a small JSON list:
+`[created_at_iso, id, direction, page_number]` where direction is
+`'n'` (rows after the boundary) or `'p'` (rows before it). They are not
+signed: tampering can only move the boundary, never widen access.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+
+def encode_cursor(created_at, entry_id, direction, page):
+    """Return an opaque token for the boundary row `(created_at, entry_id)`."""
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat(sep=' ')
+    raw = json.dumps([str(created_at), int(entry_id), direction, int(page)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a token from `encode_cursor`.
+
+    Returns `(created_at, id, direction, page)` or None when the token is
+    missing or malformed (callers then fall back to the first page).
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created_at, entry_id, direction, page = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        created_at = datetime.fromisoformat(created_at)
+        entry_id = int(entry_id)
+        page = max(1, int(page))
+    except (ValueError, TypeError):
+        return None
+    if direction not in ('n', 'p'):
+        return None
+    return created_at, entry_id, direction, page
+
+
+def keyset_clause(direction, alias='d'):
+    """Return `(where_sql, order_sql)` for paging past a boundary row.
+
+    The comparison is spelled out (instead of a row constructor) so MySQL
+    can use a range scan on `created_at`. Parameters are
+    `(created_at, created_at, id)`.
+    """
+    if direction == 'p':
+        where = f"({alias}.created_at > %s OR ({alias}.created_at = %s AND {alias}.id > %s))"
+        order = f"ORDER BY {alias}.created_at ASC, {alias}.id ASC"
+    else:
+        where = f"({alias}.created_at < %s OR ({alias}.created_at = %s AND {alias}.id < %s))"
+        order = f"ORDER BY {alias}.created_at DESC, {alias}.id DESC"
+    return where, order
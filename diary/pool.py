@@ -0,0 +1,250 @@
+"""A small thread-safe connection pool for the `diary` application.
+
+`get_db()` in `diary/db.py` checks connections out of a per-process
+`ConnectionPool` instead of opening a fresh MySQL connection for every
+request, and `close_db()` hands them back at teardown.
+
+The pool is deliberately driver-agnostic: it only needs a zero-argument
+`connect` callable returning objects with `ping()`, `rollback()` and
+`close()` (PyMySQL connections satisfy this).
+
+Fork safety: gunicorn may import the app in the master and then fork
+workers. Sockets inherited across a fork must never be shared, so the
+pool remembers the pid that created its connections and silently drops
+(without closing) anything it inherited in a child process.
+"""
+
+import os
+import threading
+import time
+import weakref
+from collections import deque
+
+
+class PoolTimeoutError(RuntimeError):
+    """Raised when no connection could be checked out within the timeout."""
+
+
+class _Entry:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+# Every live pool, so `os.register_at_fork` can reset them in children.
+_pools = weakref.WeakSet()
+
+
+class ConnectionPool:
+    """Bounded pool of reusable DB connections.
+
+    - `min_size`: connections opened eagerly on first use in a process
+    - `max_size`: hard cap on open connections (idle + checked out)
+    - `recycle`: idle seconds after which a connection is pinged before reuse
+    - `max_lifetime`: seconds after which a connection is closed and replaced
+    - `timeout`: seconds `acquire()` waits for a free slot before failing
+    - `reset_on_return`: roll back any open transaction when released
+    """
+
+    def __init__(self, connect, min_size=0, max_size=10, recycle=300,
+                 max_lifetime=3600, timeout=10.0, reset_on_return=True):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self._connect = connect
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max_size
+        self.recycle = recycle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.reset_on_return = reset_on_return
+
+        self._cond = threading.Condition(threading.Lock())
+        self._reset_state()
+        _pools.add(self)
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._prefilled = False
+        # Counters exposed through `stats()`
+        self._checkouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._timeouts = 0
+
+    def _check_pid(self):
+        """Forget connections inherited from a parent process."""
+        if self._pid != os.getpid():
+            # Do not close: the sockets still belong to the parent.
+            self._cond = threading.Condition(threading.Lock())
+            self._reset_state()
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._created += 1
+        return _Entry(conn)
+
+    def _discard(self, entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def _prefill(self):
+        with self._cond:
+            if self._prefilled:
+                return
+            self._prefilled = True
+            wanted = self.min_size - self._size
+            self._size += max(0, wanted)
+
+        for _ in range(max(0, wanted)):
+            try:
+                entry = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                continue
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def _healthy(self, entry):
+        """Return True when an idle connection may be handed out again."""
+        now = time.monotonic()
+        if self.max_lifetime and now - entry.created_at >= self.max_lifetime:
+            return False
+        if self.recycle is not None and now - entry.last_used >= self.recycle:
+            try:
+                entry.conn.ping(reconnect=False)
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        """Check out a connection, opening one if the pool is not full."""
+        self._check_pid()
+        if not self._prefilled:
+            self._prefill()
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            entry = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(
+                            f'Timed out after {self.timeout}s waiting for a database connection '
+                            f'(pool max_size={self.max_size}).'
+                        )
+                    self._cond.wait(remaining)
+
+            if create:
+                try:
+                    entry = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(entry):
+                self._discard(entry)
+                continue
+
+            with self._cond:
+                self._in_use[id(entry.conn)] = entry
+                self._checkouts += 1
+            return entry.conn
+
+    def release(self, conn, discard=False):
+        """Return a checked-out connection to the pool.
+
+        Connections that fail the reset, were closed by the caller, or
+        belong to a parent process are dropped instead of being reused.
+        """
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            # Not ours (or already released); just close it.
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+
+        if not discard and not getattr(conn, 'open', True):
+            discard = True
+        if not discard and self.reset_on_return:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard:
+            self._discard(entry)
+            return
+
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def close(self):
+        """Close every idle connection (e.g. on shutdown or config reload)."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._prefilled = False
+        for entry in idle:
+            try:
+                entry.conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        """Return a snapshot of pool counters (for diagnostics/metrics)."""
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'timeouts': self._timeouts,
+            }
+
+
+def _reset_pools_after_fork():
+    for pool in list(_pools):
+        pool._check_pid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
@@ -22,7 +22,8 @@ def init_routes(app):
             return
 
         # Default public endpoints
-        default_allow = {'auth.login', 'auth.register', 'static'}
+        # (`metrics` does its own IP allowlisting, see `diary/metrics.py`)
+        default_allow = {'auth.login', 'auth.register', 'static', 'metrics'}
 
         # Merge configured public endpoints
         allowlist = set(app.config.get('AUTH_PUBLIC_ENDPOINTS', [])) | default_allow
@@ -1,7 +1,6 @@
 from flask import Blueprint, render_template, request, session, redirect, url_for, flash
 from werkzeug.security import generate_password_hash, check_password_hash
-from diary.db import get_db
-from pymysql.err import IntegrityError
+from diary.db import IntegrityError, get_db
 from urllib.parse import urlparse, urljoin
 
 
@@ -1,10 +1,25 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, Response, abort, render_template, request, redirect, url_for, flash, session, stream_with_context
 from diary.db import get_db
+from diary.conditional import from_timestamp, make_etag, not_modified, with_validators
+from diary import changelog, closure, counters, fulltext, fuzzy
+from diary import export
+from diary.excerpts import make_excerpt
+from diary.fragments import invalidate_entry
+from diary import tagindex
+from diary.entry_tags import current_tag_ids, parse_tag_ids, set_entry_tags
+from diary.tagcache import get_catalogue
+from diary.versions import bump_version
 
 
 bp = Blueprint('diary', __name__, url_prefix='/diary')
 
 
+def _picked_tags(tag_ids):
+    """`[{'id', 'name'}]` of `tag_ids`, sorted by name, for the tag form."""
+    picked = set(tag_ids)
+    return [t for t in get_catalogue().names if t['id'] in picked]
+
+
 @bp.route('/new', methods=['GET', 'POST'])
 def new():
     """Create a new diary entry (requires authentication).
@@ -26,42 +41,46 @@ def new():
             flash('Title is required.', 'error')
             return render_template('diary/new.html', title=title, content=content)
 
+        tag_ids = parse_tag_ids(selected_tags, get_catalogue().name)
+        if len(tag_ids) < len(set(selected_tags)):
+            flash('Warning: could not save some tag associations.', 'warning')
+
+        # Entry, postings, associations, closure and counters commit together
         conn = get_db()
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO diary (title, content) VALUES (%s, %s)",
-                (title, content),
-            )
-            entry_id = cur.lastrowid
-
-        # Persist tag associations if any were selected
-        if selected_tags:
-            # Insert associations; ignore invalid values
-            try:
-                with conn.cursor() as cur:
-                    for tid in selected_tags:
-                        try:
-                            tag_id = int(tid)
-                        except (TypeError, ValueError):
-                            continue
-                        cur.execute(
-                            "INSERT INTO diary_tags (diary_id, tag_id) VALUES (%s, %s)",
-                            (entry_id, tag_id),
-                        )
-            except Exception:
-                # Non-fatal: flash but continue
-                flash('Warning: could not save some tag associations.', 'warning')
+        conn.begin()
+        try:
+            with conn.cursor() as cur:
+                excerpt, truncated = make_excerpt(content)
+                cur.execute(
+                    "INSERT INTO diary (title, content, excerpt, excerpt_truncated) VALUES (%s, %s, %s, %s)",
+                    (title, content, excerpt, truncated),
+                )
+                entry_id = cur.lastrowid
+                cur.execute('SELECT created_at FROM diary WHERE id = %s', (entry_id,))
+                created_at = cur.fetchone()['created_at']
+                fulltext.index_entry(cur, entry_id, title, content)
+                set_entry_tags(cur, entry_id, tag_ids, existing=set())
+                if tag_ids:
+                    closure.refresh_entries(cur, [entry_id])
+                    after = counters.tag_sets(cur, entry_id)
+                else:
+                    after = (set(), set())
+                counters.entry_changed(cur, (set(), set()), after, total_delta=1)
+                changelog.record(cur, [entry_id])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
+        # Entries and tag usage counts changed
+        bump_version('tags', 'entries')
+        tagindex.entry_saved(entry_id, created_at, tag_ids)
+        fuzzy.title_changed(entry_id, title)
         flash('Entry created.', 'success')
         return redirect(url_for('home.preview'))
 
-        # Load available tags for the form
-    conn = get_db()
-    with conn.cursor() as cur:
-        cur.execute('SELECT id, name FROM tags ORDER BY name')
-        tags = cur.fetchall()
-
-    return render_template('diary/new.html', tags=tags)
+    # Nothing is picked yet; tags are found through `tags.suggest_tags`
+    return render_template('diary/new.html', tags=[])
 
 
 @bp.route('/<int:id>/edit', methods=['GET', 'POST'])
@@ -87,51 +106,74 @@ def edit(id):
 
         if not title:
             flash('Title is required.', 'error')
-            # Re-fetch tags for rendering
             with conn.cursor() as cur:
-                cur.execute('SELECT id, name FROM tags ORDER BY name')
-                tags = cur.fetchall()
                 cur.execute('SELECT tag_id FROM diary_tags WHERE diary_id = %s', (id,))
                 existing = [r['tag_id'] for r in cur.fetchall()]
-            return render_template('diary/edit.html', entry=entry, tags=tags, existing_tag_ids=existing)
+            return render_template('diary/edit.html', entry=entry, tags=_picked_tags(existing), existing_tag_ids=existing)
 
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE diary SET title=%s, content=%s WHERE id=%s",
-                (title, content, id),
-            )
+        tag_ids = parse_tag_ids(selected_tags, get_catalogue().name)
 
-            # Update tag associations: remove existing and insert selected
-            cur.execute('DELETE FROM diary_tags WHERE diary_id = %s', (id,))
-            if selected_tags:
-                for tid in selected_tags:
-                    try:
-                        tag_id = int(tid)
-                    except (TypeError, ValueError):
-                        continue
-                    cur.execute(
-                        "INSERT INTO diary_tags (diary_id, tag_id) VALUES (%s, %s)",
-                        (id, tag_id),
-                    )
+        # Only the difference to the stored tags is written, in one transaction
+        conn.begin()
+        try:
+            with conn.cursor() as cur:
+                excerpt, truncated = make_excerpt(content)
+                cur.execute(
+                    "UPDATE diary SET title=%s, content=%s, excerpt=%s, excerpt_truncated=%s, "
+                    "updated_at=CURRENT_TIMESTAMP(6) WHERE id=%s",
+                    (title, content, excerpt, truncated, id),
+                )
+                fulltext.index_entry(cur, id, title, content)
+                existing = current_tag_ids(cur, id)
+                tags_changed = tag_ids != existing
+                if tags_changed:
+                    before = counters.tag_sets(cur, id)
+                    set_entry_tags(cur, id, tag_ids, existing=existing)
+                    closure.refresh_entries(cur, [id])
+                    counters.entry_changed(cur, before, counters.tag_sets(cur, id))
+                changelog.record(cur, [id])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
+        if tags_changed:
+            bump_version('tags', 'entries')
+        else:
+            bump_version('entries')
+        tagindex.entry_saved(id, None, tag_ids)
+        fuzzy.title_changed(id, title)
+        invalidate_entry(id)
         flash('Entry updated.', 'success')
         return redirect(url_for('home.preview'))
 
-    # Load tags and existing tag ids for the form
+    # Only the entry's own tags are rendered; others come from `tags.suggest_tags`
     with conn.cursor() as cur:
-        cur.execute('SELECT id, name FROM tags ORDER BY name')
-        tags = cur.fetchall()
         cur.execute('SELECT tag_id FROM diary_tags WHERE diary_id = %s', (id,))
         existing = [r['tag_id'] for r in cur.fetchall()]
 
-    return render_template('diary/edit.html', entry=entry, tags=tags, existing_tag_ids=existing)
+    return render_template('diary/edit.html', entry=entry, tags=_picked_tags(existing), existing_tag_ids=existing)
 
 
 @bp.route('/<int:id>')
 def detail(id):
-    """Show a single diary entry."""
+    """Show a single diary entry.
+
+    `updated_at` is checked first so an unchanged entry is answered with
+    304 before its body is read (see `diary/conditional.py`).
+    """
     conn = get_db()
     with conn.cursor() as cur:
+        cur.execute("SELECT UNIX_TIMESTAMP(updated_at) AS updated_ts FROM diary WHERE id=%s", (id,))
+        stamp = cur.fetchone()
+        etag = last_modified = None
+        if stamp is not None:
+            etag = make_etag('diary.detail', id, str(stamp['updated_ts']))
+            last_modified = from_timestamp(stamp['updated_ts'])
+            cached = not_modified(etag, last_modified)
+            if cached is not None:
+                return cached
+
         cur.execute("SELECT id, title, content, created_at FROM diary WHERE id=%s", (id,))
         entry = cur.fetchone()
 
@@ -139,7 +181,25 @@ def detail(id):
         flash('Entry not found.', 'error')
         return redirect(url_for('diary.index'))
 
-    return render_template('diary/detail.html', entry=entry)
+    return with_validators(render_template('diary/detail.html', entry=entry), etag, last_modified)
+
+
+@bp.route('/<int:id>/content')
+def content_fragment(id):
+    """Return the full body of an entry as an HTML fragment.
+
+    Used by the "Show more" links on `home.preview`, which only renders
+    the stored excerpt.
+    """
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, content FROM diary WHERE id=%s", (id,))
+        entry = cur.fetchone()
+
+    if entry is None:
+        abort(404)
+
+    return render_template('diary/_content.html', entry=entry)
 
 
 @bp.route('/<int:id>/delete', methods=['POST'])
@@ -148,13 +208,57 @@ def delete(id):
     if session.get('user_id') is None:
         return redirect(url_for('auth.login', next=request.path))
 
+    # Associations, closure rows, postings and counters go together
     conn = get_db()
-    with conn.cursor() as cur:
-        # Remove tag associations first
-        cur.execute('DELETE FROM diary_tags WHERE diary_id = %s', (id,))
-        # Delete the diary entry
-        cur.execute('DELETE FROM diary WHERE id = %s', (id,))
-        # Optionally check affected rows: not required
+    conn.begin()
+    try:
+        with conn.cursor() as cur:
+            before = counters.tag_sets(cur, id)
+            # Remove tag associations first
+            cur.execute('DELETE FROM diary_tags WHERE diary_id = %s', (id,))
+            closure.remove_entry(cur, id)
+            fulltext.remove_entry(cur, id)
+            # Delete the diary entry
+            cur.execute('DELETE FROM diary WHERE id = %s', (id,))
+            if cur.rowcount:
+                counters.entry_changed(cur, before, (set(), set()), total_delta=-1)
+            changelog.record(cur, [id])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
+    bump_version('tags', 'entries')
+    tagindex.entry_deleted(id)
+    fuzzy.title_changed(id, None)
+    invalidate_entry(id)
     flash('Entry deleted.', 'success')
-    return redirect(url_for('home.preview'))
\ No newline at end of file
+    return redirect(url_for('home.preview'))
+
+
+@bp.route('/export')
+def export_entries():
+    """Stream every entry with its tags as NDJSON (default) or CSV.
+
+    Query parameters: `format` (`ndjson` or `csv`) and `since` (ISO date
+    or datetime) for incremental exports. Requires login.
+    """
+    if session.get('user_id') is None:
+        return redirect(url_for('auth.login', next=request.path))
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        abort(400)
+    try:
+        since = export.parse_since(request.args.get('since'))
+    except ValueError:
+        abort(400)
+
+    lines = export.render(export.iter_entries(get_db(), since), fmt)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = f'diary-export.{fmt}'
+    return Response(
+        stream_with_context(lines),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
@@ -1,198 +1,288 @@
-from flask import Blueprint, render_template, request
+from flask import Blueprint, current_app, render_template, request, url_for
 from diary.db import get_db
+from diary.conditional import not_modified, version_etag, with_validators
+from diary.pagination import decode_cursor, encode_cursor, keyset_clause
+from diary.counters import entry_count
+from diary.tagcache import attach_tag_names, get_catalogue
+from diary.tagindex import facet_counts, get_tag_index, select
 
 bp = Blueprint('home', __name__)
 
 
+def _resolve_tag_id(value, allow_id=False):
+    """Return the id of the tag named `value` (or with id `value` when
+    `allow_id` and it is numeric), or None if no such tag exists."""
+    catalogue = get_catalogue()
+    if allow_id and value.isdigit():
+        return int(value) if int(value) in catalogue.name else None
+    return catalogue.by_name.get(value)
+
+
+def _list_entries(cur, columns, tag_id, per_page, cursor=None, offset=None, selection=None, tag_filter=None):
+    """Fetch one page of entries, newest first.
+
+    With `cursor` (a decoded keyset cursor) the page is the `per_page` rows
+    after/before the boundary row; otherwise `offset` is used (legacy
+    `?page=N` links). Returns `(entries, has_more)` where `has_more` says
+    whether further rows exist in the direction of travel.
+
+    With a tag-index `selection` (see `diary/tagindex.py`) the page's ids
+    come from memory and only those rows are read. `tag_filter` is a
+    `(clauses, params)` pair from `_tag_filter_sql()`.
+    """
+    if selection is not None:
+        ids, has_more = selection.page(per_page, cursor=cursor, offset=offset or 0)
+        if not ids:
+            return [], has_more
+        placeholders = ', '.join(['%s'] * len(ids))
+        cur.execute(f"SELECT {columns} FROM diary d WHERE d.id IN ({placeholders})", tuple(ids))
+        rows = {r['id']: r for r in cur.fetchall()}
+        entries = [rows[i] for i in ids if i in rows]
+        return attach_tag_names(cur, entries), has_more
+
+    where = []
+    params = []
+    if tag_id is not None:
+        where.append('EXISTS (SELECT 1 FROM diary_tags dt2 WHERE dt2.diary_id = d.id AND dt2.tag_id = %s)')
+        params.append(tag_id)
+    if tag_filter is not None:
+        where.extend(tag_filter[0])
+        params.extend(tag_filter[1])
+
+    direction = 'n'
+    if cursor is not None:
+        created_at, entry_id, direction, _ = cursor
+        clause, order_sql = keyset_clause(direction)
+        where.append(clause)
+        params.extend([created_at, created_at, entry_id])
+    else:
+        _, order_sql = keyset_clause('n')
+
+    where_sql = ('WHERE ' + ' AND '.join(where)) if where else ''
+    limit_sql = 'LIMIT %s'
+    params.append(per_page + 1)
+    if cursor is None and offset:
+        limit_sql += ' OFFSET %s'
+        params.append(offset)
+
+    cur.execute(f"SELECT {columns} FROM diary d {where_sql} {order_sql} {limit_sql}", tuple(params))
+    entries = list(cur.fetchall())
+
+    has_more = len(entries) > per_page
+    entries = entries[:per_page]
+    if direction == 'p':
+        entries.reverse()
+    return attach_tag_names(cur, entries), has_more
+
+
+def _paginate(cur, columns, tag_id, per_page, selection=None, tag_filter=None):
+    """Shared pagination logic for `preview` and `title`.
+
+    Returns a dict of template variables. `?cursor=` selects keyset mode
+    (the default); an explicit `?page=N` keeps the old offset behaviour.
+    """
+    cursor = decode_cursor(request.args.get('cursor'))
+    page_arg = request.args.get('page')
+
+    if selection is not None:
+        total = selection.count
+    elif tag_filter is not None:
+        cur.execute(f"SELECT COUNT(*) AS cnt FROM diary d WHERE {' AND '.join(tag_filter[0])}", tuple(tag_filter[1]))
+        total = int(cur.fetchone()['cnt'])
+    else:
+        # Maintained counter (see `diary/counters.py`): a primary-key lookup
+        total = entry_count(cur, tag_id)
+    total_pages = max(1, (total + per_page - 1) // per_page)
+
+    if cursor is None and page_arg is not None:
+        try:
+            page = int(page_arg)
+        except ValueError:
+            page = 1
+        page = min(max(page, 1), total_pages)
+        entries, has_more = _list_entries(cur, columns, tag_id, per_page, offset=(page - 1) * per_page,
+                                       selection=selection, tag_filter=tag_filter)
+        has_next, has_prev = has_more, page > 1
+    else:
+        page = cursor[3] if cursor else 1
+        entries, has_more = _list_entries(cur, columns, tag_id, per_page, cursor=cursor,
+                                          selection=selection, tag_filter=tag_filter)
+        if cursor is not None and cursor[2] == 'p':
+            has_next, has_prev = True, has_more
+        else:
+            has_next, has_prev = has_more, cursor is not None
+        # Entries may be added while paging; never show "Page 7 of 6".
+        total_pages = max(total_pages, page + (1 if has_next else 0))
+
+    next_cursor = prev_cursor = None
+    if entries and has_next:
+        last = entries[-1]
+        next_cursor = encode_cursor(last['created_at'], last['id'], 'n', page + 1)
+    if entries and has_prev:
+        first = entries[0]
+        prev_cursor = encode_cursor(first['created_at'], first['id'], 'p', max(1, page - 1))
+
+    return {
+        'entries': entries,
+        'page': page,
+        'total_pages': total_pages,
+        'per_page': per_page,
+        'total': total,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    }
+
+
+def _filter_args():
+    """Tag filters from the query string (see `diary/tagindex.py`).
+
+    `?tag=` (repeatable) must all match, at least one `?any=` must match,
+    no `?exclude=` may match; `?deep=1` lets each tag match its
+    descendants. Returns the arguments to repeat in links (empty when
+    unfiltered).
+    """
+    args = {}
+    for key in ('tag', 'any', 'exclude'):
+        values = [v for v in request.args.getlist(key) if v]
+        if values:
+            args[key] = values
+    if args and request.args.get('deep') == '1':
+        args['deep'] = '1'
+    return args
+
+
+def _tag_filter_sql(all_of, any_of, none_of):
+    """`(clauses, params)` on `diary d` for the groups of `tagindex.select()`."""
+    clauses = []
+    params = []
+
+    def exists(ids):
+        ids = sorted(ids)
+        params.extend(ids)
+        placeholders = ', '.join(['%s'] * len(ids))
+        return f'EXISTS (SELECT 1 FROM diary_tags dt2 WHERE dt2.diary_id = d.id AND dt2.tag_id IN ({placeholders}))'
+
+    for ids in all_of:
+        clauses.append(exists(ids))
+    if any_of:
+        clauses.append(exists(set().union(*any_of)))
+    for ids in none_of:
+        clauses.append('NOT ' + exists(ids))
+    return clauses, params
+
+
+def _listing(cur, columns, filters, per_page, allow_id=False):
+    """Template variables for one listing page under `filters`.
+
+    Uses the in-memory tag index when enabled; otherwise the same filters
+    are applied through SQL (`EXISTS` per tag group) and no facets are
+    shown. Unfiltered pages take the SQL keyset path (an index range
+    scan) and show no facets, so they never wait for the index.
+    """
+    empty = {'entries': [], 'page': 1, 'total_pages': 1, 'per_page': per_page, 'total': 0,
+             'next_cursor': None, 'prev_cursor': None, 'facets': []}
+    if not filters:
+        return dict(_paginate(cur, columns, None, per_page), facets=[])
+
+    catalogue = get_catalogue()
+    deep = filters.get('deep') == '1'
+
+    def resolve(values):
+        groups = []
+        for value in values:
+            tag_id = _resolve_tag_id(value, allow_id=allow_id)
+            if tag_id is None:
+                groups.append(None)
+            else:
+                groups.append(set(catalogue.descendants(tag_id)) | {tag_id} if deep else {tag_id})
+        return groups
+
+    all_of = resolve(filters.get('tag', []))
+    if None in all_of:
+        return empty
+    any_of = [g for g in resolve(filters.get('any', [])) if g is not None]
+    if filters.get('any') and not any_of:
+        return empty
+    none_of = [g for g in resolve(filters.get('exclude', [])) if g is not None]
+
+    index = get_tag_index()
+    if index is None:
+        if len(all_of) == 1 and len(all_of[0]) == 1 and not any_of and not none_of:
+            # One plain `?tag=`: the maintained counter gives the total
+            tag_id, = all_of[0]
+            return dict(_paginate(cur, columns, tag_id, per_page), facets=[])
+        tag_filter = _tag_filter_sql(all_of, any_of, none_of)
+        if not tag_filter[0]:
+            return dict(_paginate(cur, columns, None, per_page), facets=[])
+        return dict(_paginate(cur, columns, None, per_page, tag_filter=tag_filter), facets=[])
+
+    selection = select(index, all_of, any_of, none_of)
+    ctx = _paginate(cur, columns, None, per_page, selection=selection)
+
+    # Facets: how many of the selected entries carry each other tag
+    chosen = set().union(*all_of, *any_of, *none_of)
+    counts = facet_counts(selection, [t for t in catalogue.name if t not in chosen])
+    top = sorted(counts.items(), key=lambda kv: (-kv[1], catalogue.name[kv[0]]))
+    facets = []
+    for tag_id, n in top[:int(current_app.config.get('TAG_FACETS_LIMIT', 20))]:
+        name = catalogue.name[tag_id]
+        facets.append({
+            'id': tag_id,
+            'name': name,
+            'count': n,
+            'url': url_for(request.endpoint, **dict(filters, tag=filters.get('tag', []) + [name])),
+        })
+    ctx['facets'] = facets
+    return ctx
+
+
 @bp.route('/preview')
 def preview():
-    """Show recent diary entries. If `?tag=<name>` is provided, filter by tag.
+    """Show recent diary entries, optionally filtered by tags.
 
     Each returned row includes an optional `tags` column containing a
-    comma-separated list of tag names (or None).
+    comma-separated list of tag names (or None). Only the stored excerpt
+    is read (see `diary/excerpts.py`); the full body loads on demand.
+    Pages are addressed by an opaque `?cursor=` token (see
+    `diary/pagination.py`). Tag filters (`?tag=<name>`, `?any=`,
+    `?exclude=`, `?deep=1`) and the facet counts come from the in-memory
+    tag index (see `_filter_args()` and `diary/tagindex.py`).
     """
-    tag = request.args.get('tag')
-    try:
-        page = int(request.args.get('page', '1'))
-    except ValueError:
-        page = 1
-    if page < 1:
-        page = 1
+    filters = _filter_args()
     per_page = 10
-    offset = (page - 1) * per_page
+
+    etag = version_etag('tags', 'entries')
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
 
     conn = get_db()
     with conn.cursor() as cur:
-        if tag:
-            # Count matching entries for pagination (use DISTINCT to avoid duplicate rows)
-            cur.execute(
-                """
-                SELECT COUNT(DISTINCT d.id) AS cnt
-                FROM diary d
-                JOIN diary_tags dt2 ON dt2.diary_id = d.id
-                JOIN tags t2 ON t2.id = dt2.tag_id
-                WHERE t2.name = %s
-                """,
-                (tag,)
-            )
-            total = cur.fetchone()['cnt']
-
-            # Select paginated entries that have the selected tag, but include all tags in GROUP_CONCAT
-            cur.execute(
-                """
-                SELECT d.id, d.title, d.content, d.created_at,
-                       GROUP_CONCAT(t.name SEPARATOR ',') AS tags
-                FROM diary d
-                LEFT JOIN diary_tags dt ON dt.diary_id = d.id
-                LEFT JOIN tags t ON t.id = dt.tag_id
-                WHERE EXISTS (
-                  SELECT 1 FROM diary_tags dt2
-                  JOIN tags t2 ON t2.id = dt2.tag_id
-                  WHERE dt2.diary_id = d.id AND t2.name = %s
-                )
-                GROUP BY d.id
-                ORDER BY d.created_at DESC
-                LIMIT %s OFFSET %s
-                """,
-                (tag, per_page, offset),
-            )
-        else:
-            cur.execute('SELECT COUNT(*) AS cnt FROM diary')
-            total = cur.fetchone()['cnt']
-
-            cur.execute(
-                """
-                SELECT d.id, d.title, d.content, d.created_at,
-                       GROUP_CONCAT(t.name SEPARATOR ',') AS tags
-                FROM diary d
-                LEFT JOIN diary_tags dt ON dt.diary_id = d.id
-                LEFT JOIN tags t ON t.id = dt.tag_id
-                GROUP BY d.id
-                ORDER BY d.created_at DESC
-                LIMIT %s OFFSET %s
-                """,
-                (per_page, offset),
-            )
-        entries = cur.fetchall()
-
-    total_pages = max(1, (int(total) + per_page - 1) // per_page)
-    if page > total_pages:
-        page = total_pages
-
-    return render_template('home/preview.html', entries=entries, tag=tag, page=page, total_pages=total_pages, per_page=per_page, total=total)
+        ctx = _listing(cur, 'd.id, d.title, d.excerpt, d.excerpt_truncated, d.created_at, d.updated_at', filters, per_page)
+
+    return with_validators(render_template('home/preview.html', filters=filters, **ctx), etag)
 
 
 @bp.route('/title')
 def title():
-    selected_tag = request.args.get('tag')
-    # Pagination
-    try:
-        page = int(request.args.get('page', '1'))
-    except ValueError:
-        page = 1
-    if page < 1:
-        page = 1
+    filters = _filter_args()
     per_page = 20
-    offset = (page - 1) * per_page
+
+    etag = version_etag('tags', 'entries')
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
     conn = get_db()
     with conn.cursor() as cur:
-        if selected_tag:
-            # Count matching entries for pagination using direct diary_tags join
-            if selected_tag.isdigit():
-                cur.execute(
-                    """
-                    SELECT COUNT(DISTINCT d.id) AS cnt
-                    FROM diary d
-                    JOIN diary_tags dt2 ON dt2.diary_id = d.id
-                    JOIN tags t2 ON t2.id = dt2.tag_id
-                    WHERE t2.id = %s
-                    """,
-                    (int(selected_tag),)
-                )
-                total = cur.fetchone()['cnt']
-
-                cur.execute(
-                    """
-                    SELECT d.id, d.title, GROUP_CONCAT(t.name SEPARATOR ',') AS tags
-                    FROM diary d
-                    LEFT JOIN diary_tags dt ON dt.diary_id = d.id
-                    LEFT JOIN tags t ON t.id = dt.tag_id
-                    WHERE EXISTS (
-                      SELECT 1 FROM diary_tags dt2
-                      JOIN tags t2 ON t2.id = dt2.tag_id
-                      WHERE dt2.diary_id = d.id AND t2.id = %s
-                    )
-                    GROUP BY d.id
-                    ORDER BY d.created_at DESC
-                    LIMIT %s OFFSET %s
-                    """,
-                    (int(selected_tag), per_page, offset)
-                )
-            else:
-                cur.execute(
-                    """
-                    SELECT COUNT(DISTINCT d.id) AS cnt
-                    FROM diary d
-                    JOIN diary_tags dt2 ON dt2.diary_id = d.id
-                    JOIN tags t2 ON t2.id = dt2.tag_id
-                    WHERE t2.name = %s
-                    """,
-                    (selected_tag,)
-                )
-                total = cur.fetchone()['cnt']
-
-                cur.execute(
-                    """
-                    SELECT d.id, d.title, GROUP_CONCAT(t.name SEPARATOR ',') AS tags
-                    FROM diary d
-                    LEFT JOIN diary_tags dt ON dt.diary_id = d.id
-                    LEFT JOIN tags t ON t.id = dt.tag_id
-                    WHERE EXISTS (
-                      SELECT 1 FROM diary_tags dt2
-                      JOIN tags t2 ON t2.id = dt2.tag_id
-                      WHERE dt2.diary_id = d.id AND t2.name = %s
-                    )
-                    GROUP BY d.id
-                    ORDER BY d.created_at DESC
-                    LIMIT %s OFFSET %s
-                    """,
-                    (selected_tag, per_page, offset)
-                )
-        else:
-            # Count total entries for pagination
-            cur.execute('SELECT COUNT(*) AS cnt FROM diary')
-            total = cur.fetchone()['cnt']
-
-            cur.execute(
-                """
-                SELECT d.id, d.title, GROUP_CONCAT(t.name SEPARATOR ',') AS tags
-                FROM diary d
-                LEFT JOIN diary_tags dt ON dt.diary_id = d.id
-                LEFT JOIN tags t ON t.id = dt.tag_id
-                GROUP BY d.id
-                ORDER BY d.created_at DESC
-                LIMIT %s OFFSET %s
-                """,
-                (per_page, offset)
-            )
-        entries = cur.fetchall()
-
-        # Fetch all tags for the filter select
-        cur.execute('SELECT id, name FROM tags ORDER BY name')
-        all_tags = cur.fetchall()
-
-    # Compute pagination values
-    total_pages = max(1, (int(total) + per_page - 1) // per_page)
-    if page > total_pages:
-        page = total_pages
-
-    return render_template(
+        ctx = _listing(cur, 'd.id, d.title, d.created_at, d.updated_at', filters, per_page, allow_id=True)
+
+    # All tags for the filter select
+    all_tags = get_catalogue().names
+
+    return with_validators(render_template(
         'home/title.html',
-        entries=entries,
         tags=all_tags,
-        selected_tag=selected_tag,
-        page=page,
-        total_pages=total_pages,
-        per_page=per_page,
-        total=total,
-    )
\ No newline at end of file
+        filters=filters,
+        **ctx,
+    ), etag)
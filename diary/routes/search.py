@@ -1,18 +1,211 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from diary.db import get_db
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app, jsonify
+from collections import OrderedDict
+import threading
+import time
+from diary.db import get_db, table_exists
+from diary.fulltext import match_sql
+from diary.snippets import highlight, render_snippet, snippet_columns
+from diary.tagcache import attach_tag_names, get_catalogue
+from diary.versions import data_version
+from diary.history_buffer import get_history_buffer, record_search
+from diary import fuzzy, suggest
 
 bp = Blueprint('search', __name__, url_prefix='/search')
 
+_cache_lock = threading.Lock()
+
+
+def _matching_tag_ids(keywords, include_descendants=False):
+    """Map each keyword to the ids of tags whose name contains it.
+
+    Matched case-insensitively, like `LIKE`, against the cached tag
+    catalogue, so no query is run per keyword. With `include_descendants`
+    the ids of all descendant tags are added too (used when
+    `diary_tags_closure` is unavailable), by prefix on the materialized
+    tag paths (see `diary/tagpaths.py`).
+    """
+    catalogue = get_catalogue()
+    names = [(t['id'], t['name'].casefold()) for t in catalogue.names]
+    out = {}
+    for kw in keywords:
+        needle = kw.casefold()
+        ids = {tag_id for tag_id, name in names if needle in name}
+        if include_descendants and ids:
+            prefixes = tuple(catalogue.paths[t] for t in ids if catalogue.paths.get(t))
+            ids.update(t for t, p in catalogue.paths.items() if p and p.startswith(prefixes))
+        out[kw] = sorted(ids)
+    return out
+
+
+def _capabilities():
+    """Return schema capabilities, detected once per process.
+
+    Currently only whether `diary_tags_closure` exists. The probe used to
+    hit the schema catalogue on every search.
+    """
+    app = current_app._get_current_object()
+    caps = app.extensions.get('diary_search_capabilities')
+    if caps is None:
+        conn = get_db()
+        with conn.cursor() as cur:
+            caps = {'closure': table_exists(cur, 'diary_tags_closure')}
+        app.extensions['diary_search_capabilities'] = caps
+    return caps
+
+
+class ResultCache:
+    """LRU + TTL cache of rendered search result pages.
+
+    Keys are `(normalized keyword set, page)`. Each value remembers the
+    `tags`/`entries` data versions it was computed from and is dropped as
+    soon as either moves, so any diary or tag write (in any worker)
+    invalidates it. Memory is capped by an estimate of the cached text
+    size as well as by entry count.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=8 * 1024 * 1024, ttl=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(results):
+        size = 256
+        for e in results:
+            size += 200 + len(e.get('title') or '') + len(e.get('tags') or '') + 2 * len(e.get('snippet') or '')
+        return size
+
+    def _drop(self, key):
+        _, _, _, size = self._items.pop(key)
+        self._bytes -= size
+
+    def get(self, key, versions):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, item_versions, stored_at, _ = item
+                if item_versions == versions and now - stored_at < self.ttl:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, versions, value):
+        size = self._size(value[0])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = (value, versions, time.monotonic(), size)
+            self._bytes += size
+            while self._items and (len(self._items) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._items)))
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+def _result_cache():
+    app = current_app._get_current_object()
+    cache = app.extensions.get('diary_search_cache')
+    if cache is None:
+        with _cache_lock:
+            cache = app.extensions.get('diary_search_cache')
+            if cache is None:
+                cache = ResultCache(
+                    max_entries=int(app.config.get('SEARCH_CACHE_MAX_ENTRIES', 256)),
+                    max_bytes=int(app.config.get('SEARCH_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+                    ttl=float(app.config.get('SEARCH_CACHE_TTL', 300)),
+                )
+                app.extensions['diary_search_cache'] = cache
+    return cache
+
+
+def _run_search(cur, keywords, page, per_page):
+    """Execute a search and return `(results, has_next)` for one page."""
+    closure_exists = _capabilities()['closure']
+    tag_ids = _matching_tag_ids(keywords, include_descendants=not closure_exists)
+    match, params = match_sql(keywords, tag_ids, via_closure=closure_exists)
+    if match is None:
+        return [], False
+
+    snippet_sql, snippet_params = snippet_columns(keywords)
+    sql = f"""
+    SELECT d.id, d.title, d.created_at, d.updated_at, s.score, {snippet_sql}
+    FROM ({match}) s
+    JOIN diary d ON d.id = s.diary_id
+    ORDER BY s.score DESC, d.created_at DESC, d.id DESC
+    LIMIT %s OFFSET %s
+    """
+    cur.execute(sql, tuple(snippet_params + params + [per_page + 1, (page - 1) * per_page]))
+    results = list(cur.fetchall())
+    has_next = len(results) > per_page
+    results = attach_tag_names(cur, results[:per_page])
+    for e in results:
+        e['title_html'] = highlight(e['title'], keywords)
+        e['snippet_html'] = render_snippet(e, keywords)
+    return results, has_next
+
+
+def _search_page(keywords, page, per_page):
+    """`(results, has_next)` for one page, from `ResultCache` while current."""
+    cache = _result_cache()
+    key = (tuple(keywords), page)
+    versions = (data_version('tags'), data_version('entries'))
+    cached = cache.get(key, versions)
+    if cached is None:
+        with get_db().cursor() as cur:
+            cached = _run_search(cur, keywords, page, per_page)
+        cache.put(key, versions, cached)
+    return cached
+
 
 @bp.route('/', methods=['GET', 'POST'])
 def index():
     """Search diary entries by title, content, or tag name.
 
+    Title/content matching goes through the inverted index in
+    `diary/fulltext.py`; results are ranked by relevance and paged with
+    `?page=N`. Each result carries a highlighted snippet of the body
+    around the first keyword hit instead of the full content. Pages are
+    served from `ResultCache` while the underlying data is unchanged.
+    When nothing matches, misspelled keywords are corrected and the
+    search is retried once (see `diary/fuzzy.py`); `?exact=1` skips that.
+
     - GET: show form and optional `q` results
     - POST: accept form submission and redirect to GET for bookmarking
     """
     q = ''
     results = []
+    has_next = False
+    corrected_q = None
+    did_you_mean = None
+    exact = request.args.get('exact') or None
+    per_page = 20
+    try:
+        page = max(1, int(request.args.get('page', '1')))
+    except ValueError:
+        page = 1
 
     if request.method == 'POST':
         q = request.form.get('q', '').strip()
@@ -22,103 +215,60 @@ def index():
     q = request.args.get('q', '').strip()
     if q:
         # Record search in session-backed history (most-recent first, unique, cap 20)
-        history = session.get('search_history', [])
-        if q in history:
-            history.remove(q)
-        history.insert(0, q)
-        session['search_history'] = history[:20]
-
-        # Support multiple keywords separated by whitespace; require all keywords (AND)
-        keywords = [k for k in q.split() if k]
-        conn = get_db()
-        with conn.cursor() as cur:
-            if keywords:
-                # detect closure table presence; if present use it, otherwise build
-                # a recursive CTE per keyword to include descendant tags
-                cur.execute(
-                    "SELECT COUNT(*) AS cnt FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
-                    ("diary_tags_closure",)
-                )
-                closure_exists = cur.fetchone()['cnt'] > 0
-
-                if closure_exists:
-                    where_clauses = []
-                    params = []
-                    for kw in keywords:
-                        like = f"%{kw}%"
-                        where_clauses.append(
-                            "(d.title LIKE %s OR d.content LIKE %s OR EXISTS (SELECT 1 FROM diary_tags_closure dt2 JOIN tags t2 ON t2.id = dt2.tag_id WHERE dt2.diary_id = d.id AND t2.name LIKE %s))"
-                        )
-                        params.extend([like, like, like])
-
-                    where_sql = " AND ".join(where_clauses)
-                    sql = f"""
-                    SELECT d.id, d.title, d.content, d.created_at,
-                        GROUP_CONCAT(t_all.name SEPARATOR ',') AS tags
-                    FROM diary d
-                    LEFT JOIN diary_tags dt_all ON dt_all.diary_id = d.id
-                    LEFT JOIN tags t_all ON dt_all.tag_id = t_all.id
-                    WHERE {where_sql}
-                    GROUP BY d.id
-                    ORDER BY d.created_at DESC
-                    """
-                    cur.execute(sql, tuple(params))
-                else:
-                    # Build recursive CTEs: one per keyword to gather matching tags and their descendants
-                    cte_defs = []
-                    where_parts = []
-                    cte_params = []
-                    where_params = []
-                    for i, kw in enumerate(keywords, start=1):
-                        like = f"%{kw}%"
-                        cte_name = f"tag_desc_{i}"
-                        cte_defs.append(
-                            f"{cte_name} AS (SELECT id FROM tags WHERE name LIKE %s UNION ALL SELECT t.id FROM tags t JOIN {cte_name} ON t.parent_id = {cte_name}.id)"
-                        )
-                        cte_params.append(like)
-
-                        # For each keyword, match title/content OR existence of a tag in the CTE
-                        where_parts.append(
-                            f"(d.title LIKE %s OR d.content LIKE %s OR EXISTS (SELECT 1 FROM diary_tags dt2 WHERE dt2.diary_id = d.id AND dt2.tag_id IN (SELECT id FROM {cte_name})))"
-                        )
-                        where_params.extend([like, like])
-
-                    where_sql = " AND ".join(where_parts)
-                    cte_sql = "WITH RECURSIVE " + ", ".join(cte_defs)
-
-                    sql = f"""
-                    {cte_sql}
-                    SELECT d.id, d.title, d.content, d.created_at,
-                        GROUP_CONCAT(t.name SEPARATOR ',') AS tags
-                    FROM diary d
-                    LEFT JOIN diary_tags dt ON d.id = dt.diary_id
-                    LEFT JOIN tags t ON t.id = dt.tag_id
-                    WHERE {where_sql}
-                    GROUP BY d.id
-                    ORDER BY d.created_at DESC
-                    """
-                    # parameter order: CTE seeds, then where title/content params
-                    params = tuple(cte_params + where_params)
-                    cur.execute(sql, params)
-
-                results = cur.fetchall()
-            else:
-                results = []
-        # Persist the search term and increment its count in `search_history`
-        # only when the search actually returned results.
-        if results:
+        # Paging through results is not a new search.
+        if page == 1:
+            history = session.get('search_history', [])
+            if q in history:
+                history.remove(q)
+            history.insert(0, q)
+            session['search_history'] = history[:20]
+
+        # Support multiple keywords separated by whitespace; require all keywords (AND).
+        # Matching is case-insensitive, so the casefolded set identifies the query.
+        keywords = sorted({k.casefold() for k in q.split() if k})
+        if keywords:
+            results, has_next = _search_page(keywords, page, per_page)
+
+            # Nothing matched: retry once with misspelled keywords corrected
+            if not results and not exact and current_app.config.get('SEARCH_FUZZY', True):
+                with get_db().cursor() as cur:
+                    corrected = fuzzy.correct(cur, keywords)
+                if corrected:
+                    results, has_next = _search_page(corrected, page, per_page)
+                    if results:
+                        corrected_q = ' '.join(corrected)
+                did_you_mean = fuzzy.did_you_mean(q)
+                if did_you_mean == corrected_q:
+                    did_you_mean = None
+
+        # Count the search term in `search_history` only when the search
+        # actually returned results. Increments are buffered and written
+        # in batches (see `diary/history_buffer.py`).
+        if results and page == 1:
             try:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "INSERT INTO search_history (term, count, last_searched) VALUES (%s, 1, CURRENT_TIMESTAMP) "
-                        "ON DUPLICATE KEY UPDATE count = count + 1, last_searched = CURRENT_TIMESTAMP",
-                        (q,)
-                    )
+                # A corrected search is remembered by what it matched
+                record_search(corrected_q or q)
+                suggest.term_searched(corrected_q or q)
             except Exception:
                 # Non-fatal: ignore DB errors so search still works
                 pass
 
-    return render_template('search/index.html', q=q, results=results)
+    return render_template(
+        'search/index.html', q=q, results=results, page=page, has_next=has_next,
+        corrected_q=corrected_q, did_you_mean=did_you_mean, exact=exact,
+    )
+
+
+@bp.route('/suggest')
+def suggest_terms():
+    """Return past searches completing `?q=` as JSON `[{term, count}]`, best first."""
+    return jsonify(suggest.suggest_terms(request.args.get('q', ''), suggest.parse_k()))
+
+
+@bp.route('/cache-stats')
+def cache_stats():
+    """Return hit/miss counters of this worker's search result cache as JSON."""
+    return jsonify(_result_cache().stats())
 
 @bp.route('/history')
 def history():
@@ -143,7 +293,24 @@ def history():
     with conn.cursor() as cur:
         sql = f"SELECT term, count, last_searched FROM search_history {where_sql} {order_sql}"
         cur.execute(sql, tuple(params))
-        rows = cur.fetchall()
+        rows = [dict(r) for r in cur.fetchall()]
+
+    # Merge this worker's not-yet-flushed increments
+    pending = get_history_buffer().pending()
+    if pending:
+        by_term = {r['term']: r for r in rows}
+        needle = filter_term.casefold()
+        for term, (count, last) in pending.items():
+            row = by_term.get(term)
+            if row is not None:
+                row['count'] += count
+                row['last_searched'] = max(row['last_searched'], last)
+            elif needle in term.casefold():
+                rows.append({'term': term, 'count': count, 'last_searched': last})
+        if order == 'time':
+            rows.sort(key=lambda r: (r['last_searched'], r['count']), reverse=True)
+        else:
+            rows.sort(key=lambda r: (r['count'], r['last_searched']), reverse=True)
 
     return render_template('search/history.html', history=rows, filter=filter_term, order=order)
 
@@ -158,8 +325,10 @@ def delete_history_term():
 
     conn = get_db()
     try:
+        get_history_buffer().discard(term)
         with conn.cursor() as cur:
             cur.execute('DELETE FROM search_history WHERE term = %s', (term,))
+        suggest.term_deleted(term)
     except Exception:
         flash('Could not delete search term.', 'error')
         return redirect(url_for('search.history'))
@@ -1,93 +1,34 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, jsonify
-from diary.db import get_db
-import pymysql
+from diary.db import IntegrityError, get_db
+from diary.conditional import not_modified, version_etag, with_validators
+from diary.fragments import clear_fragments
+from diary import changelog, closure, counters, suggest, tagindex, tagpaths
+from diary.tagcache import get_catalogue
+from diary.versions import bump_version
 
 bp = Blueprint('tags', __name__, url_prefix='/tags')
 
 
 @bp.route('/')
 def index():
-    conn = get_db()
-    with conn.cursor() as cur:
-        # Fetch tags with parent_id and usage counts (direct uses only)
-        cur.execute(
-            "SELECT t.id, t.name, t.parent_id, COUNT(dt.diary_id) AS usage_count "
-            "FROM tags t LEFT JOIN diary_tags dt ON dt.tag_id = t.id "
-            "GROUP BY t.id ORDER BY t.name"
-        )
-        rows = cur.fetchall()
-
-    # Build maps for tier computation
-    parent = {r['id']: r.get('parent_id') for r in rows}
-    usage = {r['id']: r['usage_count'] for r in rows}
-    name = {r['id']: r['name'] for r in rows}
-
-    # Compute tier (depth) for each tag with memoization and cycle protection
-    tiers = {}
-    def compute_tier(tag_id):
-        if tag_id in tiers:
-            return tiers[tag_id]
-        seen = set()
-        depth = 0
-        cur = tag_id
-        while True:
-            pid = parent.get(cur)
-            if not pid:
-                tiers[tag_id] = depth
-                return depth
-            if pid in seen:
-                # cycle detected, treat as root
-                tiers[tag_id] = 0
-                return 0
-            seen.add(pid)
-            depth += 1
-            if pid in tiers:
-                tiers[tag_id] = depth + tiers[pid]
-                return tiers[tag_id]
-            cur = pid
-
-    max_tier = 0
-    groups = {}
-    for r in rows:
-        tid = r['id']
-        t = compute_tier(tid)
-        max_tier = max(max_tier, t)
-        groups.setdefault(t, []).append({'id': tid, 'name': name[tid], 'parent_id': parent.get(tid), 'usage_count': usage.get(tid, 0)})
-
-    return render_template('tags/index.html', tag_groups=groups, max_tier=max_tier)
+    # Tags grouped by tier (depth) with direct usage counts, from the cache
+    catalogue = get_catalogue()
+    return render_template('tags/index.html', tag_groups=catalogue.tag_groups, max_tier=catalogue.max_tier)
 
 @bp.route('/trees')
 def trees():
-    conn = get_db()
-    with conn.cursor() as cur:
-        # Fetch tags with parent_id and usage counts (direct uses only)
-        cur.execute(
-            "SELECT t.id, t.name, t.parent_id, COUNT(dt.diary_id) AS usage_count "
-            "FROM tags t LEFT JOIN diary_tags dt ON dt.tag_id = t.id "
-            "GROUP BY t.id ORDER BY t.name"
-        )
-        rows = cur.fetchall()
-
-    # Build nodes and tree
-    nodes = {r['id']: {'id': r['id'], 'name': r['name'], 'parent_id': r.get('parent_id'), 'usage_count': r['usage_count'], 'children': []} for r in rows}
-    roots = []
-    for n in nodes.values():
-        pid = n.get('parent_id')
-        if pid and pid in nodes:
-            nodes[pid]['children'].append(n)
-        else:
-            roots.append(n)
-
-    return render_template('tags/trees.html', tag_tree=roots)
+    etag = version_etag('tags')
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    return with_validators(render_template('tags/trees.html', tag_tree=get_catalogue().tree), etag)
 
 
 @bp.route('/new', methods=['GET', 'POST'])
 def new():
     conn = get_db()
-    # Fetch existing tags for parent selection
-    with conn.cursor() as cur:
-        cur.execute('SELECT id, name FROM tags ORDER BY name')
-        all_tags = cur.fetchall()
+    # Existing tags for parent selection
+    all_tags = get_catalogue().names
 
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
@@ -103,12 +44,23 @@ def new():
             flash('Tag name is required.')
             return render_template('tags/new.html', tags=all_tags)
 
+        conn.begin()
         try:
             with conn.cursor() as cur:
                 cur.execute('INSERT INTO tags (name, parent_id) VALUES (%s, %s)', (name, parent_id))
-        except pymysql.err.IntegrityError:
+                tag_id = cur.lastrowid
+                tagpaths.assign(cur, tag_id, parent_id)
+            conn.commit()
+        except IntegrityError:
+            conn.rollback()
             flash('A tag with that name already exists.')
             return render_template('tags/new.html', tags=all_tags)
+        except Exception:
+            conn.rollback()
+            raise
+
+        bump_version('tags')
+        suggest.tag_added(tag_id, name)
 
         flash('Tag created.')
         return redirect(url_for('tags.new'))
@@ -138,29 +90,55 @@ def edit(id):
 
         if not name:
             flash('Tag name is required.')
-            # Re-fetch tags for parent select
-            with conn.cursor() as cur:
-                cur.execute('SELECT id, name FROM tags WHERE id != %s ORDER BY name', (id,))
-                all_tags = cur.fetchall()
+            # Tags for parent select (exclude self and descendants)
+            all_tags = get_catalogue().names_except(id)
             return render_template('tags/edit.html', tag=tag, tags=all_tags)
 
+        conn.begin()
         try:
             with conn.cursor() as cur:
-                cur.execute('UPDATE tags SET name = %s, parent_id = %s WHERE id = %s', (name, parent_id, id))
-        except pymysql.err.IntegrityError:
+                # Re-parenting moves the whole subtree: remember which entries
+                # were under this tag so their closure rows can be re-derived.
+                moved = parent_id != tag.get('parent_id')
+                affected = closure.entries_under_tag(cur, id) if moved else []
+                # Rollups shift along both the old and the new ancestor chain
+                # (taken from the catalogue as it was before the update)
+                chains = set()
+                if affected:
+                    catalogue = get_catalogue()
+                    chains.update(catalogue.ancestors(id))
+                    if parent_id:
+                        chains.update([parent_id], catalogue.ancestors(parent_id))
+                cur.execute('UPDATE tags SET name = %s WHERE id = %s', (name, id))
+                if moved:
+                    # Rewrites `path`/`depth` of the subtree; rejects cycles
+                    tagpaths.move(cur, id, parent_id)
+                if affected:
+                    closure.refresh_entries(cur, affected)
+                    counters.recount_rollups(cur, chains)
+            conn.commit()
+        except IntegrityError:
+            conn.rollback()
             flash('A tag with that name already exists.')
-            with conn.cursor() as cur:
-                cur.execute('SELECT id, name FROM tags WHERE id != %s ORDER BY name', (id,))
-                all_tags = cur.fetchall()
+            all_tags = get_catalogue().names_except(id)
+            return render_template('tags/edit.html', tag=tag, tags=all_tags)
+        except tagpaths.TagCycleError:
+            conn.rollback()
+            flash('A tag cannot be moved below itself or one of its descendants.')
+            all_tags = get_catalogue().names_except(id)
             return render_template('tags/edit.html', tag=tag, tags=all_tags)
+        except Exception:
+            conn.rollback()
+            raise
 
+        bump_version('tags')
+        # Renamed tags appear in every cached entry fragment that shows them
+        clear_fragments()
         flash('Tag updated.')
         return redirect(url_for('tags.index'))
 
-    # GET: fetch tags for parent select (exclude self)
-    with conn.cursor() as cur:
-        cur.execute('SELECT id, name FROM tags WHERE id != %s ORDER BY name', (id,))
-        all_tags = cur.fetchall()
+    # GET: tags for parent select (exclude self and descendants)
+    all_tags = get_catalogue().names_except(id)
 
     return render_template('tags/edit.html', tag=tag, tags=all_tags)
 
@@ -168,11 +146,32 @@ def edit(id):
 @bp.route('/delete/<int:id>', methods=['POST'])
 def delete(id):
     conn = get_db()
-    with conn.cursor() as cur:
-        # Remove associations first to be explicit, then remove tag
-        cur.execute('DELETE FROM diary_tags WHERE tag_id = %s', (id,))
-        cur.execute('DELETE FROM tags WHERE id = %s', (id,))
+    ancestors = get_catalogue().ancestors(id)
+    conn.begin()
+    try:
+        with conn.cursor() as cur:
+            # Entries under this tag lose it (and, for entries tagged with a
+            # descendant, every ancestor above it) from their closure rows.
+            affected = closure.entries_under_tag(cur, id)
+            # Remove associations first to be explicit, then remove tag
+            cur.execute('DELETE FROM diary_tags WHERE tag_id = %s', (id,))
+            # Children become roots (`ON DELETE SET NULL`); re-root their paths first
+            tagpaths.detach_children(cur, id)
+            cur.execute('DELETE FROM tags WHERE id = %s', (id,))
+            counters.remove_tag(cur, id)
+            if affected:
+                closure.refresh_entries(cur, affected)
+                counters.recount_rollups(cur, ancestors)
+            changelog.record(cur, tag_id=id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
+    # Entries lost the tag too (cascade), which the tag index tracks
+    bump_version('tags', 'entries')
+    tagindex.tag_deleted(id)
+    clear_fragments()
     flash('Tag deleted.')
     return redirect(url_for('tags.index'))
 
@@ -208,6 +207,7 @@ def create():
         return jsonify({'error': 'Tag name is required.'}), 400
 
     conn = get_db()
+    conn.begin()
     try:
         with conn.cursor() as cur:
             # insert with optional parent_id when provided
@@ -216,9 +216,25 @@ def create():
             else:
                 cur.execute('INSERT INTO tags (name, parent_id) VALUES (%s, %s)', (name, parent_id))
             tag_id = cur.lastrowid
-    except pymysql.err.IntegrityError:
+            tagpaths.assign(cur, tag_id, parent_id)
+        conn.commit()
+    except IntegrityError:
+        conn.rollback()
         return jsonify({'error': 'Tag already exists.'}), 409
     except Exception:
+        conn.rollback()
         return jsonify({'error': 'Could not create tag.'}), 500
 
-    return jsonify({'id': tag_id, 'name': name}), 201
\ No newline at end of file
+    bump_version('tags')
+    suggest.tag_added(tag_id, name)
+    return jsonify({'id': tag_id, 'name': name}), 201
+
+
+@bp.route('/suggest')
+def suggest_tags():
+    """Return tags completing `?q=` as JSON `[{id, name, count}]`, most used first.
+
+    Any word of the name may match (see `diary/suggest.py`); `?k=` caps
+    the number of results at `SUGGEST_MAX_K`.
+    """
+    return jsonify(suggest.suggest_tags(request.args.get('q', ''), suggest.parse_k()))
\ No newline at end of file
@@ -0,0 +1,304 @@
+"""Server-side sessions.
+
+Flask's default session is a signed cookie holding the whole session:
+every request uploads it and every change (a search adds to the 20-item
+`search_history` list) re-signs and re-sends it. Here the browser only
+keeps an opaque random id; the data lives in a `SessionStore`:
+
+- `SESSION_BACKEND = 'sqlite'` (default): a WAL-mode SQLite file
+  (`SESSION_SQLITE_PATH`, default `<instance_path>/sessions.sqlite3`)
+  shared by every gunicorn worker on the host;
+- `'memory'`: a per-process LRU of `SESSION_MEMORY_MAX_ENTRIES`
+  sessions, for a single worker, tests and benchmarks;
+- `'cookie'`: Flask's signed-cookie sessions, unchanged.
+
+The cookie is only set when a session id is issued, so request and
+response headers stay small and constant-size. Data is written back
+only when the session changed, or when less than half of its lifetime
+(`PERMANENT_SESSION_LIFETIME`) is left. `session.clear()` (login and
+logout) also issues a new id, so an id seen before login is never
+reused after it. Expired sessions are swept every
+`SESSION_SWEEP_INTERVAL` seconds by the request that saves one, and by
+`flask sweep-sessions`.
+
+A request that still carries a signed cookie from Flask's default
+sessions (from before this backend was enabled) has it verified once,
+and its data moved into the store under a new id, so switching the
+backend does not log anyone out.
+"""
+
+import abc
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature
+from werkzeug.datastructures import CallbackDict
+
+
+_SID_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+_serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data plus the id it is stored under."""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = sid is None
+        self.modified = False
+        # Set by `clear()`: store under a fresh id and drop the old one
+        self.rotate = False
+
+    def clear(self):
+        super().clear()
+        self.rotate = True
+
+
+class SessionStore(abc.ABC):
+    """Storage for serialized sessions: `sid -> (data, expires)`."""
+
+    @abc.abstractmethod
+    def load(self, sid):
+        """Return `(data, expires)` of an unexpired session, or None."""
+
+    @abc.abstractmethod
+    def save(self, sid, data, expires):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, sid):
+        pass
+
+    @abc.abstractmethod
+    def sweep(self, now=None):
+        """Delete expired sessions; return how many were removed."""
+
+
+class MemoryStore(SessionStore):
+    """Per-process LRU of sessions (not shared between workers)."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def load(self, sid):
+        with self._lock:
+            item = self._items.get(sid)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                del self._items[sid]
+                return None
+            self._items.move_to_end(sid)
+            return item
+
+    def save(self, sid, data, expires):
+        with self._lock:
+            self._items[sid] = (data, expires)
+            self._items.move_to_end(sid)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._items.pop(sid, None)
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [sid for sid, (_, expires) in self._items.items() if expires <= now]
+            for sid in expired:
+                del self._items[sid]
+        return len(expired)
+
+
+class SQLiteStore(SessionStore):
+    """Sessions in a SQLite file shared by the worker processes of one host.
+
+    Each thread (and each forked worker) opens its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def load(self, sid):
+        row = self._connect().execute(
+            'SELECT data, expires FROM sessions WHERE sid = ? AND expires > ?', (sid, time.time())
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def save(self, sid, data, expires):
+        self._connect().execute(
+            'INSERT INTO sessions (sid, data, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (sid) DO UPDATE SET data = excluded.data, expires = excluded.expires',
+            (sid, data, expires),
+        )
+
+    def delete(self, sid):
+        self._connect().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        return self._connect().execute('DELETE FROM sessions WHERE expires <= ?', (now,)).rowcount
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session data in `store`, and only its id in the cookie."""
+
+    session_class = ServerSideSession
+
+    def __init__(self, store, sweep_interval=300):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._sweep_lock = threading.Lock()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and _SID_RE.match(sid):
+            item = self.store.load(sid)
+            if item is not None:
+                data, expires = item
+                return self.session_class(_serializer.loads(data), sid=sid, expires=expires)
+        elif sid:
+            legacy = self._legacy_session(app, sid)
+            if legacy:
+                # Saved under a fresh id by `save_session()` (a new session)
+                return self.session_class(legacy)
+        return self.session_class()
+
+    def _legacy_session(self, app, value):
+        """Data of a valid signed cookie from Flask's default sessions, or None."""
+        signer = SecureCookieSessionInterface().get_signing_serializer(app)
+        if signer is None:
+            return None
+        try:
+            return signer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+
+    def _maybe_sweep(self):
+        if self.sweep_interval <= 0 or time.monotonic() < self._next_sweep:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = time.monotonic() + self.sweep_interval
+            self.store.sweep()
+        finally:
+            self._sweep_lock.release()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            # Emptied (logout) or never used: nothing to store
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(
+                    name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly
+                )
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        rotate = session.rotate and not session.new
+        refresh = session.expires is not None and session.expires - now < lifetime / 2
+        if not (session.modified or session.new or rotate or refresh):
+            return
+
+        if rotate:
+            self.store.delete(session.sid)
+        issue = session.sid is None or rotate
+        if issue:
+            session.sid = secrets.token_urlsafe(32)
+        session.expires = now + lifetime
+        self.store.save(session.sid, _serializer.dumps(dict(session)), session.expires)
+        self._maybe_sweep()
+
+        if issue or (session.permanent and refresh):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=httponly,
+                domain=domain,
+                path=path,
+                secure=secure,
+                samesite=samesite,
+            )
+
+
+def make_store(app):
+    backend = app.config.get('SESSION_BACKEND', 'sqlite')
+    if backend == 'memory':
+        return MemoryStore(int(app.config.get('SESSION_MEMORY_MAX_ENTRIES', 10000)))
+    if backend == 'sqlite':
+        path = app.config.get('SESSION_SQLITE_PATH') or os.path.join(app.instance_path, 'sessions.sqlite3')
+        return SQLiteStore(path)
+    raise ValueError(f'Unknown SESSION_BACKEND {backend!r}')
+
+
+def init_sessions(app):
+    """Install the configured session backend and `flask sweep-sessions`."""
+    app.config.setdefault('SESSION_BACKEND', 'sqlite')
+    app.config.setdefault('SESSION_MEMORY_MAX_ENTRIES', 10000)
+    app.config.setdefault('SESSION_SWEEP_INTERVAL', 300)
+
+    if app.config['SESSION_BACKEND'] != 'cookie':
+        app.session_interface = ServerSideSessionInterface(
+            make_store(app), sweep_interval=float(app.config['SESSION_SWEEP_INTERVAL'])
+        )
+
+    @click.command('sweep-sessions')
+    @with_appcontext
+    def sweep_sessions_command():
+        """Delete expired server-side sessions."""
+        interface = current_app.session_interface
+        if not isinstance(interface, ServerSideSessionInterface):
+            click.echo('SESSION_BACKEND is "cookie"; nothing to sweep.')
+            return
+        click.echo(f'Removed {interface.store.sweep()} expired sessions.')
+
+    app.cli.add_command(sweep_sessions_command)
@@ -0,0 +1,66 @@
+"""Search-result snippets.
+
+Search results no longer carry the full `content` TEXT column. Instead
+the query selects a fixed-size window of the body around the first hit
+of any keyword (`snippet_columns()`), so at most `SNIPPET_WIDTH`
+characters per row leave the database. `highlight()` then escapes the
+window and wraps keyword hits in `<mark>` for the template.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+
+SNIPPET_WIDTH = 240
+# Characters of context kept before the first hit
+SNIPPET_LEAD = 60
+# Sentinel for "keyword not found" inside LEAST(); larger than any TEXT
+_NOT_FOUND = 2147483647
+
+
+def snippet_columns(keywords, column='d.content', width=SNIPPET_WIDTH, lead=SNIPPET_LEAD):
+    """Return `(sql, params)` selecting `snippet`, `snippet_start`, `content_length`.
+
+    `snippet_start` is the 1-based position of the window in `column`;
+    when no keyword occurs in the body the window starts at the top.
+    """
+    hits = [f'COALESCE(NULLIF(LOCATE(%s, {column}), 0), {_NOT_FOUND})' for _ in keywords]
+    first = hits[0] if len(hits) == 1 else f"LEAST({', '.join(hits)})"
+    start = f'GREATEST(1, COALESCE(NULLIF({first}, {_NOT_FOUND}), 1) - {int(lead)})'
+    sql = (
+        f'SUBSTRING({column}, {start}, {int(width)}) AS snippet, '
+        f'{start} AS snippet_start, CHAR_LENGTH({column}) AS content_length'
+    )
+    params = list(keywords) * 2
+    return sql, params
+
+
+def highlight(text, keywords):
+    """Escape `text` and wrap case-insensitive keyword hits in `<mark>`."""
+    text = text or ''
+    words = sorted({k for k in keywords if k}, key=len, reverse=True)
+    if not words:
+        return escape(text)
+    pattern = re.compile('|'.join(re.escape(w) for w in words), re.IGNORECASE)
+    out = []
+    pos = 0
+    for m in pattern.finditer(text):
+        out.append(escape(text[pos:m.start()]))
+        out.append(Markup('<mark>') + escape(m.group(0)) + Markup('</mark>'))
+        pos = m.end()
+    out.append(escape(text[pos:]))
+    return Markup('').join(out)
+
+
+def render_snippet(row, keywords):
+    """Return highlighted snippet markup for a row from `snippet_columns()`."""
+    text = row.get('snippet') or ''
+    start = int(row.get('snippet_start') or 1)
+    length = int(row.get('content_length') or 0)
+    body = highlight(text, keywords)
+    if start > 1:
+        body = Markup('&hellip;') + body
+    if start - 1 + len(text) < length:
+        body = body + Markup('&hellip;')
+    return body
@@ -0,0 +1,197 @@
+"""SQLite storage backend (`DB_BACKEND = 'sqlite'`).
+
+For single-node deployments, tests and benchmarks the app can run on a
+local SQLite file in WAL mode instead of MySQL: reads are a function
+call rather than a network round trip, and there is no server to run.
+
+`connect()` returns a `Connection` that mimics the parts of the PyMySQL
+API the app uses (`cursor()` as a context manager yielding dict rows,
+`begin()` / `commit()` / `rollback()`, `ping()`, `lastrowid`,
+`rowcount`), so the pool, the routes and the maintenance modules work
+unchanged. Statements are written for MySQL and translated here, once
+per distinct statement text:
+
+- `%s` placeholders become `?`;
+- `ON DUPLICATE KEY UPDATE ... VALUES(col)` becomes
+  `ON CONFLICT DO UPDATE SET ... excluded.col`;
+- `GREATEST` / `LEAST` / `SUBSTRING` / `CHAR_LENGTH` map to `MAX` /
+  `MIN` / `SUBSTR` / `LENGTH`; `GROUP_CONCAT(x SEPARATOR ',')` to
+  `GROUP_CONCAT(x, ',')`; `CURRENT_TIMESTAMP(6)` to a local-time
+  `strftime()`; `FOR UPDATE` is dropped (`begin()` takes the write lock
+  up front with `BEGIN IMMEDIATE`).
+
+`LOCATE()` (case-insensitive, like MySQL's `_ci` collations),
+`UNIX_TIMESTAMP()` and `CONCAT()` are registered as SQL functions. `TIMESTAMP` columns
+are stored as local-time ISO text and read back as `datetime`.
+
+The schema lives in `instance/schema-sqlite.sql`.
+"""
+
+import functools
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+from .instrument import TimedCursorMixin
+
+
+_PLACEHOLDER_RE = re.compile(r'%([s%])')
+_REWRITES = [
+    (re.compile(r'\bON DUPLICATE KEY UPDATE\b', re.I), 'ON CONFLICT DO UPDATE SET'),
+    (re.compile(r'\bVALUES\((\w+)\)', re.I), r'excluded.\1'),
+    (re.compile(r'\bGREATEST\(', re.I), 'MAX('),
+    (re.compile(r'\bLEAST\(', re.I), 'MIN('),
+    (re.compile(r'\bSUBSTRING\(', re.I), 'SUBSTR('),
+    (re.compile(r'\bCHAR_LENGTH\(', re.I), 'LENGTH('),
+    (re.compile(r"\bGROUP_CONCAT\(([^()]*?) SEPARATOR ('[^']*')\)", re.I), r'GROUP_CONCAT(\1, \2)'),
+    (re.compile(r'\bCURRENT_TIMESTAMP\(6\)', re.I), "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"),
+    (re.compile(r'\s+FOR UPDATE\b', re.I), ''),
+]
+
+
+@functools.lru_cache(maxsize=1024)
+def translate(sql):
+    """Rewrite a MySQL-dialect statement for SQLite."""
+    sql = _PLACEHOLDER_RE.sub(lambda m: '?' if m.group(1) == 's' else '%', sql)
+    for pattern, repl in _REWRITES:
+        sql = pattern.sub(repl, sql)
+    return sql
+
+
+def _locate(needle, haystack):
+    if needle is None or haystack is None:
+        return None
+    return haystack.casefold().find(needle.casefold()) + 1
+
+
+def _concat(*parts):
+    if any(p is None for p in parts):
+        return None
+    return ''.join(str(p) for p in parts)
+
+
+def _unix_timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, (bytes, str)):
+        value = _parse_timestamp(value)
+    return value.timestamp()
+
+
+def _parse_timestamp(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    return datetime.fromisoformat(value)
+
+
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(sep=' '))
+sqlite3.register_converter('TIMESTAMP', _parse_timestamp)
+
+
+def _dict_row(cursor, row):
+    return {col[0]: value for col, value in zip(cursor.description, row)}
+
+
+class _Cursor:
+    """PyMySQL-style cursor over a `sqlite3` cursor (dict rows)."""
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def execute(self, query, args=None):
+        self._raw.execute(translate(query), tuple(args) if args is not None else ())
+        return self._raw.rowcount
+
+    def executemany(self, query, seq):
+        self._raw.executemany(translate(query), [tuple(a) for a in seq])
+        return self._raw.rowcount
+
+    def fetchone(self):
+        return self._raw.fetchone()
+
+    def fetchall(self):
+        return self._raw.fetchall()
+
+    def fetchmany(self, size=None):
+        return self._raw.fetchmany(size or self._raw.arraysize)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    @property
+    def lastrowid(self):
+        return self._raw.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._raw.rowcount
+
+    def close(self):
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Cursor(TimedCursorMixin, _Cursor):
+    """SQLite cursor that reports to the request stats."""
+
+
+class Connection:
+    """The subset of `pymysql.connections.Connection` used by the app."""
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def cursor(self, cursor=None):
+        # `cursor` (a PyMySQL cursor class) is accepted and ignored: SQLite
+        # cursors already step through results lazily.
+        return Cursor(self._raw.cursor())
+
+    def begin(self):
+        if self._raw.in_transaction:
+            self._raw.execute('COMMIT')
+        self._raw.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        if self._raw.in_transaction:
+            self._raw.execute('COMMIT')
+
+    def rollback(self):
+        if self._raw.in_transaction:
+            self._raw.execute('ROLLBACK')
+
+    def ping(self, reconnect=False):
+        self._raw.execute('SELECT 1').fetchone()
+
+    def executescript(self, sql):
+        self._raw.executescript(sql)
+
+    def close(self):
+        self._raw.close()
+
+
+def connect(app):
+    """Open a connection to `SQLITE_PATH` in WAL mode."""
+    path = app.config.get('SQLITE_PATH') or os.path.join(app.instance_path, 'diary.sqlite3')
+    raw = sqlite3.connect(
+        path,
+        # The pool hands a connection to one thread at a time
+        check_same_thread=False,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        # Autocommit, like the MySQL connections; `begin()` opens transactions
+        isolation_level=None,
+        timeout=float(app.config.get('SQLITE_BUSY_TIMEOUT', 5)),
+    )
+    raw.row_factory = _dict_row
+    raw.create_function('LOCATE', 2, _locate, deterministic=True)
+    raw.create_function('UNIX_TIMESTAMP', 1, _unix_timestamp, deterministic=True)
+    raw.create_function('CONCAT', -1, _concat, deterministic=True)
+    raw.execute('PRAGMA journal_mode=WAL')
+    raw.execute('PRAGMA synchronous=NORMAL')
+    raw.execute('PRAGMA foreign_keys=ON')
+    return Connection(raw)
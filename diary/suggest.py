@@ -0,0 +1,249 @@
+"""Typeahead suggestions for tag names and past searches.
+
+`/tags/suggest?q=...` and `/search/suggest?q=...` answer each keystroke
+from a per-worker `PrefixTrie` instead of the database. Every trie node
+keeps the best `SUGGEST_MAX_K` keys below it, ranked by score (direct
+usage count for tags, search count for terms) and then by label, so a
+lookup is a walk down `len(q)` nodes plus a slice. Matching is
+case-insensitive and also starts at each word of a label (`proj` finds
+`work/projects` and `side-project`).
+
+The two tries are kept current differently:
+
+- The tag trie follows the shared `tags` data version (see
+  `diary/versions.py`), like the tag catalogue. Tags created by this
+  worker (`tags.new`, `tags.create`) are inserted in place
+  (`tag_added()`); any other tag write rebuilds it on next use, from the
+  cached catalogue when that is current.
+- The search trie holds the `SUGGEST_HISTORY_TERMS` most searched terms.
+  Searches counted by this worker raise a term's score immediately
+  (`term_searched()`, next to `record_search()`), deleting a term
+  rebuilds it, and it is re-read from `search_history` every
+  `SUGGEST_HISTORY_REFRESH` seconds to pick up other workers' searches.
+
+Only score increases are applied in place; a node's list is trimmed to
+`k` keys, so anything that can lower a rank triggers a rebuild instead.
+"""
+
+import bisect
+import re
+import threading
+import time
+
+from flask import current_app, request
+
+from .db import get_db
+from .history_buffer import get_history_buffer
+from .versions import data_version
+
+
+_build_lock = threading.Lock()
+# Prefixes are indexed up to this many characters; longer queries filter
+# the candidates found at that depth
+_MAX_DEPTH = 32
+_SEPARATORS = re.compile(r'[\s\-_/.,:]+')
+
+
+def _words(label):
+    """Casefolded `label` and each of its suffixes starting at a word."""
+    text = label.casefold()
+    out = [text]
+    for m in _SEPARATORS.finditer(text):
+        rest = text[m.end():]
+        if rest:
+            out.append(rest)
+    return out
+
+
+class _Node:
+    __slots__ = ('children', 'top')
+
+    def __init__(self):
+        self.children = {}
+        # `(-score, label, key)`, best first, at most `k` long
+        self.top = []
+
+
+class PrefixTrie:
+    """Prefix tree whose nodes keep their `k` best keys by score.
+
+    Lookups read `node.top` lists that writers replace rather than mutate,
+    so they need no lock.
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self.root = _Node()
+        self.scores = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, items, k=10):
+        """Build from `(key, label, score)` triples."""
+        trie = cls(k)
+        for key, label, score in sorted(items, key=lambda t: (-t[2], t[1])):
+            trie.scores[key] = (score, label)
+            entry = (-score, label, key)
+            for word in _words(label):
+                node = trie.root
+                for ch in word[:_MAX_DEPTH]:
+                    node = node.children.setdefault(ch, _Node())
+                    # Items arrive best first: append until the node is full
+                    if len(node.top) < k and (not node.top or node.top[-1][2] != key):
+                        node.top.append(entry)
+            if len(trie.root.top) < k:
+                trie.root.top.append(entry)
+        return trie
+
+    def add(self, key, label, score):
+        """Insert `key` or raise its score (lowering needs a rebuild)."""
+        with self._lock:
+            self._add(key, label, score)
+
+    def increment(self, key, label, by=1):
+        with self._lock:
+            self._add(key, label, self.scores.get(key, (0, label))[0] + by)
+
+    def _add(self, key, label, score):
+        entry = (-score, label, key)
+        self.scores[key] = (score, label)
+        self._offer(self.root, key, entry)
+        for word in _words(label):
+            node = self.root
+            for ch in word[:_MAX_DEPTH]:
+                node = node.children.setdefault(ch, _Node())
+                self._offer(node, key, entry)
+
+    def _offer(self, node, key, entry):
+        top = [t for t in node.top if t[2] != key]
+        if len(top) < self.k or entry < top[-1]:
+            bisect.insort(top, entry)
+            node.top = top[:self.k]
+
+    def lookup(self, prefix, k=None):
+        """Return up to `k` `(key, label, score)` whose label has a word starting with `prefix`."""
+        k = self.k if k is None else min(k, self.k)
+        q = prefix.casefold().strip()
+        node = self.root
+        for ch in q[:_MAX_DEPTH]:
+            node = node.children.get(ch)
+            if node is None:
+                return []
+        top = node.top
+        if len(q) > _MAX_DEPTH:
+            top = [t for t in top if any(w.startswith(q) for w in _words(t[1]))]
+        return [(key, label, -neg) for neg, label, key in top[:k]]
+
+
+def _max_k(app):
+    return int(app.config.get('SUGGEST_MAX_K', 10))
+
+
+def get_tag_trie():
+    """Return this worker's tag trie, rebuilt if the tags version moved."""
+    app = current_app._get_current_object()
+    version = data_version('tags')
+    trie = app.extensions.get('diary_tag_trie')
+    if trie is not None and trie.version == version:
+        return trie
+
+    with _build_lock:
+        trie = app.extensions.get('diary_tag_trie')
+        if trie is not None and trie.version == version:
+            return trie
+        catalogue = app.extensions.get('diary_tag_catalogue')
+        if catalogue is not None and catalogue.version == version:
+            items = [(t['id'], t['name'], catalogue.usage.get(t['id'], 0)) for t in catalogue.names]
+        else:
+            with get_db().cursor() as cur:
+                cur.execute(
+                    "SELECT t.id, t.name, COALESCE(c.direct_count, 0) AS usage_count "
+                    "FROM tags t LEFT JOIN entry_counters c ON c.tag_id = t.id"
+                )
+                items = [(r['id'], r['name'], int(r['usage_count'])) for r in cur.fetchall()]
+        trie = PrefixTrie.build(items, k=_max_k(app))
+        trie.version = version
+        app.extensions['diary_tag_trie'] = trie
+        return trie
+
+
+def tag_added(tag_id, name):
+    """Insert a tag created by this worker; call after `bump_version('tags')`.
+
+    The trie advances by exactly that one bump, otherwise it is left
+    stale and rebuilt on next use (see `tagindex._apply`).
+    """
+    trie = current_app.extensions.get('diary_tag_trie')
+    if trie is None:
+        return
+    version = data_version('tags')
+    with _build_lock:
+        if trie.version == version - 1:
+            trie.add(tag_id, name, 0)
+            trie.version = version
+
+
+def suggest_tags(q, k=None):
+    """`[{'id', 'name', 'count'}]` for tags with a word starting with `q`."""
+    return [{'id': key, 'name': label, 'count': score} for key, label, score in get_tag_trie().lookup(q, k)]
+
+
+def get_search_trie():
+    """Return this worker's search-history trie, re-read when due."""
+    app = current_app._get_current_object()
+    refresh = float(app.config.get('SUGGEST_HISTORY_REFRESH', 60))
+    trie = app.extensions.get('diary_search_trie')
+    if trie is not None and not trie.stale and time.monotonic() - trie.built_at < refresh:
+        return trie
+
+    with _build_lock:
+        trie = app.extensions.get('diary_search_trie')
+        if trie is not None and not trie.stale and time.monotonic() - trie.built_at < refresh:
+            return trie
+        with get_db().cursor() as cur:
+            cur.execute(
+                'SELECT term, count FROM search_history ORDER BY count DESC, last_searched DESC LIMIT %s',
+                (int(app.config.get('SUGGEST_HISTORY_TERMS', 5000)),),
+            )
+            counts = {r['term']: int(r['count']) for r in cur.fetchall()}
+        # Include this worker's searches that are not flushed yet
+        for term, (count, _) in get_history_buffer().pending().items():
+            counts[term] = counts.get(term, 0) + count
+        trie = PrefixTrie.build([(t, t, c) for t, c in counts.items()], k=_max_k(app))
+        trie.built_at = time.monotonic()
+        trie.stale = False
+        app.extensions['diary_search_trie'] = trie
+        return trie
+
+
+def term_searched(term):
+    """Count one search of `term` (see `history_buffer.record_search`)."""
+    trie = current_app.extensions.get('diary_search_trie')
+    if trie is not None:
+        trie.increment(term, term)
+
+
+def term_deleted(term):
+    trie = current_app.extensions.get('diary_search_trie')
+    if trie is not None:
+        trie.stale = True
+
+
+def suggest_terms(q, k=None):
+    """`[{'term', 'count'}]` for past searches with a word starting with `q`."""
+    return [{'term': label, 'count': score} for _, label, score in get_search_trie().lookup(q, k)]
+
+
+def parse_k():
+    """`?k=` from the request, clamped to `1..SUGGEST_MAX_K`."""
+    max_k = _max_k(current_app)
+    try:
+        return max(1, min(int(request.args.get('k', max_k)), max_k))
+    except ValueError:
+        return max_k
+
+
+def init_suggest(app):
+    app.config.setdefault('SUGGEST_MAX_K', 10)
+    app.config.setdefault('SUGGEST_HISTORY_TERMS', 5000)
+    app.config.setdefault('SUGGEST_HISTORY_REFRESH', 60)
@@ -0,0 +1,143 @@
+"""In-process cache of the tag catalogue.
+
+Most pages need some view of the whole tags table: the sorted name list
+for selects, the parent map, the tiers shown on `tags.index` or the tree
+shown on `tags.trees`. `get_catalogue()` builds all of them from one
+query and keeps the result until the shared `tags` data version (see
+`diary/versions.py`) changes. Every tag write and every `diary_tags`
+write bumps that version, so a cached catalogue is never served stale
+across workers.
+
+Cached structures are shared between requests: treat them as read-only.
+"""
+
+import threading
+
+from flask import current_app
+
+from .db import get_db
+from .tagpaths import ancestor_ids
+from .versions import data_version
+
+
+class TagCatalogue:
+    """Immutable snapshot of the tags table plus derived views."""
+
+    def __init__(self, rows, version):
+        self.version = version
+        # `[{'id', 'name'}]` sorted by name, as the old `SELECT id, name` returned
+        self.names = [{'id': r['id'], 'name': r['name']} for r in rows]
+        self.by_name = {r['name']: r['id'] for r in rows}
+        self.name = {r['id']: r['name'] for r in rows}
+        self.parent = {r['id']: r.get('parent_id') for r in rows}
+        # Materialized paths and depths (see `diary/tagpaths.py`)
+        self.paths = {r['id']: r['path'] for r in rows}
+        self.usage = {r['id']: int(r['usage_count']) for r in rows}
+        self.children = {}
+        for r in rows:
+            pid = r.get('parent_id')
+            if pid and pid in self.parent:
+                self.children.setdefault(pid, []).append(r['id'])
+        self.tiers = {r['id']: int(r['depth']) for r in rows}
+        self.tag_groups, self.max_tier = self._group_by_tier(rows)
+        self.tree = self._build_tree(rows)
+
+    def _group_by_tier(self, rows):
+        groups = {}
+        max_tier = 0
+        for r in rows:
+            tid = r['id']
+            t = self.tiers.get(tid, 0)
+            max_tier = max(max_tier, t)
+            groups.setdefault(t, []).append({'id': tid, 'name': r['name'], 'parent_id': self.parent.get(tid), 'usage_count': self.usage.get(tid, 0)})
+        return groups, max_tier
+
+    def _build_tree(self, rows):
+        nodes = {r['id']: {'id': r['id'], 'name': r['name'], 'parent_id': r.get('parent_id'), 'usage_count': self.usage[r['id']], 'children': []} for r in rows}
+        roots = []
+        for n in nodes.values():
+            pid = n.get('parent_id')
+            if pid and pid in nodes:
+                nodes[pid]['children'].append(n)
+            else:
+                roots.append(n)
+        return roots
+
+    def ancestors(self, tag_id):
+        """Ids of the ancestors of `tag_id`, nearest first."""
+        return ancestor_ids(self.paths.get(tag_id) or '')
+
+    def path(self, tag_id):
+        """Slash-separated name path of `tag_id` from its root, e.g. `work/projects`."""
+        chain = [tag_id] + self.ancestors(tag_id)
+        return '/'.join(self.name[t] for t in reversed(chain) if t in self.name)
+
+    def descendants(self, tag_id):
+        """Ids of all tags below `tag_id` (from the materialized paths)."""
+        prefix = self.paths.get(tag_id)
+        if not prefix:
+            return []
+        return [t for t, p in self.paths.items() if t != tag_id and p.startswith(prefix)]
+
+    def names_except(self, tag_id):
+        """Name list for parent selects, excluding `tag_id` and its descendants."""
+        prefix = self.paths.get(tag_id)
+        if not prefix:
+            return [t for t in self.names if t['id'] != tag_id]
+        return [t for t in self.names if t['id'] != tag_id and not self.paths[t['id']].startswith(prefix)]
+
+
+_build_lock = threading.Lock()
+
+
+def get_catalogue():
+    """Return the current `TagCatalogue`, rebuilding it if the tags version moved."""
+    app = current_app._get_current_object()
+    version = data_version('tags')
+    cached = app.extensions.get('diary_tag_catalogue')
+    if cached is not None and cached.version == version:
+        return cached
+
+    with _build_lock:
+        cached = app.extensions.get('diary_tag_catalogue')
+        if cached is not None and cached.version == version:
+            return cached
+        conn = get_db()
+        with conn.cursor() as cur:
+            # Direct usage counts come from the maintained `entry_counters`
+            cur.execute(
+                "SELECT t.id, t.name, t.parent_id, t.path, t.depth, COALESCE(c.direct_count, 0) AS usage_count "
+                "FROM tags t LEFT JOIN entry_counters c ON c.tag_id = t.id "
+                "ORDER BY t.name"
+            )
+            rows = cur.fetchall()
+        catalogue = TagCatalogue(rows, version)
+        app.extensions['diary_tag_catalogue'] = catalogue
+        return catalogue
+
+
+def attach_tag_names(cur, entries):
+    """Fill `e['tags']` (comma-separated names or None) for a page of rows.
+
+    Only the `(diary_id, tag_id)` pairs for the page are read from the
+    database; names come from the cached catalogue, so listings no longer
+    need a `GROUP BY` over a three-way join.
+    """
+    for e in entries:
+        e['tags'] = None
+    if not entries:
+        return entries
+    ids = [e['id'] for e in entries]
+    placeholders = ', '.join(['%s'] * len(ids))
+    cur.execute(f'SELECT diary_id, tag_id FROM diary_tags WHERE diary_id IN ({placeholders})', tuple(ids))
+    names = get_catalogue().name
+    by_entry = {}
+    for r in cur.fetchall():
+        name = names.get(r['tag_id'])
+        if name is not None:
+            by_entry.setdefault(r['diary_id'], []).append(name)
+    for e in entries:
+        tags = by_entry.get(e['id'])
+        if tags:
+            e['tags'] = ','.join(sorted(tags))
+    return entries
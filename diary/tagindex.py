@@ -0,0 +1,338 @@
+"""In-memory tag -> entry bitmap index for multi-tag filtering and facets.
+
+The listing routes accept any combination of tags:
+
+- `?tag=a&tag=b`: entries carrying every listed tag (AND);
+- `?any=c&any=d`: ... and at least one of these (OR);
+- `?exclude=e`: ... and none of these (NOT);
+- `?deep=1`: each tag also matches its descendants.
+
+Each worker keeps one bitmap per tag (a Python `int` whose bit *n* is
+set when entry *n* carries the tag directly) plus the entry order by
+`(created_at, id)`. Set operations and counts (`&`, `|`, `& ~`,
+popcounts) run in C over the packed bits, so filtering and the
+facet counts for every other tag never touch the database; only the
+rows of the final page are fetched (`select()` / `Selection.page()`).
+Entry ids are dense auto-increment values, so an uncompressed bitmap
+costs about `max(id) / 8` bytes per tag.
+
+The index is built on first use (like the connection pool, so the
+gunicorn master never opens connections) and then updated in place by
+this worker's writes (`entry_saved()`, `entry_deleted()`,
+`tag_deleted()`). It tracks the shared `entries` data version (see `diary/versions.py`): when another
+worker or a CLI command writes, the version moves past what this worker
+applied, and the next filtered request catches up from the
+`entry_changes` log (see `diary/changelog.py`), re-reading only the
+changed entries. It is rebuilt only after a bulk write (`flask import`,
+`flask seed`) or when it fell too far behind the log.
+Set `TAG_INDEX_ENABLED = False` to apply the same filters through SQL
+(`home._tag_filter_sql()`), without facets.
+"""
+
+import bisect
+import threading
+
+from flask import current_app
+
+from . import changelog
+from .db import get_db
+from .instrument import SSDictCursor
+from .versions import data_version
+
+
+_build_lock = threading.Lock()
+# Use extract-and-sort instead of walking the whole order when fewer
+# than 1 in this many entries match
+_SPARSE_RATIO = 32
+# Entries re-read per statement when catching up
+_CATCH_UP_CHUNK = 500
+
+
+def _bits(bitmap):
+    """Yield the positions of the set bits of `bitmap`, ascending."""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for i, byte in enumerate(data):
+        if byte:
+            base = i * 8
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield base + bit
+
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    # `int.bit_count()` needs Python 3.10; this is ~40x slower on big bitmaps
+    def _popcount(bitmap):
+        return bin(bitmap).count('1')
+
+
+def _from_ids(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, 'little')
+
+
+class TagIndex:
+    """Per-tag entry bitmaps plus the listing order of all entries."""
+
+    def __init__(self, version):
+        self.version = version
+        self.lock = threading.Lock()
+        self.bitmaps = {}
+        self.all = 0
+        # `(created_at, id)` per entry and all of them sorted ascending
+        self.keys = {}
+        self.order = []
+        # Direct tags per entry, to clear old bits on edit and delete
+        self.entry_tags = {}
+        self.feed = changelog.Feed()
+
+    @classmethod
+    def build(cls, cur, version):
+        index = cls(version)
+        # Position in the change log first: writes committed during the
+        # scan are re-applied by the next catch-up
+        index.feed.start(cur)
+        cur.execute('SELECT id, created_at FROM diary')
+        for r in cur:
+            index.keys[r['id']] = (r['created_at'], r['id'])
+        index.order = sorted(index.keys.values())
+        index.all = _from_ids(index.keys)
+
+        by_tag = {}
+        cur.execute('SELECT diary_id, tag_id FROM diary_tags')
+        for r in cur:
+            by_tag.setdefault(r['tag_id'], []).append(r['diary_id'])
+            index.entry_tags.setdefault(r['diary_id'], set()).add(r['tag_id'])
+        index.bitmaps = {tag_id: _from_ids(ids) for tag_id, ids in by_tag.items()}
+        return index
+
+    def _clear_entry(self, entry_id):
+        bit = 1 << entry_id
+        for tag_id in self.entry_tags.pop(entry_id, ()):
+            self.bitmaps[tag_id] = self.bitmaps.get(tag_id, 0) & ~bit
+        key = self.keys.pop(entry_id, None)
+        if key is not None:
+            i = bisect.bisect_left(self.order, key)
+            if i < len(self.order) and self.order[i] == key:
+                del self.order[i]
+        self.all &= ~bit
+
+    def set_entry(self, entry_id, created_at, tag_ids):
+        """Insert or replace one entry (`created_at=None` keeps the old key)."""
+        if created_at is None and entry_id in self.keys:
+            created_at = self.keys[entry_id][0]
+        self._clear_entry(entry_id)
+        bit = 1 << entry_id
+        key = (created_at, entry_id)
+        self.keys[entry_id] = key
+        bisect.insort(self.order, key)
+        self.all |= bit
+        if tag_ids:
+            self.entry_tags[entry_id] = set(tag_ids)
+            for tag_id in tag_ids:
+                self.bitmaps[tag_id] = self.bitmaps.get(tag_id, 0) | bit
+
+    def catch_up(self, cur, entry_ids, tag_ids):
+        """Re-read `entry_ids` and drop `tag_ids` (writes of other processes)."""
+        for tag_id in tag_ids:
+            self.remove_tag(tag_id)
+        entry_ids = sorted(entry_ids)
+        for i in range(0, len(entry_ids), _CATCH_UP_CHUNK):
+            chunk = entry_ids[i:i + _CATCH_UP_CHUNK]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cur.execute(f'SELECT id, created_at FROM diary WHERE id IN ({placeholders})', tuple(chunk))
+            created = {r['id']: r['created_at'] for r in cur.fetchall()}
+            cur.execute(f'SELECT diary_id, tag_id FROM diary_tags WHERE diary_id IN ({placeholders})', tuple(chunk))
+            tags = {}
+            for r in cur.fetchall():
+                tags.setdefault(r['diary_id'], set()).add(r['tag_id'])
+            for entry_id in chunk:
+                if entry_id in created:
+                    self.set_entry(entry_id, created[entry_id], tags.get(entry_id))
+                else:
+                    self.remove_entry(entry_id)
+
+    def remove_entry(self, entry_id):
+        self._clear_entry(entry_id)
+
+    def remove_tag(self, tag_id):
+        self.bitmaps.pop(tag_id, None)
+        for tags in self.entry_tags.values():
+            tags.discard(tag_id)
+
+    def union(self, tag_ids):
+        out = 0
+        for tag_id in tag_ids:
+            out |= self.bitmaps.get(tag_id, 0)
+        return out
+
+    def facets(self, bitmap, tag_ids):
+        """`{tag_id: count}` of entries in `bitmap` per tag (zero counts omitted)."""
+        out = {}
+        for tag_id in tag_ids:
+            b = self.bitmaps.get(tag_id)
+            if b:
+                n = _popcount(b & bitmap)
+                if n:
+                    out[tag_id] = n
+        return out
+
+
+class Selection:
+    """A filtered set of entries that can be paged in listing order."""
+
+    def __init__(self, index, bitmap):
+        self.index = index
+        self.bitmap = bitmap
+        self.count = _popcount(bitmap)
+
+    def _walk(self, start, step, skip, limit):
+        order = self.index.order
+        data = self.bitmap.to_bytes((self.bitmap.bit_length() + 7) // 8, 'little')
+        size = len(data)
+        out = []
+        i = start
+        while 0 <= i < len(order) and len(out) < limit:
+            entry_id = order[i][1]
+            j = entry_id >> 3
+            if j < size and data[j] >> (entry_id & 7) & 1:
+                if skip:
+                    skip -= 1
+                else:
+                    out.append(entry_id)
+            i += step
+        return out
+
+    def page(self, per_page, cursor=None, offset=0):
+        """Return `(entry ids, has_more)` for one page, newest first.
+
+        Mirrors `home._list_entries`: with a keyset `cursor` the page
+        starts after (`'n'`) or before (`'p'`) the boundary row, otherwise
+        `offset` rows are skipped.
+        """
+        index = self.index
+        want = per_page + 1
+        with index.lock:
+            if self.count * _SPARSE_RATIO < len(index.order):
+                keys = sorted((index.keys[i] for i in _bits(self.bitmap) if i in index.keys), reverse=True)
+                if cursor is not None:
+                    created_at, entry_id, direction, _ = cursor
+                    boundary = (created_at, entry_id)
+                    if direction == 'p':
+                        keys = [k for k in reversed(keys) if k > boundary]
+                    else:
+                        keys = [k for k in keys if k < boundary]
+                    ids = [k[1] for k in keys[:want]]
+                else:
+                    ids = [k[1] for k in keys[offset:offset + want]]
+            elif cursor is not None:
+                created_at, entry_id, direction, _ = cursor
+                boundary = (created_at, entry_id)
+                if direction == 'p':
+                    ids = self._walk(bisect.bisect_right(index.order, boundary), 1, 0, want)
+                else:
+                    ids = self._walk(bisect.bisect_left(index.order, boundary) - 1, -1, 0, want)
+            else:
+                ids = self._walk(len(index.order) - 1, -1, offset, want)
+        has_more = len(ids) > per_page
+        ids = ids[:per_page]
+        if cursor is not None and cursor[2] == 'p':
+            ids.reverse()
+        return ids, has_more
+
+
+def get_tag_index():
+    """Return this worker's current `TagIndex`, catching up or rebuilding if stale.
+
+    Returns None when `TAG_INDEX_ENABLED` is off.
+    """
+    app = current_app._get_current_object()
+    if not app.config.get('TAG_INDEX_ENABLED', True):
+        return None
+    version = data_version('entries')
+    index = app.extensions.get('diary_tag_index')
+    if index is not None and index.version == version:
+        return index
+
+    with _build_lock:
+        index = app.extensions.get('diary_tag_index')
+        if index is not None and index.version == version:
+            return index
+        if index is not None:
+            with get_db().cursor() as cur:
+                changes = index.feed.poll(cur)
+                if changes is not None:
+                    with index.lock:
+                        index.catch_up(cur, *changes)
+                        index.version = max(index.version, version)
+                    return index
+        with get_db().cursor(SSDictCursor) as cur:
+            index = TagIndex.build(cur, version)
+        app.extensions['diary_tag_index'] = index
+        return index
+
+
+def select(index, all_of=(), any_of=(), none_of=()):
+    """Return a `Selection` for the given groups of tag-id sets.
+
+    Each member of `all_of`/`any_of`/`none_of` is a set of tag ids that
+    counts as one tag (a tag plus its descendants with `?deep=1`).
+    """
+    with index.lock:
+        bitmap = index.all
+        for ids in all_of:
+            bitmap &= index.union(ids)
+        if any_of:
+            alternatives = 0
+            for ids in any_of:
+                alternatives |= index.union(ids)
+            bitmap &= alternatives
+        for ids in none_of:
+            bitmap &= ~index.union(ids)
+    return Selection(index, bitmap)
+
+
+def facet_counts(selection, tag_ids):
+    """Entry counts per tag within `selection` (tags with no match omitted)."""
+    with selection.index.lock:
+        return selection.index.facets(selection.bitmap, tag_ids)
+
+
+def _apply(change):
+    """Apply `change(index)` if this worker's index saw every earlier write.
+
+    Call after `bump_version('entries')`: the index advances by exactly
+    that one bump, otherwise it is left stale and rebuilt on next use.
+    """
+    index = current_app.extensions.get('diary_tag_index')
+    if index is None:
+        return
+    version = data_version('entries')
+    with index.lock:
+        if index.version == version - 1:
+            change(index)
+            index.version = version
+
+
+def entry_saved(entry_id, created_at, tag_ids):
+    """Record a created or edited entry (`created_at=None` when unchanged)."""
+    _apply(lambda index: index.set_entry(entry_id, created_at, tag_ids))
+
+
+def entry_deleted(entry_id):
+    _apply(lambda index: index.remove_entry(entry_id))
+
+
+def tag_deleted(tag_id):
+    _apply(lambda index: index.remove_tag(tag_id))
+
+
+def init_tag_index(app):
+    app.config.setdefault('TAG_INDEX_ENABLED', True)
+    app.config.setdefault('TAG_FACETS_LIMIT', 20)
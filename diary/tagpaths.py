@@ -0,0 +1,133 @@
+"""Materialized paths for the tag hierarchy.
+
+Besides `parent_id`, every tag row carries:
+
+- `path`: the ids from its root down to itself, e.g. `/3/17/42/`;
+- `depth`: the number of ancestors (0 for a root tag).
+
+"Tag X and everything below it" is then one index range scan,
+`path LIKE '/3/17/%'` (see `subtree_clause()`), and the tier shown on
+`tags.index` is simply `depth`. Paths hold ids rather than names, so
+renaming a tag does not touch them.
+
+The columns are kept correct by every write to `tags`:
+
+- new tags get their parent's path plus their own id (`assign()`);
+- re-parenting rewrites the path and depth of the whole subtree
+  (`move()`), and refuses to put a tag below itself (`TagCycleError`);
+- before a tag is deleted its children become roots (`detach_children()`),
+  matching `ON DELETE SET NULL` on `parent_id`.
+
+`rebuild()` recomputes every path from `parent_id`; migration 5 (see
+`diary/migrations.py`) uses it to backfill existing databases.
+"""
+
+
+class TagCycleError(ValueError):
+    """Raised when a tag would become its own ancestor."""
+
+
+def _parent_path(cur, parent_id):
+    if parent_id is None:
+        return '/', -1
+    cur.execute('SELECT path, depth FROM tags WHERE id = %s', (parent_id,))
+    row = cur.fetchone()
+    if row is None or not row['path']:
+        return '/', -1
+    return row['path'], int(row['depth'])
+
+
+def subtree_clause(path, alias='t'):
+    """Return `(where_sql, params)` matching the tag at `path` and its descendants."""
+    return f'{alias}.path LIKE %s', (path + '%',)
+
+
+def ancestor_ids(path):
+    """Ids on `path` above its last element, nearest first."""
+    ids = [int(p) for p in path.strip('/').split('/') if p]
+    return ids[-2::-1]
+
+
+def assign(cur, tag_id, parent_id):
+    """Set `path`/`depth` of a newly inserted leaf tag."""
+    prefix, parent_depth = _parent_path(cur, parent_id)
+    cur.execute(
+        'UPDATE tags SET path = %s, depth = %s WHERE id = %s',
+        (f'{prefix}{tag_id}/', parent_depth + 1, tag_id),
+    )
+
+
+def move(cur, tag_id, parent_id):
+    """Re-parent `tag_id` (and its subtree) below `parent_id` (None for root).
+
+    Raises `TagCycleError` if `parent_id` is the tag itself or one of its
+    descendants. Does not commit.
+    """
+    cur.execute('SELECT path, depth FROM tags WHERE id = %s', (tag_id,))
+    row = cur.fetchone()
+    if row is None:
+        return
+    old_path, old_depth = row['path'], int(row['depth'])
+    prefix, parent_depth = _parent_path(cur, parent_id)
+    if parent_id == tag_id or prefix.startswith(old_path):
+        raise TagCycleError('A tag cannot be moved below itself.')
+
+    new_path = f'{prefix}{tag_id}/'
+    cur.execute('UPDATE tags SET parent_id = %s WHERE id = %s', (parent_id, tag_id))
+    if new_path == old_path:
+        return
+    where, params = subtree_clause(old_path, alias='tags')
+    cur.execute(
+        f'UPDATE tags SET path = CONCAT(%s, SUBSTRING(path, %s)), depth = depth + %s WHERE {where}',
+        (new_path, len(old_path) + 1, parent_depth + 1 - old_depth) + params,
+    )
+
+
+def detach_children(cur, tag_id):
+    """Make the children of `tag_id` roots (call before deleting it)."""
+    cur.execute('SELECT id FROM tags WHERE parent_id = %s', (tag_id,))
+    for r in cur.fetchall():
+        move(cur, r['id'], None)
+
+
+def rebuild(cur):
+    """Recompute every tag's `path` and `depth` from `parent_id`.
+
+    Tags caught in a `parent_id` cycle (possible in data written before
+    cycles were rejected) are turned into roots. Returns the number of
+    tags detached that way.
+    """
+    cur.execute('SELECT id, parent_id FROM tags')
+    parent = {r['id']: r['parent_id'] for r in cur.fetchall()}
+    children = {}
+    for tag_id, pid in parent.items():
+        children.setdefault(pid if pid in parent else None, []).append(tag_id)
+
+    paths = {}
+    stack = [(t, '/', 0) for t in children.get(None, [])]
+    while stack:
+        tag_id, prefix, depth = stack.pop()
+        path = f'{prefix}{tag_id}/'
+        paths[tag_id] = (path, depth)
+        stack.extend((c, path, depth + 1) for c in children.get(tag_id, []))
+
+    detached = 0
+    for tag_id in sorted(parent):
+        if tag_id in paths:
+            continue
+        # Unreached: part of (or below) a cycle. Break it here.
+        detached += 1
+        cur.execute('UPDATE tags SET parent_id = NULL WHERE id = %s', (tag_id,))
+        stack = [(tag_id, '/', 0)]
+        while stack:
+            t, prefix, depth = stack.pop()
+            if t in paths:
+                continue
+            path = f'{prefix}{t}/'
+            paths[t] = (path, depth)
+            stack.extend((c, path, depth + 1) for c in children.get(t, []))
+
+    rows = [(path, depth, tag_id) for tag_id, (path, depth) in paths.items()]
+    if rows:
+        cur.executemany('UPDATE tags SET path = %s, depth = %s WHERE id = %s', rows)
+    return detached
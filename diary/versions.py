@@ -0,0 +1,112 @@
+"""Data-version counters shared by every worker process.
+
+In-process caches (tag catalogue, search results, ...) must notice writes
+made by *other* gunicorn workers. Each cache records the version of the
+data it was built from and compares it with the current counter before
+use; every write path bumps the counters it affects.
+
+Counters live in a small memory-mapped file under the instance folder
+(`instance/data-versions`), so reading one is a memory access rather
+than a database round trip, and forked workers share the same mapping.
+Increments take an exclusive `flock` so concurrent bumps from several
+processes are never lost. On platforms without `fcntl` the counters
+fall back to process-local values.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+
+# Fixed slot numbers; append new names, never reorder. `epoch` is a
+# random value written when the file is created, so validators derived
+# from the counters (see `diary/conditional.py`) never repeat after the
+# file is deleted and the counters restart from zero. `fragments` moves
+# when rendered entry HTML changes without an edit (see
+# `diary/fragments.py`).
+SLOTS = ('tags', 'entries', 'epoch', 'fragments')
+_SLOT_SIZE = 8
+_FILE_SIZE = 64 * _SLOT_SIZE
+
+
+class VersionCounters:
+    """Named 64-bit counters backed by a shared memory-mapped file."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = dict.fromkeys(SLOTS, 0)
+        self._fd = None
+        self._map = None
+        if path is not None and fcntl is not None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < _FILE_SIZE:
+                os.ftruncate(fd, _FILE_SIZE)
+            self._fd = fd
+            self._map = mmap.mmap(fd, _FILE_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            self._init_epoch()
+
+    @property
+    def shared(self):
+        """True when the counters are visible to every worker process."""
+        return self._map is not None
+
+    def _init_epoch(self):
+        offset = SLOTS.index('epoch') * _SLOT_SIZE
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if struct.unpack_from('<Q', self._map, offset)[0] == 0:
+                struct.pack_into('<Q', self._map, offset, int.from_bytes(os.urandom(8), 'little') or 1)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get(self, name):
+        """Return the current value of counter `name`."""
+        if self._map is None:
+            return self._local[name]
+        return struct.unpack_from('<Q', self._map, SLOTS.index(name) * _SLOT_SIZE)[0]
+
+    def bump(self, *names):
+        """Increment each named counter by one (atomically across processes)."""
+        with self._lock:
+            if self._map is None:
+                for name in names:
+                    self._local[name] += 1
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for name in names:
+                    offset = SLOTS.index(name) * _SLOT_SIZE
+                    value = struct.unpack_from('<Q', self._map, offset)[0]
+                    struct.pack_into('<Q', self._map, offset, value + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def init_versions(app):
+    """Attach the shared counters to `app` (file in the instance folder)."""
+    path = app.config.get('DATA_VERSIONS_FILE') or os.path.join(app.instance_path, 'data-versions')
+    try:
+        counters = VersionCounters(path)
+    except OSError:
+        app.logger.warning('Could not open %s; data versions are per-process only.', path)
+        counters = VersionCounters(None)
+    app.extensions['diary_versions'] = counters
+
+
+def data_version(name):
+    """Return the current data version `name` for the current app."""
+    return current_app.extensions['diary_versions'].get(name)
+
+
+def bump_version(*names):
+    """Record that data covered by `names` changed (call after writes)."""
+    current_app.extensions['diary_versions'].bump(*names)
@@ -0,0 +1,123 @@
+-- SQLite equivalent of `schema.sql`, used by `flask init-db` when
+-- `DB_BACKEND = 'sqlite'` (see `diary/sqlite_db.py`). Executed as one
+-- script, so statements may contain semicolons (triggers).
+-- TIMESTAMP columns hold local-time ISO text, like MySQL's session-zone values.
+
+CREATE TABLE IF NOT EXISTS `diary` (
+    `id` INTEGER PRIMARY KEY,
+    `title` VARCHAR(255) NOT NULL,
+    `content` TEXT NOT NULL,
+    -- Listing excerpt, maintained by `diary/excerpts.py`
+    `excerpt` VARCHAR(2000) NOT NULL DEFAULT '',
+    `excerpt_truncated` TINYINT(1) NOT NULL DEFAULT 0,
+    `created_at` TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    -- Validator for conditional GETs and `flask export --since`
+    `updated_at` TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS `idx_diary_updated_at` ON `diary` (`updated_at`);
+-- Listings sort by `created_at DESC, id DESC` (keyset pagination)
+CREATE INDEX IF NOT EXISTS `idx_diary_created_at` ON `diary` (`created_at`, `id`);
+
+-- MySQL's `ON UPDATE CURRENT_TIMESTAMP(6)`, for edits of the entry itself
+-- (backfills such as `flask rebuild-excerpts` keep `updated_at`)
+CREATE TRIGGER IF NOT EXISTS `trg_diary_updated_at` AFTER UPDATE OF `title`, `content` ON `diary`
+FOR EACH ROW WHEN NEW.updated_at = OLD.updated_at
+BEGIN
+    UPDATE `diary` SET `updated_at` = strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') WHERE `id` = NEW.id;
+END;
+
+CREATE TABLE IF NOT EXISTS `users` (
+    `id` INTEGER PRIMARY KEY,
+    `username` VARCHAR(150) NOT NULL UNIQUE,
+    `password_hash` VARCHAR(255) NOT NULL
+);
+
+-- Tags table and many-to-many association to diary entries.
+-- NOCASE matches the case-insensitive uniqueness of the MySQL collation.
+CREATE TABLE IF NOT EXISTS `tags` (
+    `id` INTEGER PRIMARY KEY,
+    `name` VARCHAR(100) NOT NULL UNIQUE COLLATE NOCASE,
+    `parent_id` BIGINT NULL REFERENCES `tags` (`id`) ON DELETE SET NULL,
+    -- Materialized path `/root/.../id/` and depth (see `diary/tagpaths.py`);
+    -- NOCASE lets `LIKE 'prefix%'` use the index
+    `path` VARCHAR(700) NOT NULL DEFAULT '' COLLATE NOCASE,
+    `depth` INT NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS `idx_tags_path` ON `tags` (`path`);
+
+CREATE TABLE IF NOT EXISTS `diary_tags` (
+    `diary_id` BIGINT NOT NULL REFERENCES `diary` (`id`) ON DELETE CASCADE,
+    `tag_id` BIGINT NOT NULL REFERENCES `tags` (`id`) ON DELETE CASCADE,
+    PRIMARY KEY (`diary_id`, `tag_id`)
+) WITHOUT ROWID;
+-- Tag filters: entries carrying a tag
+CREATE INDEX IF NOT EXISTS `idx_diary_tags_tag` ON `diary_tags` (`tag_id`, `diary_id`);
+
+-- Closure table mapping diary entries to tags including ancestor tags.
+-- Maintained by `diary/closure.py`; backfill with `flask rebuild-closure`.
+CREATE TABLE IF NOT EXISTS `diary_tags_closure` (
+    `diary_id` BIGINT NOT NULL REFERENCES `diary` (`id`) ON DELETE CASCADE,
+    `tag_id` BIGINT NOT NULL REFERENCES `tags` (`id`) ON DELETE CASCADE,
+    PRIMARY KEY (`diary_id`, `tag_id`)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS `idx_diary_tags_closure_tag` ON `diary_tags_closure` (`tag_id`, `diary_id`);
+
+-- Inverted index for full-text search (maintained by `diary/fulltext.py`).
+-- Tokens are stored case-folded; NOCASE lets `LIKE 'prefix%'` use the index.
+CREATE TABLE IF NOT EXISTS `diary_postings` (
+    `token` VARCHAR(64) NOT NULL COLLATE NOCASE,
+    `diary_id` BIGINT NOT NULL REFERENCES `diary` (`id`) ON DELETE CASCADE,
+    `weight` INT NOT NULL,
+    PRIMARY KEY (`token`, `diary_id`)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS `idx_diary_postings_diary` ON `diary_postings` (`diary_id`);
+
+-- Maintained entry counts (see `diary/counters.py`); `tag_id = 0` holds the
+-- total number of entries. Repair drift with `flask reconcile-counters`.
+CREATE TABLE IF NOT EXISTS `entry_counters` (
+    `tag_id` BIGINT NOT NULL PRIMARY KEY,
+    `direct_count` BIGINT NOT NULL DEFAULT 0,
+    `rollup_count` BIGINT NOT NULL DEFAULT 0
+);
+
+-- Persistent search history and counts
+CREATE TABLE IF NOT EXISTS `search_history` (
+    `term` VARCHAR(255) NOT NULL PRIMARY KEY,
+    `count` BIGINT NOT NULL DEFAULT 0,
+    `last_searched` TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS `idx_search_history_count` ON `search_history` (`count`, `last_searched`);
+CREATE INDEX IF NOT EXISTS `idx_search_history_last` ON `search_history` (`last_searched`, `count`);
+
+-- Entry writes, read by the per-worker indexes to catch up (see `diary/changelog.py`)
+CREATE TABLE IF NOT EXISTS `entry_changes` (
+    `seq` INTEGER PRIMARY KEY AUTOINCREMENT,
+    `diary_id` BIGINT NULL,
+    `tag_id` BIGINT NULL
+);
+
+-- Applied migrations (see `diary/migrations.py`, `flask migrate`)
+CREATE TABLE IF NOT EXISTS `schema_version` (
+    `version` INT NOT NULL PRIMARY KEY,
+    `description` VARCHAR(255) NOT NULL,
+    `applied_at` TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+
+-- Convenience views
+-- `diary_with_tags` presents diary rows with a comma-separated `tags` column
+DROP VIEW IF EXISTS `diary_with_tags`;
+CREATE VIEW `diary_with_tags` AS
+SELECT d.id, d.title, d.content, d.created_at,
+       GROUP_CONCAT(t.name, ',') AS tags
+FROM diary d
+LEFT JOIN diary_tags dt ON dt.diary_id = d.id
+LEFT JOIN tags t ON t.id = dt.tag_id
+GROUP BY d.id;
+
+-- `tags_with_usage` presents tags with their direct usage counts and optional parent
+DROP VIEW IF EXISTS `tags_with_usage`;
+CREATE VIEW `tags_with_usage` AS
+SELECT t.id, t.name, t.parent_id AS parent_id, COUNT(dt.diary_id) AS usage_count
+FROM tags t
+LEFT JOIN diary_tags dt ON dt.tag_id = t.id
+GROUP BY t.id;
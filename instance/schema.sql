@@ -2,7 +2,15 @@ CREATE TABLE IF NOT EXISTS `diary` (
     `id` BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     `title` VARCHAR(255) NOT NULL,
     `content` TEXT NOT NULL,
-    `created_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    -- Listing excerpt, maintained by `diary/excerpts.py`
+    `excerpt` VARCHAR(2000) NOT NULL DEFAULT '',
+    `excerpt_truncated` TINYINT(1) NOT NULL DEFAULT 0,
+    `created_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Validator for conditional GETs and `flask export --since`
+    `updated_at` TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+    KEY `idx_diary_updated_at` (`updated_at`),
+    -- Listings sort by `created_at DESC, id DESC` (keyset pagination)
+    KEY `idx_diary_created_at` (`created_at`, `id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE IF NOT EXISTS `users` (
@@ -16,6 +24,10 @@ CREATE TABLE IF NOT EXISTS `tags` (
     `id` BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     `name` VARCHAR(100) NOT NULL UNIQUE,
     `parent_id` BIGINT NULL,
+    -- Materialized path `/root/.../id/` and depth (see `diary/tagpaths.py`)
+    `path` VARCHAR(700) CHARACTER SET ascii COLLATE ascii_bin NOT NULL DEFAULT '',
+    `depth` INT NOT NULL DEFAULT 0,
+    KEY `idx_tags_path` (`path`),
     CONSTRAINT `fk_tags_parent` FOREIGN KEY (`parent_id`) REFERENCES `tags` (`id`) ON DELETE SET NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
@@ -23,25 +35,65 @@ CREATE TABLE IF NOT EXISTS `diary_tags` (
     `diary_id` BIGINT NOT NULL,
     `tag_id` BIGINT NOT NULL,
     PRIMARY KEY (`diary_id`, `tag_id`),
+    -- Tag filters: entries carrying a tag
+    KEY `idx_diary_tags_tag` (`tag_id`, `diary_id`),
     CONSTRAINT `fk_diary_tags_diary` FOREIGN KEY (`diary_id`) REFERENCES `diary` (`id`) ON DELETE CASCADE,
     CONSTRAINT `fk_diary_tags_tag` FOREIGN KEY (`tag_id`) REFERENCES `tags` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- Closure table mapping diary entries to tags including ancestor tags (if tag hierarchy used).
 -- This lets queries filter entries by tag name while respecting tag parent relationships.
+-- Maintained by `diary/closure.py`; backfill with `flask rebuild-closure`.
 CREATE TABLE IF NOT EXISTS `diary_tags_closure` (
     `diary_id` BIGINT NOT NULL,
     `tag_id` BIGINT NOT NULL,
     PRIMARY KEY (`diary_id`, `tag_id`),
+    KEY `idx_diary_tags_closure_tag` (`tag_id`, `diary_id`),
     CONSTRAINT `fk_diary_tags_closure_diary` FOREIGN KEY (`diary_id`) REFERENCES `diary` (`id`) ON DELETE CASCADE,
     CONSTRAINT `fk_diary_tags_closure_tag` FOREIGN KEY (`tag_id`) REFERENCES `tags` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- Inverted index for full-text search (maintained by `diary/fulltext.py`).
+-- `weight` is the token's frequency in the entry, title hits weighted higher.
+-- Binary collation keeps case-folded tokens distinct and prefix scans exact.
+CREATE TABLE IF NOT EXISTS `diary_postings` (
+    `token` VARCHAR(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+    `diary_id` BIGINT NOT NULL,
+    `weight` INT NOT NULL,
+    PRIMARY KEY (`token`, `diary_id`),
+    KEY `idx_diary_postings_diary` (`diary_id`),
+    CONSTRAINT `fk_diary_postings_diary` FOREIGN KEY (`diary_id`) REFERENCES `diary` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Maintained entry counts (see `diary/counters.py`); `tag_id = 0` holds the
+-- total number of entries. Repair drift with `flask reconcile-counters`.
+CREATE TABLE IF NOT EXISTS `entry_counters` (
+    `tag_id` BIGINT NOT NULL PRIMARY KEY,
+    `direct_count` BIGINT NOT NULL DEFAULT 0,
+    `rollup_count` BIGINT NOT NULL DEFAULT 0
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 -- Persistent search history and counts
 CREATE TABLE IF NOT EXISTS `search_history` (
     `term` VARCHAR(255) NOT NULL PRIMARY KEY,
     `count` BIGINT NOT NULL DEFAULT 0,
-    `last_searched` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    `last_searched` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    KEY `idx_search_history_count` (`count`, `last_searched`),
+    KEY `idx_search_history_last` (`last_searched`, `count`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Entry writes, read by the per-worker indexes to catch up (see `diary/changelog.py`)
+CREATE TABLE IF NOT EXISTS `entry_changes` (
+    `seq` BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    `diary_id` BIGINT NULL,
+    `tag_id` BIGINT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Applied migrations (see `diary/migrations.py`, `flask migrate`)
+CREATE TABLE IF NOT EXISTS `schema_version` (
+    `version` INT NOT NULL PRIMARY KEY,
+    `description` VARCHAR(255) NOT NULL,
+    `applied_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- Convenience views